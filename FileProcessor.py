@@ -4,7 +4,12 @@
 # copyright Tom Goetz
 #
 
-import logging, sys, os, re, datetime
+import logging, sys, os, re, time
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 
 logger = logging.getLogger(__file__)
@@ -12,6 +17,9 @@ logger = logging.getLogger(__file__)
 
 class FileProcessor():
 
+    # without a recorded import cursor, 'latest' means modified in the last day
+    latest_secs = 24 * 60 * 60
+
     @classmethod
     def match_file(cls, input_file, file_regex):
         logger.info("Reading file: " + input_file)
@@ -21,13 +29,24 @@ class FileProcessor():
         return []
 
     @classmethod
-    def dir_to_files(cls, input_dir, file_regex, latest=False):
+    def scan_dir(cls, input_dir, compiled_regex, recursive, newer_than):
+        for entry in scandir(input_dir):
+            if entry.is_dir():
+                if recursive:
+                    for file_entry in cls.scan_dir(entry.path, compiled_regex, recursive, newer_than):
+                        yield file_entry
+            elif compiled_regex.search(entry.name):
+                mtime = entry.stat().st_mtime
+                if newer_than is None or mtime > newer_than:
+                    yield (mtime, entry.path)
+
+    @classmethod
+    def dir_to_file_mtimes(cls, input_dir, file_regex, latest=False, recursive=False, newer_than=None):
         logger.info("Reading directory: " + input_dir)
-        file_names = []
-        timestamp = datetime.datetime.now() - datetime.timedelta(1)
-        for file in os.listdir(input_dir):
-            match = re.search(file_regex, file)
-            file_with_path = input_dir + "/" + file
-            if match and (not latest or datetime.datetime.fromtimestamp(os.stat(file_with_path).st_ctime) > timestamp):
-                file_names.append(file_with_path)
-        return file_names
+        if latest and newer_than is None:
+            newer_than = time.time() - cls.latest_secs
+        return sorted(cls.scan_dir(input_dir, re.compile(file_regex), recursive, newer_than))
+
+    @classmethod
+    def dir_to_files(cls, input_dir, file_regex, latest=False, recursive=False, newer_than=None):
+        return [file_name for (mtime, file_name) in cls.dir_to_file_mtimes(input_dir, file_regex, latest, recursive, newer_than)]
@@ -285,12 +285,28 @@ class FitFileProcessor():
     def write_zones_target_entry(self, fit_file, zones_target_message):
         logger.debug("zones target message: " + repr(zones_target_message.to_dict()))
 
+    def write_record(self, fit_file, message_type, messages):
+        # buffer the file's records, write them in one batch, and derive the activity metrics from the buffer
+        self.record_activity_id = GarminDB.File.get(self.garmin_db, fit_file.filename)
+        self.records = []
+        self.record_powers = []
+        self.write_generic(fit_file, message_type, messages)
+        GarminDB.ActivityRecords.create_or_update_batch(self.garmin_act_db, self.records, True)
+        self.garmin_act_db.invalidate_track(self.record_activity_id)
+        records = {
+            'timestamp' : [record['timestamp'] for record in self.records],
+            'distance'  : [record['distance'] for record in self.records],
+            'alititude' : [record['alititude'] for record in self.records],
+            'hr'        : [record['hr'] for record in self.records],
+            'power'     : self.record_powers,
+        }
+        GarminDB.ActivityMetrics.compute(self.garmin_act_db, self.record_activity_id, records, self.english_units)
+
     def write_record_entry(self, fit_file, record_message):
         message_dict = record_message.to_dict()
         logger.debug("record message: " + repr(message_dict))
-        activity_id = GarminDB.File.get(self.garmin_db, fit_file.filename)
         record = {
-            'activity_id'                       : activity_id,
+            'activity_id'                       : self.record_activity_id,
             'record'                            : self.record,
             'timestamp'                         : message_dict['timestamp'],
             'position_lat'                      : message_dict.get('position_lat', None),
@@ -302,7 +318,8 @@ class FitFileProcessor():
             'speed'                             : message_dict.get('speed', None),
             'temperature'                       : message_dict.get('temperature', None),
         }
-        GarminDB.ActivityRecords.create_or_update_not_none(self.garmin_act_db, record)
+        self.records.append(record)
+        self.record_powers.append(message_dict.get('power', None))
         self.record += 1
 
     def write_dev_data_id_entry(self, fit_file, dev_data_id_message):
@@ -326,21 +343,34 @@ class FitFileProcessor():
                 }
                 GarminDB.MonitoringInfo.find_or_create(self.garmin_mon_db, entry)
 
-    def write_monitoring_entry(self, fit_file, message):
-        entry = message.to_dict()
-        try:
-            if GarminDB.MonitoringHeartRate.matches(entry):
-                GarminDB.MonitoringHeartRate.create_or_update_not_none(self.garmin_mon_db, entry)
-            elif GarminDB.MonitoringIntensity.matches(entry):
-                GarminDB.MonitoringIntensity.create_or_update_not_none(self.garmin_mon_db, entry)
-            elif GarminDB.MonitoringClimb.matches(entry):
-                GarminDB.MonitoringClimb.create_or_update_not_none(self.garmin_mon_db, entry)
-            else:
-                GarminDB.Monitoring.create_or_update_not_none(self.garmin_mon_db, entry)
-        except ValueError as e:
-            logger.info("ValueError: %s" % str(e))
-        except Exception as e:
-            logger.info("Exception on entry: %s: %s" % (repr(entry), str(e)))
+    def monitoring_table(self, entry):
+        for table in [GarminDB.MonitoringHeartRate, GarminDB.MonitoringIntensity, GarminDB.MonitoringClimb, GarminDB.Monitoring]:
+            if table.matches(entry):
+                return table
+        return None
+
+    def write_monitoring(self, fit_file, message_type, messages):
+        # group the file's entries by table and year and upsert each group on the table's natural key
+        entries = {}
+        timestamps = []
+        for message in messages:
+            entry = message.to_dict()
+            timestamp = entry.get('timestamp', None)
+            table = self.monitoring_table(entry)
+            if table is None or timestamp is None:
+                logger.debug("Monitoring message not written: " + repr(entry))
+                continue
+            entries.setdefault((table, timestamp.year), []).append(entry)
+            timestamps.append(timestamp)
+        for (table, year), table_entries in entries.iteritems():
+            # looked up as each group is written, adding a partition can merge the oldest ones
+            mon_db = self.garmin_mon_db.partition(table_entries[0]['timestamp'])
+            table.upsert_batch(mon_db, table_entries, True)
+            if issubclass(table, GarminDB.CounterDeltas):
+                table_timestamps = [table_entry['timestamp'] for table_entry in table_entries]
+                table.update_deltas(mon_db, min(table_timestamps), max(table_timestamps))
+        if len(timestamps) > 0:
+            GarminDB.MonitoringHourly.rollup(self.garmin_mon_db, min(timestamps), max(timestamps))
 
     def write_device_info_entry(self, fit_file, device_info_message):
         parsed_message = device_info_message.to_dict()
@@ -4,7 +4,12 @@
 # copyright Tom Goetz
 #
 
+import math
+
+from sqlalchemy import or_, and_
+
 from HealthDB import *
+from Fit import Conversions
 
 logger = logging.getLogger(__name__)
 
@@ -12,7 +17,7 @@ logger = logging.getLogger(__name__)
 class ActivitiesDB(DB):
     Base = declarative_base()
     db_name = 'garmin_activities'
-    db_version = 6
+    db_version = 7
 
     class DbVersion(Base, DbVersionObject):
         pass
@@ -22,7 +27,7 @@ class ActivitiesDB(DB):
         DB.__init__(self, db_params_dict, debug)
         ActivitiesDB.Base.metadata.create_all(self.engine)
         self.version = SummaryDB.DbVersion()
-        self.version.version_check(self, self.db_version)
+        self.version.version_check(self, self.db_version, {6 : ActivitiesDB.migrate_epoch_timestamps})
 
         RunActivities.create_view(self)
         WalkActivities.create_view(self)
@@ -30,6 +35,30 @@ class ActivitiesDB(DB):
         CycleActivities.create_view(self)
         EllipticalActivities.create_view(self)
 
+    def migrate_epoch_timestamps(self):
+        self.convert_to_epoch(ActivityRecords.__tablename__, 'timestamp')
+        self.vacuum()
+
+    def update_track_tables(self):
+        ActivityStartPoints.index_missing(self)
+        ActivityTrackCells.index_missing(self)
+        ActivityPolylines.index_missing(self)
+        SegmentEfforts.update(self)
+
+    def delete_activity_data(self, activity_id):
+        # the laps and records written for an activity whose file failed part way through
+        session = self.session()
+        for table in [ActivityLaps, ActivityRecords]:
+            session.query(table).filter(table.activity_id == activity_id).delete(synchronize_session=False)
+        DB.commit(session)
+        self.invalidate_track(activity_id)
+
+    def invalidate_track(self, activity_id):
+        # the activity's records changed, update_track_tables rebuilds what's derived from them
+        ActivityTrackCells.invalidate(self, activity_id)
+        ActivityPolylines.invalidate(self, activity_id)
+        SegmentEfforts.invalidate_activity(self, activity_id)
+
 
 class Activities(ActivitiesDB.Base, DBObject):
     __tablename__ = 'activities'
@@ -84,6 +113,14 @@ class Activities(ActivitiesDB.Base, DBObject):
     def _find_query(cls, session, values_dict):
         return session.query(cls).filter(cls.activity_id == values_dict['activity_id'])
 
+    @classmethod
+    def get_started_in_box(cls, db, min_lat, min_long, max_lat, max_long):
+        return ActivityStartPoints.get_in_box(db, min_lat, min_long, max_lat, max_long)
+
+    @classmethod
+    def get_started_near(cls, db, latitude, longitude, radius_meters):
+        return ActivityStartPoints.get_near(db, latitude, longitude, radius_meters)
+
 
 class ActivityLaps(ActivitiesDB.Base, DBObject):
     __tablename__ = 'activity_laps'
@@ -138,7 +175,7 @@ class ActivityRecords(ActivitiesDB.Base, DBObject):
 
     activity_id = Column(Integer, ForeignKey('activities.activity_id'))
     record = Column(Integer)
-    timestamp = Column(DateTime, primary_key=True)
+    timestamp = Column(EpochDateTime, primary_key=True)
     # degrees
     position_lat = Column(Float)
     position_long = Column(Float)
@@ -163,6 +200,566 @@ class ActivityRecords(ActivitiesDB.Base, DBObject):
     def _find_query(cls, session, values_dict):
         return session.query(cls).filter(cls.activity_id == values_dict['activity_id']).filter(cls.record == values_dict['record'])
 
+    @classmethod
+    def get_activities_in_box(cls, db, min_lat, min_long, max_lat, max_long):
+        return ActivityTrackCells.get_in_box(db, min_lat, min_long, max_lat, max_long)
+
+    @classmethod
+    def get_activities_near(cls, db, latitude, longitude, radius_meters):
+        return ActivityTrackCells.get_near(db, latitude, longitude, radius_meters)
+
+
+#
+# Metrics derived from an activity's record stream, computed once at import time so reports are a single row lookup.
+# Records come in as columns: timestamp, distance (kms or miles), alititude (feet or meters), hr, and optionally
+# power (watts).
+#
+class ActivityMetrics(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'activity_metrics'
+
+    activity_id = Column(Integer, ForeignKey('activities.activity_id'), primary_key=True)
+    # time in HR zones, by percent of the highest max HR of all activities: 50-60%, 60-70%, 70-80%, 80-90%, 90%+
+    hr_zone_1_time = Column(Time)
+    hr_zone_2_time = Column(Time)
+    hr_zone_3_time = Column(Time)
+    hr_zone_4_time = Column(Time)
+    hr_zone_5_time = Column(Time)
+    # fastest time over the distance anywhere in the activity
+    best_1k_time = Column(Time)
+    best_mile_time = Column(Time)
+    best_5k_time = Column(Time)
+    # watts
+    normalized_power = Column(Float)
+    # mins/km or mins/mile, pace adjusted for the cost of running up and down hill
+    grade_adjusted_pace = Column(Time)
+
+    min_row_values = 2
+
+    hr_zone_percents = [0.5, 0.6, 0.7, 0.8, 0.9]
+    # a sample doesn't count for more than this, longer gaps are pauses
+    max_sample_secs = 30
+    best_distances = {'best_1k_time' : 1000.0, 'best_mile_time' : 1609.344, 'best_5k_time' : 5000.0}
+    # grades are taken over stretches at least this long and capped to what the cost model covers
+    grade_segment_meters = 10.0
+    max_grade = 0.45
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.activity_id == values_dict['activity_id'])
+
+    @classmethod
+    def sample_durations(cls, timestamps):
+        durations = [min((timestamps[index + 1] - timestamps[index]).total_seconds(), cls.max_sample_secs) for index in xrange(len(timestamps) - 1)]
+        return durations + [0]
+
+    @classmethod
+    def hr_zone_times(cls, max_hr, hrs, durations):
+        zone_secs = [0] * len(cls.hr_zone_percents)
+        if max_hr:
+            zone_floors = [max_hr * percent for percent in cls.hr_zone_percents]
+            for hr, duration in zip(hrs, durations):
+                if hr is None:
+                    continue
+                for zone in xrange(len(zone_floors) - 1, -1, -1):
+                    if hr >= zone_floors[zone]:
+                        zone_secs[zone] += duration
+                        break
+        return zone_secs
+
+    @classmethod
+    def best_time(cls, timestamps, distances, target):
+        # two pointers: the shortest window covering the target distance ending at each sample
+        best = None
+        start = 0
+        for end in xrange(len(distances)):
+            while start < end and distances[end] - distances[start + 1] >= target:
+                start += 1
+            if distances[end] - distances[start] >= target:
+                secs = (timestamps[end] - timestamps[start]).total_seconds()
+                if best is None or secs < best:
+                    best = secs
+        return best
+
+    @classmethod
+    def normalized_power(cls, timestamps, powers):
+        # 30 second rolling average of power sampled each second, then the fourth root of the mean of the fourth powers
+        seconds = []
+        for index in xrange(len(timestamps) - 1):
+            if powers[index] is not None:
+                seconds.extend([powers[index]] * int(min((timestamps[index + 1] - timestamps[index]).total_seconds(), cls.max_sample_secs)))
+        if len(seconds) < 30:
+            return None
+        window_sum = sum(seconds[:30])
+        fourth_powers = (window_sum / 30.0) ** 4
+        for index in xrange(30, len(seconds)):
+            window_sum += seconds[index] - seconds[index - 30]
+            fourth_powers += (window_sum / 30.0) ** 4
+        return (fourth_powers / (len(seconds) - 29)) ** 0.25
+
+    @classmethod
+    def grade_cost(cls, grade):
+        # Minetti's energy cost of running on a grade, J/kg/m, 3.6 on the flat
+        return (155.4 * grade ** 5) - (30.4 * grade ** 4) - (43.3 * grade ** 3) + (46.3 * grade ** 2) + (19.5 * grade) + 3.6
+
+    @classmethod
+    def grade_adjusted_secs_per_meter(cls, timestamps, distances, altitudes, durations):
+        adjusted_meters = 0.0
+        moving_secs = 0.0
+        segment_start = None
+        for index in xrange(len(distances)):
+            if distances[index] is None or altitudes[index] is None:
+                continue
+            if segment_start is None:
+                segment_start = index
+                continue
+            segment_meters = distances[index] - distances[segment_start]
+            if segment_meters < cls.grade_segment_meters:
+                continue
+            grade = max(-cls.max_grade, min(cls.max_grade, (altitudes[index] - altitudes[segment_start]) / segment_meters))
+            adjusted_meters += segment_meters * cls.grade_cost(grade) / 3.6
+            moving_secs += sum(durations[segment_start:index])
+            segment_start = index
+        if adjusted_meters > 0:
+            return moving_secs / adjusted_meters
+
+    @classmethod
+    def compute(cls, db, activity_id, records, english_units):
+        timestamps = records['timestamp']
+        if len(timestamps) < 2:
+            return
+        if english_units:
+            (distance_meters, altitude_meters, pace_meters) = (1609.344, 0.3048, 1609.344)
+        else:
+            (distance_meters, altitude_meters, pace_meters) = (1000.0, 1.0, 1000.0)
+        durations = cls.sample_durations(timestamps)
+        metrics = {'activity_id' : activity_id}
+        max_hr = Activities.get_col_max(db, Activities.max_hr)
+        for zone, secs in enumerate(cls.hr_zone_times(max_hr, records['hr'], durations)):
+            metrics['hr_zone_%d_time' % (zone + 1)] = Conversions.secs_to_dt_time(int(secs))
+        distance_samples = [(timestamp, distance * distance_meters) for timestamp, distance in zip(timestamps, records['distance']) if distance is not None]
+        if len(distance_samples) > 1:
+            (distance_timestamps, distances) = zip(*distance_samples)
+            for col_name, target in cls.best_distances.iteritems():
+                secs = cls.best_time(distance_timestamps, distances, target)
+                if secs is not None:
+                    metrics[col_name] = Conversions.secs_to_dt_time(int(secs))
+        powers = records.get('power')
+        if powers is not None:
+            metrics['normalized_power'] = cls.normalized_power(timestamps, powers)
+        distances = [distance * distance_meters if distance is not None else None for distance in records['distance']]
+        altitudes = [altitude * altitude_meters if altitude is not None else None for altitude in records['alititude']]
+        secs_per_meter = cls.grade_adjusted_secs_per_meter(timestamps, distances, altitudes, durations)
+        if secs_per_meter is not None:
+            metrics['grade_adjusted_pace'] = Conversions.secs_to_dt_time(int(secs_per_meter * pace_meters))
+        cls.create_or_update_not_none(db, metrics)
+
+    @classmethod
+    def update(cls, db, activity_id, english_units):
+        # recompute from the stored records, for activities imported without buffering
+        import Series
+        cls.compute(db, activity_id, Series.Series.activity_records(db, activity_id), english_units)
+
+
+#
+# Spatial index over activity start points and tracks. Rows are keyed by geohash with a B-tree index, so box and
+# radius queries scan a few index ranges instead of every activity or record. The importers keep them up to date
+# with ActivitiesDB.update_track_tables.
+#
+class ActivityStartPoints(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'activity_start_points'
+
+    activity_id = Column(Integer, ForeignKey('activities.activity_id'), primary_key=True)
+    geohash = Column(String(12), nullable=False, index=True)
+    # degrees
+    latitude = Column(Float)
+    longitude = Column(Float)
+
+    # about 5m x 5m
+    precision = 9
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.activity_id == values_dict['activity_id'])
+
+    @classmethod
+    def box_filter(cls, query, geohash_col, precision, min_lat, min_long, max_lat, max_long):
+        ranges = [geohash_prefix_range(prefix) for prefix in geohash_cover(min_lat, min_long, max_lat, max_long, precision)]
+        return query.filter(or_(*[and_(geohash_col >= low, geohash_col < high) for (low, high) in ranges]))
+
+    @classmethod
+    def index_missing(cls, db):
+        session = db.session()
+        missing = (
+            session.query(Activities.activity_id, Activities.start_lat, Activities.start_long)
+                .outerjoin(cls, cls.activity_id == Activities.activity_id)
+                .filter(cls.activity_id == None)
+                .filter(Activities.start_lat != None)
+                .filter(Activities.start_long != None)
+                .all()
+        )
+        for (activity_id, latitude, longitude) in missing:
+            session.add(cls(activity_id=activity_id, geohash=geohash_encode(latitude, longitude, cls.precision), latitude=latitude, longitude=longitude))
+        DB.commit(session)
+        logger.info("Indexed start points of %d activities" % len(missing))
+
+    @classmethod
+    def get_in_box(cls, db, min_lat, min_long, max_lat, max_long):
+        query = cls.box_filter(db.query_session().query(cls.activity_id), cls.geohash, cls.precision, min_lat, min_long, max_lat, max_long)
+        query = query.filter(cls.latitude.between(min_lat, max_lat)).filter(cls.longitude.between(min_long, max_long))
+        return [activity_id for (activity_id,) in query.all()]
+
+    @classmethod
+    def get_near(cls, db, latitude, longitude, radius_meters):
+        (min_lat, min_long, max_lat, max_long) = radius_bounding_box(latitude, longitude, radius_meters)
+        query = cls.box_filter(db.query_session().query(cls.activity_id, cls.latitude, cls.longitude), cls.geohash, cls.precision, min_lat, min_long, max_lat, max_long)
+        near = []
+        for (activity_id, start_lat, start_long) in query.all():
+            meters = distance_meters(latitude, longitude, start_lat, start_long)
+            if meters <= radius_meters:
+                near.append((activity_id, meters))
+        return sorted(near, key=lambda activity_meters: activity_meters[1])
+
+
+class ActivityTrackCells(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'activity_track_cells'
+
+    # geohash first so the primary key doubles as the spatial index
+    geohash = Column(String(12), primary_key=True)
+    activity_id = Column(Integer, ForeignKey('activities.activity_id'), primary_key=True, index=True)
+
+    # about 150m x 150m
+    precision = 7
+    # marks activities without GPS records as indexed, never matches a query
+    no_track = ''
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.geohash == values_dict['geohash']).filter(cls.activity_id == values_dict['activity_id'])
+
+    @classmethod
+    def index_missing(cls, db):
+        session = db.session()
+        missing = session.query(Activities.activity_id).outerjoin(cls, cls.activity_id == Activities.activity_id).filter(cls.activity_id == None).all()
+        for (activity_id,) in missing:
+            points = (
+                session.query(ActivityRecords.position_lat, ActivityRecords.position_long)
+                    .filter(ActivityRecords.activity_id == activity_id)
+                    .filter(ActivityRecords.position_lat != None)
+                    .filter(ActivityRecords.position_long != None)
+                    .all()
+            )
+            cells = set([geohash_encode(latitude, longitude, cls.precision) for (latitude, longitude) in points])
+            if len(cells) == 0:
+                cells.add(cls.no_track)
+            for cell in cells:
+                session.add(cls(geohash=cell, activity_id=activity_id))
+        DB.commit(session)
+        logger.info("Indexed tracks of %d activities" % len(missing))
+
+    @classmethod
+    def invalidate(cls, db, activity_id):
+        session = db.session()
+        session.query(cls).filter(cls.activity_id == activity_id).delete(synchronize_session=False)
+        DB.commit(session)
+
+    @classmethod
+    def get_in_box(cls, db, min_lat, min_long, max_lat, max_long):
+        # cells narrow it down to a few candidate activities, their records decide
+        activity_ids = []
+        for activity_id in cls.get_candidates(db, min_lat, min_long, max_lat, max_long):
+            query = (
+                db.query_session().query(ActivityRecords.record)
+                    .filter(ActivityRecords.activity_id == activity_id)
+                    .filter(ActivityRecords.position_lat.between(min_lat, max_lat))
+                    .filter(ActivityRecords.position_long.between(min_long, max_long))
+            )
+            if query.first() is not None:
+                activity_ids.append(activity_id)
+        return activity_ids
+
+    @classmethod
+    def get_candidates(cls, db, min_lat, min_long, max_lat, max_long):
+        # dedup here, with DISTINCT SQLite scans the activity_id index instead of the geohash ranges
+        query = ActivityStartPoints.box_filter(db.query_session().query(cls.activity_id), cls.geohash, cls.precision, min_lat, min_long, max_lat, max_long)
+        return sorted(set([activity_id for (activity_id,) in query.all()]))
+
+    @classmethod
+    def get_near(cls, db, latitude, longitude, radius_meters):
+        # returns (activity id, closest approach in meters) sorted by closest approach
+        (min_lat, min_long, max_lat, max_long) = radius_bounding_box(latitude, longitude, radius_meters)
+        near = []
+        for activity_id in cls.get_candidates(db, min_lat, min_long, max_lat, max_long):
+            points = (
+                db.query_session().query(ActivityRecords.position_lat, ActivityRecords.position_long)
+                    .filter(ActivityRecords.activity_id == activity_id)
+                    .filter(ActivityRecords.position_lat.between(min_lat, max_lat))
+                    .filter(ActivityRecords.position_long.between(min_long, max_long))
+                    .all()
+            )
+            if len(points) > 0:
+                meters = min([distance_meters(latitude, longitude, point_lat, point_long) for (point_lat, point_long) in points])
+                if meters <= radius_meters:
+                    near.append((activity_id, meters))
+        return sorted(near, key=lambda activity_meters: activity_meters[1])
+
+
+#
+# Simplified track shape of each activity as an encoded polyline, so drawing a map or matching a route reads one short
+# string instead of every record.
+#
+class ActivityPolylines(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'activity_polylines'
+
+    activity_id = Column(Integer, ForeignKey('activities.activity_id'), primary_key=True)
+    # Google encoded polyline of the simplified track
+    polyline = Column(String)
+    points = Column(Integer)
+    record_points = Column(Integer)
+
+    # meters a simplified track can stray from the recorded one
+    tolerance_meters = 5.0
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.activity_id == values_dict['activity_id'])
+
+    @classmethod
+    def index_missing(cls, db):
+        session = db.session()
+        missing = session.query(Activities.activity_id).outerjoin(cls, cls.activity_id == Activities.activity_id).filter(cls.activity_id == None).all()
+        for (activity_id,) in missing:
+            points = (
+                session.query(ActivityRecords.position_lat, ActivityRecords.position_long)
+                    .filter(ActivityRecords.activity_id == activity_id)
+                    .filter(ActivityRecords.position_lat != None)
+                    .filter(ActivityRecords.position_long != None)
+                    .order_by(ActivityRecords.timestamp)
+                    .all()
+            )
+            simplified = simplify_track(points, cls.tolerance_meters)
+            # activities without GPS get an empty polyline so they aren't revisited
+            session.add(cls(activity_id=activity_id, polyline=polyline_encode(simplified), points=len(simplified), record_points=len(points)))
+        DB.commit(session)
+        logger.info("Simplified tracks of %d activities" % len(missing))
+
+    @classmethod
+    def invalidate(cls, db, activity_id):
+        session = db.session()
+        session.query(cls).filter(cls.activity_id == activity_id).delete(synchronize_session=False)
+        DB.commit(session)
+
+    @classmethod
+    def get_track(cls, db, activity_id):
+        # [(latitude, longitude), ...] or None if the activity hasn't been simplified
+        row = db.query_session().query(cls.polyline).filter(cls.activity_id == activity_id).first()
+        if row is not None:
+            return polyline_decode(row.polyline)
+
+
+#
+# User defined segments and the efforts on them. Activities are prefiltered with the track cells index, so only
+# activities that passed near both ends of a segment have their records read. Efforts are kept in segment_efforts
+# and only activities not checked against a segment yet are matched when new activities are imported.
+#
+class Segments(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'segments'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
+    # Google encoded polyline
+    polyline = Column(String)
+    # meters
+    distance = Column(Float)
+    # degrees
+    start_lat = Column(Float)
+    start_long = Column(Float)
+    stop_lat = Column(Float)
+    stop_long = Column(Float)
+
+    # how far a track can be from the segment and still be on it
+    tolerance_meters = 25.0
+    simplify_meters = 5.0
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.name == values_dict['name'])
+
+    @classmethod
+    def create_from_activity(cls, db, name, activity_id, first_record=None, last_record=None):
+        query = (
+            db.query_session().query(ActivityRecords.position_lat, ActivityRecords.position_long)
+                .filter(ActivityRecords.activity_id == activity_id)
+                .filter(ActivityRecords.position_lat != None)
+                .filter(ActivityRecords.position_long != None)
+        )
+        if first_record is not None:
+            query = query.filter(ActivityRecords.record >= first_record)
+        if last_record is not None:
+            query = query.filter(ActivityRecords.record <= last_record)
+        points = query.order_by(ActivityRecords.timestamp).all()
+        if len(points) < 2:
+            raise ValueError("Segment %s: activity %s has no GPS records in range" % (name, str(activity_id)))
+        simplified = simplify_track(points, cls.simplify_meters)
+        segment = {
+            'name'          : name,
+            'polyline'      : polyline_encode(simplified),
+            'distance'      : track_meters(points),
+            'start_lat'     : points[0][0],
+            'start_long'    : points[0][1],
+            'stop_lat'      : points[-1][0],
+            'stop_long'     : points[-1][1],
+        }
+        cls.create_or_update(db, segment)
+        segment_id = cls.find_id(db, {'name' : name})
+        # a new or redefined segment is matched against all activities again
+        SegmentEfforts.invalidate_segment(db, segment_id)
+        return segment_id
+
+    def points(self):
+        return polyline_decode(self.polyline)
+
+    def bounding_box(self):
+        points = self.points()
+        dlat = self.tolerance_meters / meters_per_degree
+        dlong = dlat / max(math.cos(math.radians(self.start_lat)), 0.01)
+        latitudes = [latitude for (latitude, longitude) in points]
+        longitudes = [longitude for (latitude, longitude) in points]
+        return (min(latitudes) - dlat, min(longitudes) - dlong, max(latitudes) + dlat, max(longitudes) + dlong)
+
+    def candidate_activities(self, db):
+        # activities whose tracks pass through the cells near both ends
+        start_box = radius_bounding_box(self.start_lat, self.start_long, self.tolerance_meters)
+        stop_box = radius_bounding_box(self.stop_lat, self.stop_long, self.tolerance_meters)
+        return set(ActivityTrackCells.get_candidates(db, *start_box)) & set(ActivityTrackCells.get_candidates(db, *stop_box))
+
+    @classmethod
+    def find_repeated_routes(cls, db, min_activities=2, length_tolerance=0.05):
+        # activities that start and finish in the same places and cover about the same distance, by simplified track
+        groups = {}
+        for (activity_id, polyline) in db.query_session().query(ActivityPolylines.activity_id, ActivityPolylines.polyline).filter(ActivityPolylines.points > 1).all():
+            points = polyline_decode(polyline)
+            key = (geohash_encode(points[0][0], points[0][1], ActivityTrackCells.precision), geohash_encode(points[-1][0], points[-1][1], ActivityTrackCells.precision))
+            groups.setdefault(key, []).append((track_meters(points), activity_id))
+        routes = []
+        for activities in groups.itervalues():
+            activities.sort()
+            route = [activities[0]]
+            for (meters, activity_id) in activities[1:]:
+                if meters > route[0][0] * (1 + length_tolerance):
+                    if len(route) >= min_activities:
+                        routes.append([route_activity_id for (route_meters, route_activity_id) in route])
+                    route = []
+                route.append((meters, activity_id))
+            if len(route) >= min_activities:
+                routes.append([route_activity_id for (route_meters, route_activity_id) in route])
+        return routes
+
+
+class SegmentEfforts(ActivitiesDB.Base, DBObject):
+    __tablename__ = 'segment_efforts'
+
+    segment_id = Column(Integer, ForeignKey('segments.id'), primary_key=True)
+    activity_id = Column(Integer, ForeignKey('activities.activity_id'), primary_key=True, index=True)
+    # the rest are None when the activity came near the segment but didn't cover it
+    start_time = Column(DateTime)
+    elapsed_time = Column(Time)
+    avg_hr = Column(Integer)
+    max_hr = Column(Integer)
+
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.segment_id == values_dict['segment_id']).filter(cls.activity_id == values_dict['activity_id'])
+
+    @classmethod
+    def covers(cls, segment_xy, track_xy, tolerance_meters):
+        # the track goes along the whole segment without straying from it
+        return points_within_meters(segment_xy, track_xy, tolerance_meters) and points_within_meters(track_xy, segment_xy, tolerance_meters)
+
+    @classmethod
+    def match(cls, db, segment, segment_xy, activity_id):
+        (min_lat, min_long, max_lat, max_long) = segment.bounding_box()
+        records = (
+            db.query_session().query(ActivityRecords.record, ActivityRecords.timestamp, ActivityRecords.position_lat, ActivityRecords.position_long, ActivityRecords.hr)
+                .filter(ActivityRecords.activity_id == activity_id)
+                .filter(ActivityRecords.position_lat.between(min_lat, max_lat))
+                .filter(ActivityRecords.position_long.between(min_long, max_long))
+                .order_by(ActivityRecords.timestamp)
+                .all()
+        )
+        effort = {'segment_id' : segment.id, 'activity_id' : activity_id}
+        track_xy = local_xy([(record.position_lat, record.position_long) for record in records], segment.start_lat)
+        (start_xy, stop_xy) = (segment_xy[0], segment_xy[-1])
+        tolerance = segment.tolerance_meters
+        best = None
+        start_index = None
+        left_start = False
+        for index, (x, y) in enumerate(track_xy):
+            if start_index is not None and records[index].record != records[index - 1].record + 1:
+                # the track left the segment's box
+                start_index = None
+            if start_index is not None and left_start and math.hypot(x - stop_xy[0], y - stop_xy[1]) <= tolerance:
+                if cls.covers(segment_xy, track_xy[start_index:index + 1], tolerance):
+                    elapsed = (records[index].timestamp - records[start_index].timestamp).total_seconds()
+                    if best is None or elapsed < best[2]:
+                        best = (start_index, index, elapsed)
+                start_index = None
+            if math.hypot(x - start_xy[0], y - start_xy[1]) <= tolerance:
+                # the effort starts from the last point near the start
+                start_index = index
+                left_start = False
+            elif start_index is not None:
+                left_start = True
+        if best is not None:
+            (start_index, stop_index, elapsed) = best
+            hrs = [record.hr for record in records[start_index:stop_index + 1] if record.hr is not None]
+            effort['start_time'] = records[start_index].timestamp
+            effort['elapsed_time'] = Conversions.secs_to_dt_time(int(elapsed))
+            if len(hrs) > 0:
+                effort['avg_hr'] = sum(hrs) / len(hrs)
+                effort['max_hr'] = max(hrs)
+        return effort
+
+    @classmethod
+    def update(cls, db):
+        for segment in db.query_session().query(Segments).all():
+            segment_xy = local_xy(segment.points(), segment.start_lat)
+            checked = set([activity_id for (activity_id,) in db.query_session().query(cls.activity_id).filter(cls.segment_id == segment.id).all()])
+            new_activities = sorted(segment.candidate_activities(db) - checked)
+            session = db.session()
+            for activity_id in new_activities:
+                session.add(cls(**cls.match(db, segment, segment_xy, activity_id)))
+            DB.commit(session)
+            logger.info("Segment %s: matched %d new activities" % (segment.name, len(new_activities)))
+
+    @classmethod
+    def invalidate_segment(cls, db, segment_id):
+        session = db.session()
+        session.query(cls).filter(cls.segment_id == segment_id).delete(synchronize_session=False)
+        DB.commit(session)
+
+    @classmethod
+    def invalidate_activity(cls, db, activity_id):
+        session = db.session()
+        session.query(cls).filter(cls.activity_id == activity_id).delete(synchronize_session=False)
+        DB.commit(session)
+
+    @classmethod
+    def get_efforts(cls, db, segment_id):
+        # (start time, elapsed time, avg hr, max hr) of each effort, fastest first
+        return (
+            db.query_session().query(cls.start_time, cls.elapsed_time, cls.avg_hr, cls.max_hr)
+                .filter(cls.segment_id == segment_id)
+                .filter(cls.elapsed_time != None)
+                .order_by(cls.elapsed_time)
+                .all()
+        )
+
 
 class SportActivities(DBObject):
 
@@ -13,7 +13,7 @@ logger = logging.getLogger(__name__)
 class GarminDB(DB):
     Base = declarative_base()
     db_name = 'garmin'
-    db_version = 1
+    db_version = 2
 
     class DbVersion(Base, DbVersionObject):
         pass
@@ -23,15 +23,127 @@ class GarminDB(DB):
         DB.__init__(self, db_params_dict, debug)
         GarminDB.Base.metadata.create_all(self.engine)
         self.version = SummaryDB.DbVersion()
-        self.version.version_check(self, self.db_version)
+        self.version.version_check(self, self.db_version, {1 : GarminDB.migrate_epoch_timestamps})
         DeviceInfo.create_view(self)
         File.create_view(self)
 
+    def migrate_epoch_timestamps(self):
+        self.convert_to_epoch(Stress.__tablename__, 'timestamp')
+        self.vacuum()
+
 
 class Attributes(GarminDB.Base, KeyValueObject):
     __tablename__ = 'attributes'
 
 
+class ImportCursors(GarminDB.Base, KeyValueObject):
+    __tablename__ = 'import_cursors'
+
+    @classmethod
+    def cursor_key(cls, file_type, input_dir):
+        return file_type + ':' + os.path.abspath(input_dir)
+
+    @classmethod
+    def get_cursor(cls, db, file_type, input_dir):
+        value = cls.get(db, cls.cursor_key(file_type, input_dir))
+        if value is not None:
+            return float(value)
+
+    @classmethod
+    def set_cursor(cls, db, file_type, input_dir, mtime):
+        cls.set(db, cls.cursor_key(file_type, input_dir), repr(mtime), datetime.datetime.now())
+
+    @classmethod
+    def advance_cursor(cls, db, file_type, input_dir, file_mtimes, failed_file_names=[]):
+        # Moves the cursor over the files processed, file_mtimes is [(mtime, file name)]. It stops short of the first
+        # file that failed, so the next import of the latest files retries it.
+        failed_mtimes = [mtime for (mtime, file_name) in file_mtimes if file_name in failed_file_names]
+        mtimes = [mtime for (mtime, file_name) in file_mtimes if len(failed_mtimes) == 0 or mtime < min(failed_mtimes)]
+        if len(mtimes) == 0:
+            return
+        cursor = cls.get_cursor(db, file_type, input_dir)
+        if cursor is None or max(mtimes) > cursor:
+            cls.set_cursor(db, file_type, input_dir, max(mtimes))
+
+    @classmethod
+    def file_key(cls, file_type, file_name):
+        return file_type + '_file:' + os.path.basename(file_name)
+
+    @classmethod
+    def file_applied(cls, db, file_type, file_name):
+        return cls.get(db, cls.file_key(file_type, file_name)) is not None
+
+    @classmethod
+    def set_file_applied(cls, db, file_type, file_name):
+        cls.set(db, cls.file_key(file_type, file_name), 'applied', datetime.datetime.now())
+
+
+class ScrapeState(GarminDB.Base, DBObject):
+    __tablename__ = 'scrape_state'
+
+    day = Column(Date, primary_key=True)
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    checksum = Column(String)
+    timestamp = Column(DateTime)
+
+    status_downloaded = 'downloaded'
+    status_failed = 'failed'
+    # downloaded, but the imported data has a gap on that day
+    status_missing = 'missing'
+    # stop refetching days that keep failing or keep coming back empty
+    max_attempts = 3
+
+    min_row_values = 3
+    _updateable_fields = ['status', 'attempts', 'checksum', 'timestamp']
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.day == values_dict['day'])
+
+    @classmethod
+    def set_status(cls, db, day, status, checksum=None, attempted=True):
+        session = db.session()
+        state = cls._find_one(session, {'day' : day})
+        attempts = 0 if state is None else state.attempts
+        if attempted:
+            attempts += 1
+        values = {
+            'day'       : day,
+            'status'    : status,
+            'attempts'  : attempts,
+            'checksum'  : checksum,
+            'timestamp' : datetime.datetime.now(),
+        }
+        cls._create_or_update(db, session, values, True)
+        DB.commit(session)
+
+    @classmethod
+    def record_download(cls, db, day, checksum):
+        if checksum is not None:
+            cls.set_status(db, day, cls.status_downloaded, checksum)
+        else:
+            cls.set_status(db, day, cls.status_failed)
+
+    @classmethod
+    def mark_missing(cls, db, day):
+        cls.set_status(db, day, cls.status_missing, attempted=False)
+
+    @classmethod
+    def days_to_fetch(cls, db, start_date, end_date):
+        # days in [start_date, end_date) not downloaded yet, plus earlier days that failed or are missing data
+        session = db.query_session()
+        done_days = set([row[0] for row in session.query(cls.day).filter(cls.status == cls.status_downloaded).all()])
+        retry_days = set([
+            row[0] for row in session.query(cls.day)
+                .filter(cls.status != cls.status_downloaded)
+                .filter(cls.attempts < cls.max_attempts)
+                .all()
+        ])
+        days = set([start_date + datetime.timedelta(day) for day in xrange((end_date - start_date).days)]) - done_days
+        return sorted(days | retry_days)
+
+
 class Device(GarminDB.Base, DBObject):
     __tablename__ = 'devices'
     unknown_device_serial_number = 9999999999
@@ -155,7 +267,7 @@ class Weight(GarminDB.Base, DBObject):
 class Stress(GarminDB.Base, DBObject):
     __tablename__ = 'stress'
 
-    timestamp = Column(DateTime, primary_key=True, unique=True)
+    timestamp = Column(EpochDateTime, primary_key=True, unique=True)
     stress = Column(Integer, nullable=False)
 
     time_col = synonym("timestamp")
@@ -124,6 +124,16 @@ class SleepEvents(GarminSummaryDB.Base, DBObject):
         if len(values) > 0:
             return values[0][0]
 
+    @classmethod
+    def get_wake_times(cls, db, first_day_date, last_day_date):
+        # {day : wake time} for the days that have one
+        start_ts = datetime.datetime.combine(first_day_date, datetime.time.min)
+        end_ts = datetime.datetime.combine(last_day_date + datetime.timedelta(1), datetime.time.min)
+        wake_times = {}
+        for (timestamp,) in db.query_session().query(cls.timestamp).filter(cls.event == 'wake_time').filter(cls.timestamp >= start_ts).filter(cls.timestamp < end_ts).order_by(cls.timestamp).all():
+            wake_times.setdefault(timestamp.date(), timestamp)
+        return wake_times
+
 
 class Sleep(GarminSummaryDB.Base, DBObject):
     __tablename__ = 'sleep'
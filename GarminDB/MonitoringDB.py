@@ -4,6 +4,10 @@
 # copyright Tom Goetz
 #
 
+import re, stat
+
+from sqlalchemy import event
+
 from HealthDB import *
 from Fit import Conversions
 
@@ -14,17 +18,288 @@ logger = logging.getLogger(__name__)
 class MonitoringDB(DB):
     Base = declarative_base()
     db_name = 'garmin_monitoring'
-    db_version = 2
+    db_version = 4
 
     class DbVersion(Base, DbVersionObject):
         pass
 
+    #
+    # With sqlite the per interval tables can be split into one DB file per year (garmin_monitoring_2018.db ...).
+    # Writes go to the year's partition, reads go through temp views over the attached partitions that shadow the
+    # empty tables in the main DB. Partitioning is turned on with 'partition_by_year' in the DB params, and stays on
+    # once partition files exist. Rows already in the main DB's tables when it's turned on are moved to the partitions.
+    #
+    partition_file_regex = re.compile(db_name + r'_(\d{4})\.db$')
+    #
+    # SQLite attaches at most 10 DBs by default. Past that many years the oldest ones are merged into one archive
+    # partition (garmin_monitoring_archive.db) holding every year before the oldest year partition.
+    #
+    max_attached_partitions = 10
+    archive_partition = 'archive'
+
     def __init__(self, db_params_dict, debug=False):
         logger.info("MonitoringDB: %s debug: %s " % (repr(db_params_dict), str(debug)))
         DB.__init__(self, db_params_dict, debug)
         MonitoringDB.Base.metadata.create_all(self.engine)
+        self.db_params_dict = db_params_dict
+        self.debug = debug
+        self.partition_dbs = {}
+        self.year_partitions = {}
+        self.rollups_converted = False
         self.version = SummaryDB.DbVersion()
-        self.version.version_check(self, self.db_version)
+        migrations = {
+            2 : MonitoringDB.migrate_counter_deltas,
+            3 : MonitoringDB.migrate_epoch_timestamps
+        }
+        self.version.version_check(self, self.db_version, migrations)
+        self.partitioned = db_params_dict['db_type'] == 'sqlite' and (db_params_dict.get('partition_by_year', False) or len(self.partition_keys()) > 0)
+        if self.partitioned:
+            self.move_to_partitions()
+            self.merge_old_partitions()
+            event.listen(self.engine, 'connect', self.attach_partitions)
+            # drops any connection a migration opened before the partitions were attached
+            self.reattach_partitions()
+        if self.rollups_converted:
+            # the rollup reads the monitoring data through the partition views, so it waits until they're attached
+            self.rollup_raw_data()
+
+    @classmethod
+    def partitioned_tables(cls):
+        return [Monitoring.__table__, MonitoringHeartRate.__table__, MonitoringIntensity.__table__, MonitoringClimb.__table__]
+
+    def migration_dbs(self):
+        # migrations run before the partitions are attached, so the main DB's tables aren't shadowed by the views
+        dbs = [self]
+        for partition_key in self.partition_keys():
+            if partition_key not in self.partition_dbs:
+                self.partition_dbs[partition_key] = MonitoringPartitionDB(self, partition_key)
+            dbs.append(self.partition_dbs[partition_key])
+        return dbs
+
+    def migrate_counter_deltas(self):
+        # Version 3 added the counter delta columns and changed monitoring_hourly to sum them. The deltas are
+        # computed from the timestamps as epoch seconds, so the version 4 conversion is done here first.
+        for db in self.migration_dbs():
+            for table_class in [Monitoring, MonitoringClimb]:
+                for col_name in table_class.counter_cols:
+                    db.add_column(table_class.__table__, col_name + '_delta')
+                db.convert_to_epoch(table_class.__tablename__, 'timestamp')
+                start_ts = table_class.get_col_min(db, table_class.timestamp)
+                if start_ts is not None:
+                    table_class.update_deltas(db, start_ts, table_class.get_col_max(db, table_class.timestamp))
+        self.convert_hourly_rollups()
+
+    def convert_hourly_rollups(self):
+        # Version 2 monitoring_hourly held each hour's largest running total of steps and cum_ascent, version 3 holds
+        # the hour's steps and ascent. The rows are converted in place since retention may have removed the raw data
+        # they came from.
+        col_names = [row[1] for row in self.engine.execute('PRAGMA table_info(%s)' % MonitoringHourly.__tablename__)]
+        if 'cum_ascent' not in col_names:
+            # DBs from before the hourly rollups got the version 3 table from create_all()
+            self.rollups_converted = True
+            return
+        query_str = 'SELECT timestamp, steps, moderate_activity_secs, vigorous_activity_secs, cum_ascent FROM %s ORDER BY timestamp'
+        rows = self.engine.execute(query_str % MonitoringHourly.__tablename__).fetchall()
+        timestamps = [db_datetime(row[0]) for row in rows]
+        keys = [None] * len(rows)
+        steps = CounterDeltas.counter_deltas(timestamps, keys, [row[1] for row in rows])
+        ascents = CounterDeltas.counter_deltas(timestamps, keys, [row[4] for row in rows])
+        MonitoringHourly.__table__.drop(self.engine)
+        MonitoringHourly.__table__.create(self.engine)
+        if len(rows) > 0:
+            values = [
+                {'timestamp' : timestamp, 'steps' : hour_steps, 'moderate_activity_secs' : row[2], 'vigorous_activity_secs' : row[3], 'ascent' : ascent}
+                for timestamp, row, hour_steps, ascent in zip(timestamps, rows, steps, ascents)
+            ]
+            self.engine.execute(MonitoringHourly.__table__.insert(), values)
+            DB.note_write(MonitoringHourly.__tablename__)
+        self.rollups_converted = True
+
+    def rollup_raw_data(self):
+        # the converted rollups are approximate, recompute the hours that still have raw data
+        start_timestamps = [table.get_col_min(self, table.timestamp) for table in [Monitoring, MonitoringIntensity, MonitoringClimb]]
+        start_timestamps = [timestamp for timestamp in start_timestamps if timestamp is not None]
+        if len(start_timestamps) > 0:
+            end_ts = max([table.latest_time(self) for table in [Monitoring, MonitoringIntensity, MonitoringClimb]])
+            MonitoringHourly.rollup(self, min(start_timestamps), end_ts)
+
+    def migrate_epoch_timestamps(self):
+        for db in self.migration_dbs():
+            for table in self.partitioned_tables():
+                db.convert_to_epoch(table.name, 'timestamp')
+            db.vacuum()
+
+    def partition_path(self, partition_key):
+        return self.db_params_dict['db_path'] + '/' + self.db_name + '_' + str(partition_key) + '.db'
+
+    def partition_years(self):
+        if self.db_params_dict['db_type'] != 'sqlite':
+            return []
+        years = []
+        for filename in os.listdir(self.db_params_dict['db_path']):
+            match = self.partition_file_regex.match(filename)
+            if match:
+                years.append(int(match.group(1)))
+        return sorted(years)
+
+    def has_archive_partition(self):
+        return self.db_params_dict['db_type'] == 'sqlite' and os.path.exists(self.partition_path(self.archive_partition))
+
+    def partition_keys(self):
+        # the partitions that exist, oldest first
+        keys = self.partition_years()
+        if self.has_archive_partition():
+            keys.insert(0, self.archive_partition)
+        return keys
+
+    def partition_schema(self, partition_key):
+        return 'partition_' + str(partition_key)
+
+    def partition_key(self, year):
+        # the archive partition holds all of the years before the oldest year partition
+        years = self.partition_years()
+        if self.has_archive_partition() and len(years) > 0 and year < years[0]:
+            return self.archive_partition
+        return year
+
+    def attach_partitions(self, dbapi_connection, connection_record):
+        keys = self.partition_keys()
+        if len(keys) == 0:
+            return
+        if len(keys) > self.max_attached_partitions:
+            raise RuntimeError("DB %s has %d partitions, more than the %d SQLite can attach. Please run import_garmin.py to merge the oldest ones."
+                % (self.db_name, len(keys), self.max_attached_partitions))
+        cursor = dbapi_connection.cursor()
+        for key in keys:
+            cursor.execute("ATTACH DATABASE ? AS %s" % self.partition_schema(key), (self.partition_path(key),))
+        for table in self.partitioned_tables():
+            # partitions migrated with ALTER TABLE have their columns in a different order, so name them
+            col_names = ', '.join([column.name for column in table.columns])
+            selects = ['SELECT %s FROM %s.%s' % (col_names, self.partition_schema(key), table.name) for key in keys]
+            cursor.execute('CREATE TEMP VIEW IF NOT EXISTS %s AS %s' % (table.name, ' UNION ALL '.join(selects)))
+        cursor.close()
+
+    def table_watermark(self, table_name):
+        if not self.partitioned or table_name not in [table.name for table in self.partitioned_tables()]:
+            return DB.table_watermark(self, table_name)
+        # the table is a view over the partitions, use the partitions' rowids
+        try:
+            max_rowids = tuple([
+                self.query_session().execute('SELECT max(rowid) FROM %s.%s' % (self.partition_schema(key), table_name)).scalar()
+                for key in self.partition_keys()
+            ])
+        except OperationalError:
+            # a partition another process created that isn't attached here yet
+            return None
+        return (DB.table_generations.get(table_name, 0), max_rowids)
+
+    def reattach_partitions(self):
+        # new connections pick up the current set of partitions
+        self._query_session = None
+        self.engine.dispose()
+
+    def partition(self, timestamp):
+        if not self.partitioned or timestamp is None:
+            return self
+        year = timestamp.year
+        if year not in self.year_partitions:
+            self.year_partitions[year] = self.partition_key(year)
+        return self.partition_db(self.year_partitions[year])
+
+    def partition_db(self, partition_key):
+        if partition_key not in self.partition_dbs:
+            new_partition = not os.path.exists(self.partition_path(partition_key))
+            self.partition_dbs[partition_key] = MonitoringPartitionDB(self, partition_key)
+            if new_partition:
+                self.merge_old_partitions()
+                self.reattach_partitions()
+        return self.partition_dbs[partition_key]
+
+    def move_to_partitions(self):
+        # rows imported before partitioning was turned on would be hidden by the views, move them to their partitions
+        years = set()
+        for table in self.partitioned_tables():
+            query_str = "SELECT DISTINCT CAST(strftime('%%Y', timestamp, 'unixepoch') AS INTEGER) FROM %s" % table.name
+            years.update([row[0] for row in self.engine.execute(query_str)])
+        if len(years) == 0:
+            return
+        main_path = self.db_params_dict['db_path'] + '/' + self.db_name + '.db'
+        for year in sorted(years):
+            logger.info("Moving %d monitoring data to its partition" % year)
+            params = (EpochDateTime.to_epoch(datetime.datetime(year, 1, 1)), EpochDateTime.to_epoch(datetime.datetime(year + 1, 1, 1)))
+            self.partition_db(self.partition_key(year)).copy_rows(main_path, 'timestamp >= ? AND timestamp < ?', params)
+        for table in self.partitioned_tables():
+            self.engine.execute('DELETE FROM %s' % table.name)
+            DB.note_write(table.name)
+        self.year_partitions = {}
+        self.vacuum()
+
+    def merge_old_partitions(self):
+        # SQLite can only attach a limited number of DBs, keep the partition count under it by merging the oldest years
+        years = self.partition_years()
+        if len(years) + int(self.has_archive_partition()) <= self.max_attached_partitions:
+            return
+        if self.archive_partition not in self.partition_dbs:
+            self.partition_dbs[self.archive_partition] = MonitoringPartitionDB(self, self.archive_partition)
+        archive_db = self.partition_dbs[self.archive_partition]
+        for year in years[:len(years) - (self.max_attached_partitions - 1)]:
+            logger.info("Merging monitoring partition %d into the archive partition" % year)
+            partition_db = self.partition_dbs.pop(year, None)
+            if partition_db is not None:
+                partition_db.engine.dispose()
+            archive_db.copy_rows(self.partition_path(year))
+            os.remove(self.partition_path(year))
+        self.year_partitions = {}
+        self.reattach_partitions()
+
+    def close_partitions(self):
+        # the archive and years before this one aren't written to anymore, compact them and make them read only
+        current_year = datetime.datetime.now().year
+        for partition_key in self.partition_keys():
+            path = self.partition_path(partition_key)
+            if (partition_key == self.archive_partition or partition_key < current_year) and os.access(path, os.W_OK):
+                logger.info("Closing monitoring partition " + path)
+                partition_db = self.partition_dbs.pop(partition_key, None) or MonitoringPartitionDB(self, partition_key)
+                partition_db.vacuum()
+                partition_db.engine.dispose()
+                os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+class MonitoringPartitionDB(DB):
+
+    def __init__(self, parent_db, partition_key):
+        self.parent_db = parent_db
+        self.db_name = parent_db.db_name + '_' + str(partition_key)
+        path = parent_db.partition_path(partition_key)
+        # a closed partition is reopened for writing when late data for its years arrives
+        if os.path.exists(path) and not os.access(path, os.W_OK):
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        DB.__init__(self, parent_db.db_params_dict, parent_db.debug)
+        MonitoringDB.Base.metadata.create_all(self.engine, tables=MonitoringDB.partitioned_tables())
+
+    def copy_rows(self, source_path, where=None, params=()):
+        # Copies the partitioned tables' rows from another DB file. The ids are left to this DB, rows already here
+        # are kept.
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("ATTACH DATABASE ? AS source", (source_path,))
+            for table in MonitoringDB.partitioned_tables():
+                col_names = ', '.join([column.name for column in table.columns if column.name != 'id'])
+                query_str = 'INSERT OR IGNORE INTO main.%s (%s) SELECT %s FROM source.%s' % (table.name, col_names, col_names, table.name)
+                if where is not None:
+                    query_str += ' WHERE ' + where
+                cursor.execute(query_str, params)
+            connection.commit()
+            cursor.execute("DETACH DATABASE source")
+            cursor.close()
+        finally:
+            connection.close()
+        for table in MonitoringDB.partitioned_tables():
+            DB.note_write(table.name)
+
+    def sqlite_url(self, db_params_dict):
+        return "sqlite:///" + db_params_dict['db_path'] +  '/' + self.db_name + '.db'
 
 
 class ActivityType(MonitoringDB.Base, DBObject):
@@ -41,6 +316,9 @@ class ActivityType(MonitoringDB.Base, DBObject):
 
     @classmethod
     def get_id(cls, db, name):
+        # partitions share the activity types in the main DB
+        if isinstance(db, MonitoringPartitionDB):
+            db = db.parent_db
         return cls.find_or_create_id(db, {'name' : name})
 
 
@@ -97,7 +375,7 @@ class MonitoringInfo(MonitoringDB.Base, DBObject):
 class MonitoringHeartRate(MonitoringDB.Base, DBObject):
     __tablename__ = 'monitoring_hr'
 
-    timestamp = Column(DateTime, primary_key=True)
+    timestamp = Column(EpochDateTime, primary_key=True)
     heart_rate = Column(Integer, nullable=False)
 
     __table_args__ = (
@@ -106,10 +384,7 @@ class MonitoringHeartRate(MonitoringDB.Base, DBObject):
 
     time_col = synonym("timestamp")
     min_row_values = 2
-
-    @classmethod
-    def _find_query(cls, session, values_dict):
-        return session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
+    natural_key = ('timestamp',)
 
     @classmethod
     def get_stats(cls, db, start_ts, end_ts):
@@ -118,6 +393,10 @@ class MonitoringHeartRate(MonitoringDB.Base, DBObject):
             'hr_min' : cls.get_col_min(db, cls.heart_rate, start_ts, end_ts, True),
             'hr_max' : cls.get_col_max(db, cls.heart_rate, start_ts, end_ts),
         }
+        # merge in whatever part of the range has been downsampled by the retention policy
+        if MonitoringHeartRateDownsampled.row_count_range(db, start_ts, end_ts) > 0:
+            samples = cls.get_col_func(db, cls.heart_rate, func.count, start_ts, end_ts, True)
+            stats = MonitoringHeartRateDownsampled.merge_stats(db, stats, samples, start_ts, end_ts)
         return stats
 
     @classmethod
@@ -141,13 +420,30 @@ class MonitoringHeartRate(MonitoringDB.Base, DBObject):
     @classmethod
     def get_resting_heartrate(cls, db, wake_ts):
         start_ts = wake_ts - datetime.timedelta(0, 0, 0, 0, 10)
-        return cls.get_col_min(db, cls.heart_rate, start_ts, wake_ts, True)
+        rhr = cls.get_col_min(db, cls.heart_rate, start_ts, wake_ts, True)
+        if rhr is None:
+            # include the sample period that holds start_ts
+            rhr = MonitoringHeartRateDownsampled.get_col_min(db, MonitoringHeartRateDownsampled.heart_rate_min,
+                start_ts - datetime.timedelta(0, MonitoringHeartRateDownsampled.sample_secs - 1), wake_ts, True)
+        return rhr
+
+    @classmethod
+    def get_resting_heartrates(cls, db, wake_times):
+        # get_resting_heartrate for many days at once, wake_times is {day : wake timestamp}
+        window = datetime.timedelta(0, 0, 0, 0, 10)
+        windows = {day : (wake_ts - window, wake_ts) for day, wake_ts in wake_times.iteritems()}
+        rhrs = db.get_windows_func(cls, 'heart_rate', 'min', windows, ignore_le_zero=True)
+        downsampled_window = window + datetime.timedelta(0, MonitoringHeartRateDownsampled.sample_secs - 1)
+        downsampled_windows = {day : (wake_ts - downsampled_window, wake_ts) for day, wake_ts in wake_times.iteritems() if rhrs.get(day) is None}
+        if len(downsampled_windows) > 0:
+            rhrs.update(db.get_windows_func(MonitoringHeartRateDownsampled, 'heart_rate_min', 'min', downsampled_windows, ignore_le_zero=True))
+        return rhrs
 
 
 class MonitoringIntensity(MonitoringDB.Base, DBObject):
     __tablename__ = 'monitoring_intensity'
 
-    timestamp = Column(DateTime, primary_key=True)
+    timestamp = Column(EpochDateTime, primary_key=True)
     moderate_activity_time = Column(Time)
     vigorous_activity_time = Column(Time)
 
@@ -157,10 +453,7 @@ class MonitoringIntensity(MonitoringDB.Base, DBObject):
 
     time_col = synonym("timestamp")
     min_row_values = 2
-
-    @classmethod
-    def _find_query(cls, session, values_dict):
-        return  session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
+    natural_key = ('timestamp',)
 
     @classmethod
     def get_stats(cls, db, start_ts, end_ts):
@@ -197,19 +490,75 @@ class MonitoringIntensity(MonitoringDB.Base, DBObject):
         return stats
 
 
-class MonitoringClimb(MonitoringDB.Base, DBObject):
+#
+# Some monitoring columns are running totals kept by the device, separately per activity type for the monitoring
+# table, that reset at midnight or when the device resets. Each is paired with a <column>_delta column holding the
+# change since the previous sample, so the total for any range is a plain SUM. Since the totals reset daily, deltas
+# are recomputed for whole days from that day's rows.
+#
+class CounterDeltas():
+    # {counter column : converter to a number}
+    counter_cols = {}
+    # counters are kept separately for each value of this column
+    counter_key_col = None
+
+    @classmethod
+    def counter_deltas(cls, timestamps, keys, values):
+        deltas = []
+        previous = {}
+        for timestamp, key, value in zip(timestamps, keys, values):
+            if value is None:
+                deltas.append(None)
+                continue
+            (prev_day, prev_value) = previous.get(key, (None, None))
+            if prev_day != timestamp.date() or value < prev_value:
+                # the first sample of the day or after a reset counts from zero
+                deltas.append(value)
+            else:
+                deltas.append(value - prev_value)
+            previous[key] = (timestamp.date(), value)
+        return deltas
+
+    @classmethod
+    def update_deltas(cls, db, start_ts, end_ts):
+        day_start_ts = datetime.datetime.combine(start_ts.date(), datetime.time.min)
+        day_end_ts = datetime.datetime.combine(end_ts.date(), datetime.time.min) + datetime.timedelta(1)
+        logger.debug("%s::update_deltas %s to %s" % (cls.__name__, str(day_start_ts), str(day_end_ts)))
+        col_names = ['id', 'timestamp'] + cls.counter_cols.keys()
+        if cls.counter_key_col is not None:
+            col_names.append(cls.counter_key_col)
+        columns = db.get_columns(cls, col_names, 'timestamp', day_start_ts, day_end_ts, converters=cls.counter_cols)
+        if len(columns['id']) == 0:
+            return
+        if cls.counter_key_col is not None:
+            keys = columns[cls.counter_key_col]
+        else:
+            keys = [None] * len(columns['id'])
+        rows = [{'id' : id} for id in columns['id']]
+        for col_name in cls.counter_cols:
+            for row, delta in zip(rows, cls.counter_deltas(columns['timestamp'], keys, columns[col_name])):
+                row[col_name + '_delta'] = delta
+        set_str = ', '.join(['%s_delta = :%s_delta' % (col_name, col_name) for col_name in cls.counter_cols])
+        with db.engine.begin() as connection:
+            connection.execute(text('UPDATE %s SET %s WHERE id = :id' % (cls.__tablename__, set_str)), rows)
+        DB.note_write(cls.__tablename__)
+
+
+class MonitoringClimb(MonitoringDB.Base, DBObject, CounterDeltas):
     __tablename__ = 'monitoring_climb'
 
     feet_to_floors = 10
     meters_to_floors = 3
 
     id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(EpochDateTime, nullable=False)
     # meters or feet
     ascent = Column(Float)
     descent = Column(Float)
     cum_ascent = Column(Float)
     cum_descent = Column(Float)
+    cum_ascent_delta = Column(Float)
+    cum_descent_delta = Column(Float)
 
     __table_args__ = (
         UniqueConstraint("timestamp", "ascent", "descent", "cum_ascent", "cum_descent"),
@@ -217,47 +566,45 @@ class MonitoringClimb(MonitoringDB.Base, DBObject):
 
     time_col = synonym("timestamp")
     min_row_values = 2
+    natural_key = ('timestamp', 'ascent', 'descent', 'cum_ascent', 'cum_descent')
+    counter_cols = {'cum_ascent' : None, 'cum_descent' : None}
 
     @classmethod
-    def _find_query(cls, session, values_dict):
-        return  session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
-
-    @classmethod
-    def get_stats(cls, db, func, start_ts, end_ts, english_units=False):
-        cum_ascent = func(db, cls.cum_ascent, start_ts, end_ts)
-        if cum_ascent:
+    def get_stats(cls, db, start_ts, end_ts, english_units=False):
+        ascent = cls.get_col_sum(db, cls.cum_ascent_delta, start_ts, end_ts)
+        if ascent:
             if english_units:
-                floors = cum_ascent / cls.feet_to_floors
+                floors = ascent / cls.feet_to_floors
             else:
-                floors = cum_ascent / cls.meters_to_floors
+                floors = ascent / cls.meters_to_floors
         else:
             floors = 0
         return { 'floors' : floors }
 
     @classmethod
     def get_daily_stats(cls, db, day_ts, english_units=False):
-        stats = cls.get_stats(db, cls.get_col_max, day_ts, day_ts + datetime.timedelta(1), english_units)
+        stats = cls.get_stats(db, day_ts, day_ts + datetime.timedelta(1), english_units)
         stats['day'] = day_ts
         return stats
 
     @classmethod
     def get_weekly_stats(cls, db, first_day_ts, english_units=False):
-        stats = cls.get_stats(db, cls.get_col_sum_of_max_per_day, first_day_ts, first_day_ts + datetime.timedelta(7), english_units)
+        stats = cls.get_stats(db, first_day_ts, first_day_ts + datetime.timedelta(7), english_units)
         stats['first_day'] = first_day_ts
         return stats
 
     @classmethod
     def get_monthly_stats(cls, db, first_day_ts, last_day_ts, english_units=False):
-        stats = cls.get_stats(db, cls.get_col_sum_of_max_per_day, first_day_ts, last_day_ts, english_units)
+        stats = cls.get_stats(db, first_day_ts, last_day_ts, english_units)
         stats['first_day'] = first_day_ts
         return stats
 
 
-class Monitoring(MonitoringDB.Base, DBObject):
+class Monitoring(MonitoringDB.Base, DBObject, CounterDeltas):
     __tablename__ = 'monitoring'
 
     id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(EpochDateTime, nullable=False)
     activity_type_id = Column(Integer, ForeignKey('activity_type.id'))
 
     intensity = Column(Integer)
@@ -271,6 +618,11 @@ class Monitoring(MonitoringDB.Base, DBObject):
     strokes = Column(Integer)
     cycles = Column(Float)
 
+    steps_delta = Column(Integer)
+    active_calories_delta = Column(Integer)
+    # seconds
+    cum_active_time_delta = Column(Float)
+
     __table_args__ = (
         UniqueConstraint("timestamp", "activity_type_id", "intensity", "duration"),
     )
@@ -280,10 +632,9 @@ class Monitoring(MonitoringDB.Base, DBObject):
         'activity_type' : ('activity_type_id', ActivityType.get_id)
     }
     min_row_values = 2
-
-    @classmethod
-    def _find_query(cls, session, values_dict):
-        return session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
+    natural_key = ('timestamp', 'activity_type_id', 'intensity', 'duration')
+    counter_cols = {'steps' : None, 'active_calories' : None, 'cum_active_time' : db_time_secs}
+    counter_key_col = 'activity_type_id'
 
     @classmethod
     def get_activity(cls, db, start_ts, end_ts):
@@ -297,27 +648,27 @@ class Monitoring(MonitoringDB.Base, DBObject):
         return 0
 
     @classmethod
-    def get_stats(cls, db, func, start_ts, end_ts):
+    def get_stats(cls, db, start_ts, end_ts):
         return {
-            'steps'                 : func(db, cls.steps, start_ts, end_ts),
+            'steps'                 : cls.get_col_sum(db, cls.steps_delta, start_ts, end_ts),
             'calories_active_avg'   : cls.get_active_calories(db, 0, start_ts, end_ts) + cls.get_active_calories(db, 1, start_ts, end_ts)
         }
 
     @classmethod
     def get_daily_stats(cls, db, day_ts):
-        stats = cls.get_stats(db, cls.get_col_max, day_ts, day_ts + datetime.timedelta(1))
+        stats = cls.get_stats(db, day_ts, day_ts + datetime.timedelta(1))
         stats['day'] = day_ts
         return stats
 
     @classmethod
     def get_weekly_stats(cls, db, first_day_ts):
-        stats = cls.get_stats(db, cls.get_col_sum_of_max_per_day, first_day_ts, first_day_ts + datetime.timedelta(7))
+        stats = cls.get_stats(db, first_day_ts, first_day_ts + datetime.timedelta(7))
         stats['first_day'] = first_day_ts
         return stats
 
     @classmethod
     def get_monthly_stats(cls, db, first_day_ts, last_day_ts):
-        stats = cls.get_stats(db, cls.get_col_sum_of_max_per_day, first_day_ts, last_day_ts)
+        stats = cls.get_stats(db, first_day_ts, last_day_ts)
         stats['first_day'] = first_day_ts
         return stats
 
@@ -325,3 +676,286 @@ class Monitoring(MonitoringDB.Base, DBObject):
     def get_inactive(cls, db, func, start_ts, end_ts):
         return session.query(cls).filter(cls.intensity == 0)
 
+
+
+#
+# Hourly rollups of the monitoring tables, maintained at import time, so summaries read a row per hour instead of
+# a row per monitoring interval. Steps and ascent are the sums of the per sample deltas, the amounts for the hour.
+#
+class MonitoringHourly(MonitoringDB.Base, DBObject):
+    __tablename__ = 'monitoring_hourly'
+
+    timestamp = Column(DateTime, primary_key=True)
+    steps = Column(Integer)
+    moderate_activity_secs = Column(Integer)
+    vigorous_activity_secs = Column(Integer)
+    # meters or feet
+    ascent = Column(Float)
+
+    time_col = synonym("timestamp")
+    min_row_values = 2
+    _updateable_fields = ['steps', 'moderate_activity_secs', 'vigorous_activity_secs', 'ascent']
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
+
+    @classmethod
+    def hour_start(cls, ts):
+        return ts.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def hour_col(cls, col):
+        return func.strftime('%Y-%m-%d %H:00:00', cls.sql_datetime(col))
+
+    @classmethod
+    def hour_from_col(cls, hour_str):
+        return datetime.datetime.strptime(hour_str, '%Y-%m-%d %H:%M:%S')
+
+    @classmethod
+    def get_hourly(cls, session, table, stat, start_ts, end_ts):
+        hour = cls.hour_col(table.timestamp)
+        return session.query(hour, stat).filter(table.timestamp >= start_ts).filter(table.timestamp < end_ts).group_by(hour).all()
+
+    @classmethod
+    def time_col_secs(cls, col):
+        return func.strftime('%s', col) - func.strftime('%s', '00:00')
+
+    @classmethod
+    def rollup(cls, db, start_ts, end_ts):
+        # always recompute whole hours, an import can end part way through one
+        start_ts = cls.hour_start(start_ts)
+        end_ts = cls.hour_start(end_ts) + datetime.timedelta(0, 3600)
+        logger.info("Rolling up monitoring data from %s to %s" % (str(start_ts), str(end_ts)))
+        session = db.session()
+        hours = {}
+        hourly_stats = [
+            ('steps',                   Monitoring,             func.sum(Monitoring.steps_delta)),
+            ('moderate_activity_secs',  MonitoringIntensity,    func.sum(cls.time_col_secs(MonitoringIntensity.moderate_activity_time))),
+            ('vigorous_activity_secs',  MonitoringIntensity,    func.sum(cls.time_col_secs(MonitoringIntensity.vigorous_activity_time))),
+            ('ascent',                  MonitoringClimb,        func.sum(MonitoringClimb.cum_ascent_delta)),
+        ]
+        for (col_name, table, hourly_stat) in hourly_stats:
+            for (hour_str, value) in cls.get_hourly(session, table, hourly_stat, start_ts, end_ts):
+                hour = cls.hour_from_col(hour_str)
+                hours.setdefault(hour, {'timestamp' : hour})[col_name] = value
+        for values in hours.itervalues():
+            cls._create_or_update(db, session, values, True)
+        MonitoringHourlyCalories.rollup(db, session, start_ts, end_ts)
+        DB.commit(session)
+
+    @classmethod
+    def rollup_missing(cls, db):
+        # catch up DBs with monitoring data imported before the rollups existed
+        latest_ts = Monitoring.latest_time(db)
+        if latest_ts is None:
+            return
+        rolled_up_ts = cls.latest_time(db)
+        if rolled_up_ts is None:
+            cls.rollup(db, Monitoring.get_col_min(db, Monitoring.timestamp), latest_ts)
+        elif rolled_up_ts < cls.hour_start(latest_ts):
+            cls.rollup(db, rolled_up_ts, latest_ts)
+
+    @classmethod
+    def get_stats(cls, db, start_ts, end_ts, english_units=False):
+        moderate_activity_secs = cls.get_col_sum(db, cls.moderate_activity_secs, start_ts, end_ts)
+        vigorous_activity_secs = cls.get_col_sum(db, cls.vigorous_activity_secs, start_ts, end_ts)
+        intensity_time = datetime.time.min
+        moderate_activity_time = None
+        vigorous_activity_time = None
+        if moderate_activity_secs:
+            moderate_activity_time = Conversions.secs_to_dt_time(moderate_activity_secs)
+            intensity_time = Conversions.add_time(intensity_time, moderate_activity_time)
+        if vigorous_activity_secs:
+            vigorous_activity_time = Conversions.secs_to_dt_time(vigorous_activity_secs)
+            intensity_time = Conversions.add_time(intensity_time, vigorous_activity_time, 2)
+        ascent = cls.get_col_sum(db, cls.ascent, start_ts, end_ts)
+        if ascent:
+            if english_units:
+                floors = ascent / MonitoringClimb.feet_to_floors
+            else:
+                floors = ascent / MonitoringClimb.meters_to_floors
+        else:
+            floors = 0
+        return {
+            'steps'                     : cls.get_col_sum(db, cls.steps, start_ts, end_ts),
+            'calories_active_avg'       : MonitoringHourlyCalories.get_active_calories(db, 0, start_ts, end_ts) + MonitoringHourlyCalories.get_active_calories(db, 1, start_ts, end_ts),
+            'intensity_time'            : intensity_time,
+            'moderate_activity_time'    : moderate_activity_time,
+            'vigorous_activity_time'    : vigorous_activity_time,
+            'floors'                    : floors,
+        }
+
+    @classmethod
+    def get_daily_stats(cls, db, day_ts, english_units=False):
+        stats = cls.get_stats(db, day_ts, day_ts + datetime.timedelta(1), english_units)
+        stats['day'] = day_ts
+        return stats
+
+    @classmethod
+    def get_weekly_stats(cls, db, first_day_ts, english_units=False):
+        stats = cls.get_stats(db, first_day_ts, first_day_ts + datetime.timedelta(7), english_units)
+        stats['first_day'] = first_day_ts
+        return stats
+
+    @classmethod
+    def get_monthly_stats(cls, db, first_day_ts, last_day_ts, english_units=False):
+        stats = cls.get_stats(db, first_day_ts, last_day_ts, english_units)
+        stats['first_day'] = first_day_ts
+        return stats
+
+
+class MonitoringHourlyCalories(MonitoringDB.Base, DBObject):
+    __tablename__ = 'monitoring_hourly_calories'
+
+    timestamp = Column(DateTime, primary_key=True)
+    activity_type_id = Column(Integer, ForeignKey('activity_type.id'), primary_key=True)
+    # a daily running total, so the largest seen in the hour
+    active_calories = Column(Integer)
+
+    time_col = synonym("timestamp")
+    min_row_values = 3
+    _updateable_fields = ['active_calories']
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.timestamp == values_dict['timestamp']).filter(cls.activity_type_id == values_dict['activity_type_id'])
+
+    @classmethod
+    def rollup(cls, db, session, start_ts, end_ts):
+        hour = MonitoringHourly.hour_col(Monitoring.timestamp)
+        rows = (
+            session.query(hour, Monitoring.activity_type_id, func.max(Monitoring.active_calories))
+                .filter(Monitoring.timestamp >= start_ts)
+                .filter(Monitoring.timestamp < end_ts)
+                .filter(Monitoring.activity_type_id != None)
+                .filter(Monitoring.active_calories != None)
+                .group_by(hour, Monitoring.activity_type_id)
+                .all()
+        )
+        for (hour_str, activity_type_id, active_calories) in rows:
+            values = {
+                'timestamp'         : MonitoringHourly.hour_from_col(hour_str),
+                'activity_type_id'  : activity_type_id,
+                'active_calories'   : active_calories,
+            }
+            cls._create_or_update(db, session, values, True)
+
+    @classmethod
+    def get_active_calories(cls, db, activity_type_id, start_ts, end_ts):
+        active_calories = cls.get_col_avg_of_max_per_day_for_value(db, cls.active_calories, cls.activity_type_id, activity_type_id, start_ts, end_ts)
+        if active_calories is not None:
+            return active_calories
+        return 0
+
+
+#
+# What's left of monitoring_hr once the retention policy has removed the raw rows: min, avg and max per sample period.
+#
+class MonitoringHeartRateDownsampled(MonitoringDB.Base, DBObject):
+    __tablename__ = 'monitoring_hr_downsampled'
+
+    sample_secs = 5 * 60
+
+    timestamp = Column(DateTime, primary_key=True)
+    heart_rate_min = Column(Integer)
+    heart_rate_avg = Column(Float)
+    heart_rate_max = Column(Integer)
+    samples = Column(Integer)
+
+    time_col = synonym("timestamp")
+    min_row_values = 2
+    _updateable_fields = ['heart_rate_min', 'heart_rate_avg', 'heart_rate_max', 'samples']
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.timestamp == values_dict['timestamp'])
+
+    @classmethod
+    def row_count_range(cls, db, start_ts, end_ts):
+        return db.query_session().query(cls).filter(cls.timestamp >= start_ts).filter(cls.timestamp < end_ts).count()
+
+    @classmethod
+    def downsample(cls, db, start_ts, end_ts):
+        source = MonitoringHeartRate
+        period = func.datetime((source.timestamp / cls.sample_secs) * cls.sample_secs, 'unixepoch')
+        session = db.session()
+        rows = (
+            session.query(period, func.min(source.heart_rate), func.avg(source.heart_rate), func.max(source.heart_rate), func.count(source.heart_rate))
+                .filter(source.timestamp >= start_ts)
+                .filter(source.timestamp < end_ts)
+                .filter(source.heart_rate > 0)
+                .group_by(period)
+                .all()
+        )
+        for (period_str, hr_min, hr_avg, hr_max, samples) in rows:
+            values = {
+                'timestamp'         : datetime.datetime.strptime(period_str, '%Y-%m-%d %H:%M:%S'),
+                'heart_rate_min'    : hr_min,
+                'heart_rate_avg'    : hr_avg,
+                'heart_rate_max'    : hr_max,
+                'samples'           : samples,
+            }
+            cls._create_or_update(db, session, values, True)
+        DB.commit(session)
+
+    @classmethod
+    def merge_stats(cls, db, stats, samples, start_ts, end_ts):
+        query = (
+            db.query_session().query(func.sum(cls.heart_rate_avg * cls.samples), func.sum(cls.samples), func.min(cls.heart_rate_min), func.max(cls.heart_rate_max))
+                .filter(cls.timestamp >= start_ts)
+                .filter(cls.timestamp < end_ts)
+        )
+        (hr_total, downsampled_samples, hr_min, hr_max) = query.one()
+        if not downsampled_samples:
+            return stats
+        if stats['hr_avg'] is not None and samples:
+            hr_total += stats['hr_avg'] * samples
+            downsampled_samples += samples
+        return {
+            'hr_avg' : hr_total / downsampled_samples,
+            'hr_min' : min([hr for hr in [stats['hr_min'], hr_min] if hr is not None]),
+            'hr_max' : max([hr for hr in [stats['hr_max'], hr_max] if hr is not None]),
+        }
+
+
+#
+# Removes raw monitoring rows older than a per table number of days. Heart rate is downsampled first, the other
+# tables are already covered by the hourly rollups. Works a day at a time so transactions stay small.
+#
+class MonitoringRetention():
+
+    tables = [Monitoring, MonitoringHeartRate, MonitoringIntensity, MonitoringClimb]
+
+    def __init__(self, db, retention_days):
+        self.db = db
+        self.retention_days = retention_days
+
+    def apply_table(self, table, days):
+        cutoff_ts = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days), datetime.time.min)
+        first_ts = table.get_col_min(self.db, table.timestamp)
+        if first_ts is None or first_ts >= cutoff_ts:
+            return []
+        logger.info("Retention: removing %s rows before %s" % (table.__tablename__, str(cutoff_ts)))
+        modified_dbs = []
+        day_ts = datetime.datetime.combine(first_ts.date(), datetime.time.min)
+        while day_ts < cutoff_ts:
+            next_day_ts = min(day_ts + datetime.timedelta(1), cutoff_ts)
+            if table is MonitoringHeartRate:
+                MonitoringHeartRateDownsampled.downsample(self.db, day_ts, next_day_ts)
+            table_db = self.db.partition(day_ts)
+            table.delete_range(table_db, day_ts, next_day_ts)
+            if table_db not in modified_dbs:
+                modified_dbs.append(table_db)
+            day_ts = next_day_ts
+        return modified_dbs
+
+    def apply(self):
+        MonitoringHourly.rollup_missing(self.db)
+        modified_dbs = []
+        for table in self.tables:
+            days = self.retention_days.get(table.__tablename__, None)
+            if days is not None:
+                modified_dbs += [table_db for table_db in self.apply_table(table, days) if table_db not in modified_dbs]
+        for table_db in modified_dbs:
+            table_db.vacuum()
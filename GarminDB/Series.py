@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+from HealthDB import *
+from GarminDB import Weight, Stress
+from MonitoringDB import Monitoring, MonitoringHeartRate, MonitoringIntensity
+from ActivitiesDB import ActivityRecords
+from GarminSummaryDB import SleepEvents
+
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Read-only analytics queries. Each returns a dict of {column name : list of values} ordered by timestamp for a
+# time range, or NumPy arrays if as_arrays is set, without building ORM objects. Pass interval_secs to resample
+# onto a fixed grid.
+#
+class Series():
+
+    @classmethod
+    def _get(cls, db, table, col_names, start_ts, end_ts, where=None, time_cols=[], converters={}, interval_secs=None, how='mean', as_arrays=False):
+        all_converters = {}
+        for col_name in time_cols:
+            all_converters[col_name] = db_time_secs
+        all_converters.update(converters)
+        columns = db.get_columns(table, ['timestamp'] + col_names, 'timestamp', start_ts, end_ts, where, all_converters)
+        if interval_secs is not None:
+            columns = resample(columns, start_ts, end_ts, interval_secs, how)
+        if as_arrays:
+            return columns_to_arrays(columns)
+        return columns
+
+    @classmethod
+    def heart_rate(cls, mondb, start_ts, end_ts, interval_secs=None, how='mean', as_arrays=False):
+        return cls._get(mondb, MonitoringHeartRate, ['heart_rate'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def steps(cls, mondb, start_ts, end_ts, interval_secs=None, how='max', as_arrays=False):
+        # steps are cumulative per activity type over the day
+        return cls._get(mondb, Monitoring, ['activity_type_id', 'steps'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def step_deltas(cls, mondb, start_ts, end_ts, interval_secs=None, how='sum', as_arrays=False):
+        # steps taken since the previous sample of the same activity type
+        return cls._get(mondb, Monitoring, ['activity_type_id', 'steps_delta'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def monitoring_activity(cls, mondb, start_ts, end_ts, interval_secs=None, how='last', as_arrays=False):
+        return cls._get(mondb, Monitoring, ['activity_type_id', 'intensity'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def intensity(cls, mondb, start_ts, end_ts, interval_secs=None, how='sum', as_arrays=False):
+        # activity times come back as seconds
+        return cls._get(mondb, MonitoringIntensity, ['moderate_activity_time', 'vigorous_activity_time'], start_ts, end_ts,
+            time_cols=['moderate_activity_time', 'vigorous_activity_time'], interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def stress(cls, garmindb, start_ts, end_ts, interval_secs=None, how='mean', as_arrays=False):
+        return cls._get(garmindb, Stress, ['stress'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def weight(cls, garmindb, start_ts, end_ts, interval_secs=None, how='mean', as_arrays=False):
+        return cls._get(garmindb, Weight, ['weight'], start_ts, end_ts, interval_secs=interval_secs, how=how, as_arrays=as_arrays)
+
+    @classmethod
+    def activity_records(cls, actdb, activity_id, start_ts=None, end_ts=None, as_arrays=False):
+        col_names = ['position_lat', 'position_long', 'distance', 'cadence', 'hr', 'alititude', 'speed', 'temperature']
+        return cls._get(actdb, ActivityRecords, col_names, start_ts, end_ts, where={'activity_id' : activity_id}, as_arrays=as_arrays)
+
+    @classmethod
+    def sleep_events(cls, sumdb, start_ts, end_ts):
+        # event names are strings, so these don't resample or convert to arrays
+        return cls._get(sumdb, SleepEvents, ['event', 'duration'], start_ts, end_ts, time_cols=['duration'])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import struct, array, json, sys
+
+from HealthDB import *
+from GarminDB import File
+from ActivitiesDB import ActivityRecords
+from Series import Series
+
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Local cache of activity record streams, one fixed layout binary file per activity: a header, a JSON manifest, and
+# then each column as a little endian float64 array of the same length, column after column. Missing values are NaN
+# and timestamps are seconds since the epoch. Files are opened with numpy.memmap when NumPy is installed so reads
+# don't copy or build per point objects, and read into array.array columns otherwise.
+#
+# A cached track is rebuilt when its manifest, the activity's files entry plus the count and last timestamp of its
+# records, no longer matches the DBs.
+#
+class TrackCache():
+
+    magic = 'GDBTRACK'
+    version = 1
+    header_format = '<8sIIQI'
+    header_size = struct.calcsize(header_format)
+    columns = ['timestamp', 'position_lat', 'position_long', 'distance', 'cadence', 'hr', 'alititude', 'speed', 'temperature']
+    epoch = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, cache_dir, garmin_db, garmin_act_db):
+        self.cache_dir = cache_dir
+        self.garmin_db = garmin_db
+        self.garmin_act_db = garmin_act_db
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        try:
+            import numpy
+            self.numpy = numpy
+        except ImportError:
+            self.numpy = None
+
+    def path(self, activity_id):
+        return '%s/%s.track' % (self.cache_dir, str(activity_id))
+
+    def manifest(self, activity_id):
+        file = self.garmin_db.query_session().query(File.name, File.type).filter(File.id == activity_id).first()
+        (count, last_ts) = self.garmin_act_db.query_session().query(func.count(ActivityRecords.record), func.max(ActivityRecords.timestamp)).filter(ActivityRecords.activity_id == activity_id).one()
+        if file is None:
+            return [None, None, count, str(last_ts)]
+        return [file.name, file.type, count, str(last_ts)]
+
+    def read_header(self, path):
+        with open(path, 'rb') as file:
+            (magic, version, column_count, points, manifest_size) = struct.unpack(self.header_format, file.read(self.header_size))
+            if magic != self.magic or version != self.version or column_count != len(self.columns):
+                return (None, None, None)
+            manifest = json.loads(file.read(manifest_size))
+        return (manifest, points, self.data_offset(manifest_size))
+
+    def data_offset(self, manifest_size):
+        # keep the columns 8 byte aligned
+        return (self.header_size + manifest_size + 7) & ~7
+
+    def to_float(self, value):
+        if value is None:
+            return float('nan')
+        if isinstance(value, datetime.datetime):
+            return (value - self.epoch).total_seconds()
+        return float(value)
+
+    def build(self, activity_id, manifest):
+        logger.info("Caching track for activity %s" % str(activity_id))
+        records = Series.activity_records(self.garmin_act_db, activity_id)
+        points = len(records['timestamp'])
+        manifest_str = json.dumps(manifest)
+        path = self.path(activity_id)
+        temp_path = path + '.part'
+        with open(temp_path, 'wb') as file:
+            file.write(struct.pack(self.header_format, self.magic, self.version, len(self.columns), points, len(manifest_str)))
+            file.write(manifest_str)
+            file.write('\0' * (self.data_offset(len(manifest_str)) - self.header_size - len(manifest_str)))
+            for column in self.columns:
+                values = array.array('d', [self.to_float(value) for value in records[column]])
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                values.tofile(file)
+        os.rename(temp_path, path)
+
+    def load(self, path, points, data_offset):
+        if self.numpy is not None:
+            if points == 0:
+                return {column : self.numpy.zeros(0) for column in self.columns}
+            data = self.numpy.memmap(path, dtype='<f8', mode='r', offset=data_offset, shape=(len(self.columns), points))
+            return {column : data[index] for index, column in enumerate(self.columns)}
+        track = {}
+        with open(path, 'rb') as file:
+            file.seek(data_offset)
+            for column in self.columns:
+                values = array.array('d')
+                values.fromfile(file, points)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                track[column] = values
+        return track
+
+    def get(self, activity_id):
+        path = self.path(activity_id)
+        manifest = self.manifest(activity_id)
+        if os.path.isfile(path):
+            (cached_manifest, points, data_offset) = self.read_header(path)
+            if cached_manifest == manifest:
+                return self.load(path, points, data_offset)
+            logger.debug("Cached track for activity %s is stale" % str(activity_id))
+        self.build(activity_id, manifest)
+        (cached_manifest, points, data_offset) = self.read_header(path)
+        return self.load(path, points, data_offset)
+
+    def invalidate(self, activity_id):
+        path = self.path(activity_id)
+        if os.path.isfile(path):
+            os.remove(path)
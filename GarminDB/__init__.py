@@ -2,3 +2,5 @@ from GarminDB import *
 from MonitoringDB import *
 from ActivitiesDB import *
 from GarminSummaryDB import *
+from Series import *
+from TrackCache import *
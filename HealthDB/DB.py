@@ -4,13 +4,14 @@
 # copyright Tom Goetz
 #
 
-import os, logging, datetime, time
+import os, logging, datetime, time, itertools, collections, calendar
 
-from sqlalchemy import *
-from sqlalchemy.ext.declarative import *
-from sqlalchemy.exc import *
-from sqlalchemy.orm import *
-from sqlalchemy.orm.attributes import *
+from sqlalchemy import create_engine, event, text, bindparam, Column, Integer, String, Float, FLOAT, Date, DateTime, Time, ForeignKey, UniqueConstraint, extract, func
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, synonym
+from sqlalchemy.orm.attributes import set_attribute
 
 from Fit import Conversions
 
@@ -18,10 +19,134 @@ from Fit import Conversions
 logger = logging.getLogger(__name__)
 
 
+#
+# Converters for values read with raw DBAPI cursors. SQLite hands back DateTime and Time columns as the strings
+# SQLAlchemy stored, other DBs hand back the Python types.
+#
+def db_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+def db_time_secs(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, datetime.time):
+        return (value.hour * 3600) + (value.minute * 60) + value.second + (value.microsecond / 1000000.0)
+    (hours, minutes, seconds) = value.split(':')
+    return (int(hours) * 3600) + (int(minutes) * 60) + float(seconds)
+
+
+#
+# Timestamps stored as INTEGER seconds since 1970-01-01 instead of the 26 character strings DateTime uses with
+# SQLite: rows and indexes are smaller and range scans compare integers. Timestamps are naive and aren't shifted,
+# the wall clock time is stored as if it were UTC, so SQLite's date functions with the 'unixepoch' modifier give
+# back the same time (see DBObject.sql_datetime). Fractions of a second are dropped.
+#
+class EpochDateTime(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+    epoch = datetime.datetime(1970, 1, 1)
+
+    @classmethod
+    def to_epoch(cls, value):
+        if value is None or isinstance(value, (int, long)):
+            return value
+        if isinstance(value, basestring):
+            value = db_datetime(value)
+        # a date is midnight
+        return calendar.timegm(value.timetuple())
+
+    @classmethod
+    def from_epoch(cls, value):
+        if value is None:
+            return None
+        return cls.epoch + datetime.timedelta(0, value)
+
+    def process_bind_param(self, value, dialect):
+        return self.to_epoch(value)
+
+    def process_result_value(self, value, dialect):
+        return self.from_epoch(value)
+
+
+def columns_to_arrays(columns):
+    import numpy
+    arrays = {}
+    for col_name, values in columns.iteritems():
+        if len(values) > 0 and isinstance(values[0], datetime.datetime):
+            arrays[col_name] = numpy.array(values, dtype='datetime64[us]')
+        else:
+            arrays[col_name] = numpy.array([numpy.nan if value is None else value for value in values], dtype=float)
+    return arrays
+
+#
+# Resample columns to a fixed grid of interval_secs wide bins starting at start_ts. Each bin gets the mean, min,
+# max, sum, or last of the non None values that fall in it and None if there are none.
+#
+resample_funcs = {
+    'mean'  : lambda values: sum(values) / float(len(values)),
+    'min'   : min,
+    'max'   : max,
+    'sum'   : sum,
+    'last'  : lambda values: values[-1],
+}
+
+def resample(columns, start_ts, end_ts, interval_secs, how='mean', time_col='timestamp'):
+    # a partial last bin still gets a slot
+    bin_count = int(-(-(end_ts - start_ts).total_seconds() // interval_secs))
+    value_cols = [col_name for col_name in columns if col_name != time_col]
+    bins = {col_name : [[] for index in xrange(bin_count)] for col_name in value_cols}
+    for row_index, timestamp in enumerate(columns[time_col]):
+        bin_index = int((timestamp - start_ts).total_seconds() // interval_secs)
+        if bin_index < 0 or bin_index >= bin_count:
+            continue
+        for col_name in value_cols:
+            value = columns[col_name][row_index]
+            if value is not None:
+                bins[col_name][bin_index].append(value)
+    resample_func = resample_funcs[how]
+    resampled = {time_col : [start_ts + datetime.timedelta(0, index * interval_secs) for index in xrange(bin_count)]}
+    for col_name in value_cols:
+        resampled[col_name] = [resample_func(values) if len(values) > 0 else None for values in bins[col_name]]
+    return resampled
+
+
+#
+# LRU cache of stats query results. Keys include the table's watermark, so new data makes old entries unreachable
+# and they age out.
+#
+class StatsCache():
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, value_func):
+        if key in self.entries:
+            self.hits += 1
+            value = self.entries.pop(key)
+        else:
+            self.misses += 1
+            value = value_func()
+            if len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+        self.entries[key] = value
+        return value
+
+
 class DB():
 
     max_commit_attempts = 5
     commit_errors = 0
+    # bumped for a table whenever this process writes to it
+    table_generations = {}
 
     def __init__(self, db_params_dict, debug=False):
         logger.debug("DB %s debug %s " % (repr(db_params_dict), str(debug)))
@@ -32,7 +157,29 @@ class DB():
             logger.setLevel(logging.INFO)
         self.engine = create_engine(url_func(db_params_dict), echo=(debug > 1))
         self.session_maker = sessionmaker(bind=self.engine)
+        event.listen(self.session_maker, 'after_flush', DB.note_flush)
         self._query_session = None
+        stats_cache_size = db_params_dict.get('stats_cache_size', 0)
+        if stats_cache_size > 0:
+            self.stats_cache = StatsCache(stats_cache_size)
+        else:
+            self.stats_cache = None
+
+    @classmethod
+    def note_write(cls, table_name):
+        cls.table_generations[table_name] = cls.table_generations.get(table_name, 0) + 1
+
+    @classmethod
+    def note_flush(cls, session, flush_context):
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            cls.note_write(instance.__tablename__)
+
+    def table_watermark(self, table_name):
+        # writes from this process bump the generation, inserts from other processes move the max rowid
+        if self.engine.name != 'sqlite':
+            return None
+        max_rowid = self.query_session().execute('SELECT max(rowid) FROM ' + table_name).scalar()
+        return (DB.table_generations.get(table_name, 0), max_rowid)
 
     @classmethod
     def sqlite_url(cls, db_params_dict):
@@ -50,6 +197,131 @@ class DB():
             self._query_session = self.session()
         return self._query_session
 
+    def param_marker(self):
+        if self.engine.dialect.paramstyle == 'qmark':
+            return '?'
+        return '%s'
+
+    def db_param(self, sql_type, value):
+        # the value as a column of sql_type stores it, so comparisons in raw queries line up
+        processor = sql_type.dialect_impl(self.engine.dialect).bind_processor(self.engine.dialect)
+        if processor is None:
+            return value
+        return processor(value)
+
+    def db_values(self, sql_type, values):
+        # values read off a raw cursor from a column of sql_type as the ORM would return them
+        processor = sql_type.dialect_impl(self.engine.dialect).result_processor(self.engine.dialect, None)
+        if processor is None:
+            return values
+        return [processor(value) for value in values]
+
+    #
+    # Read-only column fetch that skips ORM object construction: rows come off a raw DBAPI cursor in fetchmany
+    # sized batches and are transposed into a dict of {column name : list of values}. Values are converted by the
+    # table's column types and then by converters.
+    #
+    fetch_size = 10000
+
+    def get_columns(self, table, col_names, time_col=None, start_ts=None, end_ts=None, where=None, converters={}):
+        columns = table.__table__.columns
+        query_str = 'SELECT %s FROM %s' % (', '.join(col_names), table.__tablename__)
+        conditions = []
+        params = []
+        if where is not None:
+            for col_name, value in where.iteritems():
+                conditions.append('%s = %s' % (col_name, self.param_marker()))
+                params.append(self.db_param(columns[col_name].type, value))
+        if start_ts is not None:
+            conditions.append('%s >= %s' % (time_col, self.param_marker()))
+            params.append(self.db_param(columns[time_col].type, start_ts))
+        if end_ts is not None:
+            conditions.append('%s < %s' % (time_col, self.param_marker()))
+            params.append(self.db_param(columns[time_col].type, end_ts))
+        if len(conditions) > 0:
+            query_str += ' WHERE ' + ' AND '.join(conditions)
+        if time_col is not None:
+            query_str += ' ORDER BY ' + time_col
+        col_values = [[] for col_name in col_names]
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query_str, params)
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for column, values in zip(col_values, zip(*rows)):
+                    column.extend(values)
+            cursor.close()
+        finally:
+            connection.close()
+        result = {}
+        for col_name, column in zip(col_names, col_values):
+            column = self.db_values(columns[col_name].type, column)
+            converter = converters.get(col_name)
+            if converter is not None:
+                column = [converter(value) for value in column]
+            result[col_name] = column
+        return result
+
+    #
+    # Aggregate a column over many time windows in one query: the windows go in a temp table that's joined against
+    # the table's time index. Returns {window key : value}, windows is {window key : (start_ts, end_ts)}.
+    #
+    def get_windows_func(self, table, col_name, sql_func, windows, time_col='timestamp', ignore_le_zero=False):
+        keys = list(windows)
+        time_col_type = table.__table__.columns[time_col].type
+        query_str = (
+            'SELECT w.window_id, %s(t.%s) FROM query_windows w JOIN %s t ON t.%s >= w.start_ts AND t.%s < w.end_ts' %
+            (sql_func, col_name, table.__tablename__, time_col, time_col)
+        )
+        if ignore_le_zero:
+            query_str += ' WHERE t.%s > 0' % col_name
+        query_str += ' GROUP BY w.window_id'
+        marker = self.param_marker()
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE TEMPORARY TABLE query_windows (window_id INTEGER PRIMARY KEY, start_ts DATETIME, end_ts DATETIME)')
+            try:
+                cursor.executemany('INSERT INTO query_windows VALUES (%s, %s, %s)' % (marker, marker, marker),
+                    [(index, self.db_param(time_col_type, windows[key][0]), self.db_param(time_col_type, windows[key][1])) for index, key in enumerate(keys)])
+                cursor.execute(query_str)
+                results = {keys[window_id] : value for (window_id, value) in cursor.fetchall()}
+            finally:
+                cursor.execute('DROP TABLE query_windows')
+            cursor.close()
+        finally:
+            connection.close()
+        return results
+
+    def vacuum(self):
+        if self.engine.name == 'sqlite':
+            logger.info("Vacuuming %s" % self.db_name)
+            self.engine.execute('VACUUM')
+
+    def convert_to_epoch(self, table_name, col_name):
+        # Migrates a DateTime column's values to EpochDateTime in place. SQLite stores whatever type a value has
+        # regardless of the declared column type, other DBs need the DB rebuilt.
+        if self.engine.name != 'sqlite':
+            raise RuntimeError("DB %s can't be migrated in place. Please rebuild the DB." % self.db_name)
+        logger.info("Converting %s.%s to epoch seconds" % (table_name, col_name))
+        self.engine.execute("UPDATE %s SET %s = CAST(strftime('%%s', %s) AS INTEGER) WHERE typeof(%s) = 'text'" % (table_name, col_name, col_name, col_name))
+        DB.note_write(table_name)
+
+    def native_upsert(self):
+        # SQLite only has INSERT ... ON CONFLICT from 3.24
+        if self.engine.name == 'sqlite':
+            return self.engine.dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+        return True
+
+    def add_column(self, table, col_name):
+        # Migrates a table to a model that has a new column, create_all() only creates missing tables.
+        column = table.columns[col_name]
+        logger.info("Adding column %s.%s" % (table.name, col_name))
+        self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, col_name, column.type.compile(dialect=self.engine.dialect)))
+
     @classmethod
     def commit(cls, session):
         attempts = 0
@@ -78,6 +350,8 @@ class DBObject():
     _col_translations = {}
     _col_mappings = {}
     min_row_values = 1
+    # the columns that identify a row, matching a unique constraint: used for lookups and as the upsert conflict target
+    natural_key = None
 
 
     def _from_dict(self, db, values_dict, update=False, ignore_none=False):
@@ -176,6 +450,14 @@ class DBObject():
             return col_value
         return (cls._col_translations[col_name](col_value) if col_name in cls._col_translations else col_value)
 
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        query = session.query(cls)
+        for col_name in cls.natural_key:
+            # == None is IS NULL
+            query = query.filter(getattr(cls, col_name) == values_dict.get(col_name))
+        return query
+
     @classmethod
     def find_query(cls, session, values_dict):
         logger.debug("%s::_find %s" % (cls.__name__, repr(values_dict)))
@@ -239,14 +521,22 @@ class DBObject():
         return instance.id
 
     @classmethod
-    def create_or_update(cls, db, values_dict, ignore_none=False):
-        logger.debug("%s::create_or_update %s" % (cls.__name__, repr(values_dict)))
-        session = db.session()
+    def _create_or_update(cls, db, session, values_dict, ignore_none=False):
+        logger.debug("%s::_create_or_update %s" % (cls.__name__, repr(values_dict)))
+        if cls.natural_key is not None:
+            # natural keys are in terms of columns, so map names like activity_type to activity_type_id first
+            values_dict = cls.relational_mappings(db, cls.map_columns(values_dict))
         instance = cls._find_one(session, values_dict)
         if instance is None:
             cls._create(db, session, values_dict, ignore_none)
         else:
             instance._from_dict(db, values_dict, True, ignore_none)
+
+    @classmethod
+    def create_or_update(cls, db, values_dict, ignore_none=False):
+        logger.debug("%s::create_or_update %s" % (cls.__name__, repr(values_dict)))
+        session = db.session()
+        cls._create_or_update(db, session, values_dict, ignore_none)
         DB.commit(session)
 
     @classmethod
@@ -254,6 +544,71 @@ class DBObject():
         logger.debug("%s::create_or_update_not_none %s" % (cls.__name__, repr(values_dict)))
         cls.create_or_update(db, values_dict, True)
 
+    @classmethod
+    def create_or_update_batch(cls, db, values_dicts, ignore_none=False):
+        logger.debug("%s::create_or_update_batch %d rows" % (cls.__name__, len(values_dicts)))
+        session = db.session()
+        for values_dict in values_dicts:
+            cls._create_or_update(db, session, values_dict, ignore_none)
+        DB.commit(session)
+
+    @classmethod
+    def upsert_statement(cls, db, col_names, ignore_none):
+        update_cols = [col_name for col_name in col_names if col_name not in cls.natural_key]
+        if ignore_none:
+            set_format = '%s = COALESCE(%s, %s)'
+        else:
+            set_format = '%s = %s'
+        query_str = 'INSERT INTO %s (%s) VALUES (%s)' % (cls.__tablename__, ', '.join(col_names), ', '.join([':' + col_name for col_name in col_names]))
+        if db.engine.name == 'sqlite':
+            query_str += ' ON CONFLICT (%s) DO ' % ', '.join(cls.natural_key)
+            if len(update_cols) > 0:
+                query_str += 'UPDATE SET ' + ', '.join([set_format % (col_name, 'excluded.' + col_name, col_name) for col_name in update_cols])
+            else:
+                query_str += 'NOTHING'
+        elif len(update_cols) > 0:
+            query_str += ' ON DUPLICATE KEY UPDATE ' + ', '.join([set_format % (col_name, 'VALUES(%s)' % col_name, col_name) for col_name in update_cols])
+        else:
+            query_str = query_str.replace('INSERT', 'INSERT IGNORE', 1)
+        return text(query_str).bindparams(*[bindparam(col_name, type_=cls.__table__.c[col_name].type) for col_name in col_names])
+
+    @classmethod
+    def upsert_batch(cls, db, values_dicts, ignore_none=False):
+        # Native upsert with the natural key as the conflict target. NULLs never conflict, so rows with a NULL key
+        # column go through the ORM lookup instead, as do all rows on DBs without a native upsert.
+        logger.debug("%s::upsert_batch %d rows" % (cls.__name__, len(values_dicts)))
+        rows = []
+        for values_dict in values_dicts:
+            row = cls.massage_columns(db, values_dict)
+            # rows short of min_row_values are dropped before either path sees them
+            if len([value for value in row.itervalues() if value is not None]) >= cls.min_row_values:
+                rows.append(row)
+        if not db.native_upsert():
+            cls.create_or_update_batch(db, rows, ignore_none)
+            return
+        rows_by_cols = {}
+        null_key_rows = []
+        for row in rows:
+            if None in [row.get(col_name) for col_name in cls.natural_key]:
+                null_key_rows.append(row)
+            else:
+                rows_by_cols.setdefault(tuple(sorted(row)), []).append(row)
+        if len(null_key_rows) > 0:
+            cls.create_or_update_batch(db, null_key_rows, ignore_none)
+        if len(rows_by_cols) > 0:
+            with db.engine.begin() as connection:
+                for col_names, rows in rows_by_cols.iteritems():
+                    connection.execute(cls.upsert_statement(db, list(col_names), ignore_none), rows)
+            DB.note_write(cls.__tablename__)
+
+    @classmethod
+    def delete_range(cls, db, start_ts, end_ts):
+        logger.debug("%s::delete_range %s to %s" % (cls.__name__, str(start_ts), str(end_ts)))
+        session = db.session()
+        session.query(cls).filter(cls.time_col >= start_ts).filter(cls.time_col < end_ts).delete(synchronize_session=False)
+        DB.commit(session)
+        DB.note_write(cls.__tablename__)
+
     @classmethod
     def row_to_int(cls, row):
         return int(row[0])
@@ -279,13 +634,21 @@ class DBObject():
     def rows_to_months(cls, rows):
         return [cls.row_to_month(row) for row in rows]
 
+    @classmethod
+    def sql_datetime(cls, col):
+        # SQL date and time functions take EpochDateTime columns with the 'unixepoch' modifier
+        if isinstance(col.expression.type, EpochDateTime):
+            return func.datetime(col, 'unixepoch')
+        return col
+
     @classmethod
     def get_years(cls, db):
-        return cls.rows_to_ints_not_none(db.session().query(extract('year', cls.time_col)).distinct().all())
+        return cls.rows_to_ints_not_none(db.session().query(extract('year', cls.sql_datetime(cls.time_col))).distinct().all())
 
     @classmethod
     def get_months(cls, db, year):
-          return cls.rows_to_ints_not_none(db.query_session().query(extract('month', cls.time_col)).filter(extract('year', cls.time_col) == str(year)).distinct().all())
+          time_col = cls.sql_datetime(cls.time_col)
+          return cls.rows_to_ints_not_none(db.query_session().query(extract('month', time_col)).filter(extract('year', time_col) == str(year)).distinct().all())
 
     @classmethod
     def get_month_names(cls, db, year):
@@ -293,7 +656,8 @@ class DBObject():
 
     @classmethod
     def get_days(cls, db, year):
-        return cls.rows_to_ints(db.session().query(func.strftime("%j", cls.time_col)).filter(extract('year', cls.time_col) == str(year)).distinct().all())
+        time_col = cls.sql_datetime(cls.time_col)
+        return cls.rows_to_ints(db.session().query(func.strftime("%j", time_col)).filter(extract('year', time_col) == str(year)).distinct().all())
 
     @classmethod
     def get_col_values(cls, db, get_col, match_col, match_value, start_ts=None, end_ts=None):
@@ -305,6 +669,17 @@ class DBObject():
         query = query.filter(match_col == match_value)
         return query.all()
 
+    @classmethod
+    def cached_scalar(cls, db, query):
+        if db.stats_cache is None:
+            return query.scalar()
+        watermark = db.table_watermark(cls.__tablename__)
+        if watermark is None:
+            return query.scalar()
+        statement = query.statement.compile()
+        key = (cls.__tablename__, watermark, str(statement), tuple(sorted(statement.params.items())))
+        return db.stats_cache.get(key, query.scalar)
+
     @classmethod
     def get_col_func(cls, db, col, func, start_ts=None, end_ts=None, ignore_le_zero=False):
         query = db.query_session().query(func(col))
@@ -314,7 +689,7 @@ class DBObject():
             query = query.filter(cls.time_col < end_ts)
         if ignore_le_zero:
             query = query.filter(col > 0)
-        return query.scalar()
+        return cls.cached_scalar(db, query)
 
     @classmethod
     def get_col_avg(cls, db, col, start_ts=None, end_ts=None, ignore_le_zero=False):
@@ -338,9 +713,9 @@ class DBObject():
             db.query_session().query(func.max(col).label('maxes'))
                 .filter(cls.timestamp >= start_ts)
                 .filter(cls.timestamp < end_ts)
-                .group_by(func.strftime("%j", cls.timestamp))
+                .group_by(func.strftime("%j", cls.sql_datetime(cls.timestamp)))
         )
-        return db.query_session().query(stat_func(max_daily_query.subquery().columns.maxes)).scalar()
+        return cls.cached_scalar(db, db.query_session().query(stat_func(max_daily_query.subquery().columns.maxes)))
 
     @classmethod
     def get_col_sum_of_max_per_day(cls, db, col, start_ts, end_ts):
@@ -365,9 +740,9 @@ class DBObject():
                 .filter(match_col == match_value)
                 .filter(cls.timestamp >= start_ts)
                 .filter(cls.timestamp < end_ts)
-                .group_by(func.strftime("%j", cls.timestamp))
+                .group_by(func.strftime("%j", cls.sql_datetime(cls.timestamp)))
         )
-        return db.query_session().query(stat_func(max_daily_query.subquery().columns.maxes)).scalar()
+        return cls.cached_scalar(db, db.query_session().query(stat_func(max_daily_query.subquery().columns.maxes)))
 
     @classmethod
     def get_col_sum_of_max_per_day_for_value(cls, db, col, match_col, match_value, start_ts, end_ts):
@@ -386,7 +761,7 @@ class DBObject():
             query = query.filter(cls.time_col < end_ts)
         if ignore_le_zero:
             query = query.filter(col > 0)
-        return Conversions.secs_to_dt_time(query.scalar())
+        return Conversions.secs_to_dt_time(cls.cached_scalar(db, query))
 
     @classmethod
     def get_time_col_avg(cls, db, col, start_ts, end_ts, ignore_le_zero=False):
@@ -471,9 +846,15 @@ class KeyValueObject(DBObject):
 class DbVersionObject(KeyValueObject):
     __tablename__ = 'version'
 
-    def version_check(self, db, version_number):
+    def version_check(self, db, version_number, migrations={}):
         self.set_if_unset(db, 'version', version_number)
         self.version = self.get_int(db, 'version')
+        # migrations is {version : function(db) that updates the DB in place from that version to the next}
+        while self.version < version_number and self.version in migrations:
+            logger.info("Migrating DB %s from version %d to %d" % (db.db_name, self.version, self.version + 1))
+            migrations[self.version](db)
+            self.version += 1
+            self.set(db, 'version', self.version, datetime.datetime.now())
         if self.version != version_number:
             raise RuntimeError("DB %s version mismatch. Please rebuild the DB. (%s vs %s)" % (db.db_name, self.version, version_number))
 
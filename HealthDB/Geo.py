@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import math
+
+
+#
+# Geohashes interleave longitude and latitude bits so points close together share a prefix, which lets a B-tree
+# index on a geohash column answer bounding box queries with a few range scans. Boxes crossing the antimeridian
+# aren't handled.
+#
+geohash_alphabet = '0123456789bcdefghjkmnpqrstuvwxyz'
+earth_radius_meters = 6371000.0
+meters_per_degree = 111320.0
+
+#
+# NumPy is optional and slow to import, the vectorized distance paths load it on first use and fall back to plain
+# Python loops without it.
+#
+numpy_state = {}
+
+
+def optional_numpy():
+    if 'numpy' not in numpy_state:
+        try:
+            import numpy
+            numpy_state['numpy'] = numpy
+        except ImportError:
+            numpy_state['numpy'] = None
+    return numpy_state['numpy']
+
+
+def geohash_encode(latitude, longitude, precision):
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            value, value_range = longitude, long_range
+        else:
+            value, value_range = latitude, lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            value_range[0] = mid
+        else:
+            bits = bits << 1
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(geohash_alphabet[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+def geohash_cell_size(precision):
+    # (height, width) in degrees of a cell
+    long_bits = (5 * precision + 1) // 2
+    lat_bits = (5 * precision) // 2
+    return (180.0 / (1 << lat_bits), 360.0 / (1 << long_bits))
+
+def geohash_cover(min_lat, min_long, max_lat, max_long, max_precision, max_cells=64):
+    # the cells of the longest precision, up to max_precision, that covers the box with at most max_cells cells
+    precision = max_precision
+    while precision > 1:
+        (height, width) = geohash_cell_size(precision)
+        if (int((max_lat - min_lat) / height) + 2) * (int((max_long - min_long) / width) + 2) <= max_cells:
+            break
+        precision -= 1
+    (height, width) = geohash_cell_size(precision)
+    latitudes = [min(min_lat + (index * height), max_lat) for index in xrange(int((max_lat - min_lat) / height) + 2)]
+    longitudes = [min(min_long + (index * width), max_long) for index in xrange(int((max_long - min_long) / width) + 2)]
+    return sorted(set([geohash_encode(latitude, longitude, precision) for latitude in latitudes for longitude in longitudes]))
+
+def geohash_prefix_range(prefix):
+    # all geohashes starting with prefix sort in [prefix, prefix + '~')
+    return (prefix, prefix + '~')
+
+def distance_meters(lat1, long1, lat2, long2):
+    # haversine
+    dlat = math.radians(lat2 - lat1)
+    dlong = math.radians(long2 - long1)
+    a = (math.sin(dlat / 2) ** 2) + (math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * (math.sin(dlong / 2) ** 2))
+    return 2 * earth_radius_meters * math.asin(min(1.0, math.sqrt(a)))
+
+def radius_bounding_box(latitude, longitude, radius_meters):
+    dlat = radius_meters / meters_per_degree
+    dlong = dlat / max(math.cos(math.radians(latitude)), 0.01)
+    return (latitude - dlat, longitude - dlong, latitude + dlat, longitude + dlong)
+
+def simplify_track(points, tolerance_meters):
+    # Douglas-Peucker over (latitude, longitude) points, iterative so long tracks don't hit the recursion limit.
+    # Distances are on a local equirectangular projection, fine at track scales.
+    if len(points) < 3:
+        return list(points)
+    long_scale = math.cos(math.radians(points[0][0]))
+    xy = [(longitude * long_scale * meters_per_degree, latitude * meters_per_degree) for (latitude, longitude) in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        (x1, y1) = xy[first]
+        (x2, y2) = xy[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        length = math.hypot(dx, dy)
+        max_dist = 0.0
+        max_index = None
+        for index in xrange(first + 1, last):
+            (x, y) = xy[index]
+            if length > 0:
+                dist = abs((dy * (x - x1)) - (dx * (y - y1))) / length
+            else:
+                dist = math.hypot(x - x1, y - y1)
+            if dist > max_dist:
+                max_dist = dist
+                max_index = index
+        if max_index is not None and max_dist > tolerance_meters:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+def polyline_encode(points, precision=5):
+    # Google encoded polyline format
+    factor = 10 ** precision
+    encoded = []
+    prev_lat = prev_long = 0
+    for (latitude, longitude) in points:
+        lat = int(round(latitude * factor))
+        lng = int(round(longitude * factor))
+        for delta in (lat - prev_lat, lng - prev_long):
+            value = ~(delta << 1) if delta < 0 else (delta << 1)
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        prev_lat = lat
+        prev_long = lng
+    return ''.join(encoded)
+
+def polyline_decode(encoded, precision=5):
+    factor = float(10 ** precision)
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for coordinate in xrange(2):
+            shift = result = 0
+            while True:
+                value = ord(encoded[index]) - 63
+                index += 1
+                result |= (value & 0x1f) << shift
+                shift += 5
+                if value < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else (result >> 1))
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+def local_xy(points, ref_latitude):
+    # project (latitude, longitude) points to meters on a plane, good enough over a few kms
+    long_scale = math.cos(math.radians(ref_latitude)) * meters_per_degree
+    return [(longitude * long_scale, latitude * meters_per_degree) for (latitude, longitude) in points]
+
+def point_to_polyline_meters(point, polyline):
+    # point and polyline are local_xy projected
+    (x, y) = point
+    if len(polyline) == 1:
+        return math.hypot(x - polyline[0][0], y - polyline[0][1])
+    closest = None
+    for ((x1, y1), (x2, y2)) in zip(polyline[:-1], polyline[1:]):
+        dx = x2 - x1
+        dy = y2 - y1
+        length_squared = (dx * dx) + (dy * dy)
+        if length_squared > 0:
+            fraction = max(0.0, min(1.0, (((x - x1) * dx) + ((y - y1) * dy)) / length_squared))
+        else:
+            fraction = 0.0
+        dist = math.hypot(x - (x1 + fraction * dx), y - (y1 + fraction * dy))
+        if closest is None or dist < closest:
+            closest = dist
+    return closest
+
+def points_within_meters(points, polyline, tolerance_meters):
+    # every point is within tolerance_meters of the polyline, points and polyline are local_xy projected
+    numpy = optional_numpy()
+    if numpy is None or len(polyline) < 2:
+        for point in points:
+            if point_to_polyline_meters(point, polyline) > tolerance_meters:
+                return False
+        return True
+    xy = numpy.array(points, dtype=float).reshape(-1, 2)
+    line = numpy.array(polyline, dtype=float)
+    starts = line[:-1]
+    deltas = line[1:] - starts
+    length_squared = (deltas ** 2).sum(axis=1)
+    # (points, segments) arrays of each point's closest position along each segment of the polyline
+    offsets = xy[:, numpy.newaxis, :] - starts[numpy.newaxis, :, :]
+    fractions = (offsets * deltas[numpy.newaxis, :, :]).sum(axis=2) / numpy.where(length_squared > 0, length_squared, 1.0)
+    fractions = numpy.clip(numpy.where(length_squared > 0, fractions, 0.0), 0.0, 1.0)
+    closest = offsets - (fractions[:, :, numpy.newaxis] * deltas[numpy.newaxis, :, :])
+    distances = numpy.sqrt((closest ** 2).sum(axis=2)).min(axis=1)
+    return bool((distances <= tolerance_meters).all())
+
+def track_meters(points):
+    numpy = optional_numpy()
+    if numpy is None or len(points) < 2:
+        return sum([distance_meters(lat1, long1, lat2, long2) for ((lat1, long1), (lat2, long2)) in zip(points[:-1], points[1:])])
+    # haversine over all of the track's steps at once
+    radians = numpy.radians(numpy.array(points, dtype=float))
+    dlat = numpy.diff(radians[:, 0])
+    dlong = numpy.diff(radians[:, 1])
+    a = (numpy.sin(dlat / 2) ** 2) + (numpy.cos(radians[:-1, 0]) * numpy.cos(radians[1:, 0]) * (numpy.sin(dlong / 2) ** 2))
+    return float((2 * earth_radius_meters * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(a)))).sum())
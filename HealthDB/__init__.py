@@ -1,3 +1,4 @@
 from DB import *
 from SummaryDB import *
 from CsvImporter import *
+from Geo import *
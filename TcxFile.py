@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, datetime
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+
+logger = logging.getLogger(__file__)
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_time(time_str):
+    for time_format in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"]:
+        try:
+            return datetime.datetime.strptime(time_str, time_format)
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(time_str)
+
+
+def to_float(value):
+    if value is not None:
+        return float(value)
+
+
+def to_int(value):
+    if value is not None:
+        return int(float(value))
+
+
+#
+# Single pass TCX reader. Laps and trackpoints are handed to the callbacks as they are parsed and then
+# removed from the tree so memory use doesn't grow with the size of the file.
+#
+class TcxFile():
+
+    distance_units = 'meters'
+
+    def __init__(self, filename, lap_func=None, trackpoint_func=None):
+        self.filename = filename
+        self.lap_func = lap_func
+        self.trackpoint_func = trackpoint_func
+
+        self.sport = None
+        self.creator = None
+        self.creator_version = None
+        self.started_at = None
+        self.completed_at = None
+        self.laps = 0
+        self.trackpoints = 0
+        self.calories = 0
+        self.distance = 0.0
+        self.ascent = 0.0
+        self.descent = 0.0
+        self.start_latitude = None
+        self.start_longitude = None
+        self.end_latitude = None
+        self.end_longitude = None
+        self.hr_max = None
+        self.cadence_max = None
+        self.hr_sum = 0
+        self.hr_count = 0
+        self.cadence_sum = 0
+        self.cadence_count = 0
+        self.last_altitude = None
+
+        self.parse()
+
+    @classmethod
+    def leaf_values(cls, element, values=None, parent_name=None):
+        # flatten an element to {local tag name : text}, <X><Value>n</Value></X> becomes {X : n}
+        if values is None:
+            values = {}
+        for child in element:
+            name = local_name(child.tag)
+            if len(child) > 0:
+                cls.leaf_values(child, values, name)
+            elif child.text is not None and child.text.strip():
+                if name == 'Value' and parent_name is not None:
+                    name = parent_name
+                values[name] = child.text.strip()
+        return values
+
+    def parse(self):
+        logger.info("Parsing file: " + self.filename)
+        parents = []
+        for event, element in ElementTree.iterparse(self.filename, events=('start', 'end')):
+            name = local_name(element.tag)
+            if event == 'start':
+                parents.append(element)
+                if name == 'Lap':
+                    self.start_lap(element)
+                continue
+            parents.pop()
+            if name == 'Trackpoint':
+                self.end_trackpoint(self.leaf_values(element))
+                parents[-1].remove(element)
+            elif name == 'Lap':
+                self.end_lap(self.leaf_values(element))
+                parents[-1].remove(element)
+            elif name == 'Activity':
+                self.sport = element.get('Sport')
+            elif name == 'Creator' and local_name(parents[-1].tag) == 'Activity':
+                values = self.leaf_values(element)
+                self.creator = values.get('Name')
+                self.creator_version = to_int(values.get('UnitId'))
+
+    def start_lap(self, element):
+        self.lap_start_time = parse_time(element.get('StartTime'))
+        if self.started_at is None:
+            self.started_at = self.lap_start_time
+        self.lap_start_latitude = None
+        self.lap_start_longitude = None
+        self.lap_end_latitude = None
+        self.lap_end_longitude = None
+
+    def end_lap(self, values):
+        self.laps += 1
+        elapsed_secs = to_float(values.get('TotalTimeSeconds'))
+        calories = to_int(values.get('Calories'))
+        if calories is not None:
+            self.calories += calories
+        stop_time = None
+        if elapsed_secs is not None:
+            stop_time = self.lap_start_time + datetime.timedelta(0, elapsed_secs)
+            if self.completed_at is None or stop_time > self.completed_at:
+                self.completed_at = stop_time
+        lap = {
+            'start_time'    : self.lap_start_time,
+            'stop_time'     : stop_time,
+            'elapsed_secs'  : elapsed_secs,
+            'distance'      : to_float(values.get('DistanceMeters')),
+            'calories'      : calories,
+            'avg_hr'        : to_int(values.get('AverageHeartRateBpm')),
+            'max_hr'        : to_int(values.get('MaximumHeartRateBpm')),
+            'max_speed'     : to_float(values.get('MaximumSpeed')),
+            'avg_speed'     : to_float(values.get('AvgSpeed')),
+            'avg_cadence'   : to_int(values.get('Cadence', values.get('AvgRunCadence'))),
+            'start_lat'     : self.lap_start_latitude,
+            'start_long'    : self.lap_start_longitude,
+            'stop_lat'      : self.lap_end_latitude,
+            'stop_long'     : self.lap_end_longitude,
+        }
+        if self.lap_func is not None:
+            self.lap_func(self.laps, lap)
+
+    def end_trackpoint(self, values):
+        # a trackpoint without a usable time can't be placed in the activity, skip it rather than the whole file
+        if not values.get('Time'):
+            logger.debug("Skipping trackpoint without a time in %s" % self.filename)
+            return
+        try:
+            timestamp = parse_time(values['Time'])
+        except ValueError:
+            logger.debug("Skipping trackpoint with time %s in %s" % (values['Time'], self.filename))
+            return
+        self.trackpoints += 1
+        if self.completed_at is None or timestamp > self.completed_at:
+            self.completed_at = timestamp
+        latitude = to_float(values.get('LatitudeDegrees'))
+        longitude = to_float(values.get('LongitudeDegrees'))
+        if latitude is not None and longitude is not None:
+            if self.start_latitude is None:
+                self.start_latitude = latitude
+                self.start_longitude = longitude
+            if self.lap_start_latitude is None:
+                self.lap_start_latitude = latitude
+                self.lap_start_longitude = longitude
+            self.end_latitude = self.lap_end_latitude = latitude
+            self.end_longitude = self.lap_end_longitude = longitude
+        altitude = to_float(values.get('AltitudeMeters'))
+        if altitude is not None:
+            if self.last_altitude is not None:
+                if altitude > self.last_altitude:
+                    self.ascent += altitude - self.last_altitude
+                else:
+                    self.descent += self.last_altitude - altitude
+            self.last_altitude = altitude
+        distance = to_float(values.get('DistanceMeters'))
+        if distance is not None:
+            self.distance = distance
+        hr = to_int(values.get('HeartRateBpm'))
+        if hr is not None:
+            self.hr_sum += hr
+            self.hr_count += 1
+            if self.hr_max is None or hr > self.hr_max:
+                self.hr_max = hr
+        cadence = to_int(values.get('Cadence', values.get('RunCadence')))
+        if cadence is not None:
+            self.cadence_sum += cadence
+            self.cadence_count += 1
+            if self.cadence_max is None or cadence > self.cadence_max:
+                self.cadence_max = cadence
+        trackpoint = {
+            'timestamp'     : timestamp,
+            'position_lat'  : latitude,
+            'position_long' : longitude,
+            'altitude'      : altitude,
+            'distance'      : distance,
+            'hr'            : hr,
+            'cadence'       : cadence,
+            'speed'         : to_float(values.get('Speed')),
+        }
+        if self.trackpoint_func is not None:
+            self.trackpoint_func(self.trackpoints, trackpoint)
+
+    @property
+    def hr_avg(self):
+        if self.hr_count > 0:
+            return self.hr_sum / self.hr_count
+
+    @property
+    def cadence_avg(self):
+        if self.cadence_count > 0:
+            return self.cadence_sum / self.cadence_count
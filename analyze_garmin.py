@@ -4,7 +4,7 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, re, string, logging, datetime, calendar
+import os, sys, getopt, re, string, logging, datetime, calendar, bisect
 
 import HealthDB
 import GarminDB
@@ -27,7 +27,12 @@ class MovingAverageFilter():
 
 
 class Analyze():
+
+    # the summaries repeat a lot of the same stats queries
+    stats_cache_size = 4096
+
     def __init__(self, db_params_dict, debug):
+        db_params_dict = dict(db_params_dict, stats_cache_size=self.stats_cache_size)
         self.garmindb = GarminDB.GarminDB(db_params_dict, debug)
         self.mondb = GarminDB.MonitoringDB(db_params_dict, debug)
         self.garminsumdb = GarminDB.GarminSummaryDB(db_params_dict, debug)
@@ -142,6 +147,9 @@ class Analyze():
                 day_str = str(Conversions.day_of_the_year_to_datetime(year, day))
                 next_day_str = str(Conversions.day_of_the_year_to_datetime(year, next_day))
                 logger.info("Days gap between %d (%s) and %d (%s)" % (day, day_str, next_day, next_day_str))
+                # have the next scrape refetch the missing days
+                for missing_day in xrange(day + 1, next_day):
+                    GarminDB.ScrapeState.mark_missing(self.garmindb, Conversions.day_of_the_year_to_datetime(year, missing_day).date())
 
     base_awake_intensity = 3
     base_active_intensity = 10
@@ -202,31 +210,49 @@ class Analyze():
         elif self.asleep(sleep_state) and self.mins_asleep >= 30:
             self.wake_ts = None
 
-    def calculate_sleep(self, day_date, sleep_period_start, sleep_period_stop):
-        generic_act_id = GarminDB.ActivityType.get_id(self.mondb, 'generic')
-        stop_act_id = GarminDB.ActivityType.get_id(self.mondb, 'stop_disable')
-
+    def sleep_search_window(self, day_date, sleep_period_start, sleep_period_stop):
         sleep_search_start_ts = datetime.datetime.combine(day_date, sleep_period_start) - datetime.timedelta(0, 7200)
         sleep_search_stop_ts = datetime.datetime.combine(day_date + datetime.timedelta(1), sleep_period_stop) + datetime.timedelta(0, 7200)
+        return (sleep_search_start_ts, sleep_search_stop_ts)
 
-        activity = GarminDB.Monitoring.get_activity(self.mondb, sleep_search_start_ts, sleep_search_stop_ts)
+    def calculate_sleeps(self, day_dates, sleep_period_start, sleep_period_stop):
+        # one fetch of the monitoring activity for all of the nights, each night's window is sliced out of it
+        if len(day_dates) == 0:
+            return
+        stop_act_id = GarminDB.ActivityType.get_id(self.mondb, 'stop_disable')
+        search_start_ts = self.sleep_search_window(min(day_dates), sleep_period_start, sleep_period_stop)[0]
+        search_stop_ts = self.sleep_search_window(max(day_dates), sleep_period_start, sleep_period_stop)[1]
+        activity = GarminDB.Series.monitoring_activity(self.mondb, search_start_ts, search_stop_ts)
+        timestamps = activity['timestamp']
+        for day_date in day_dates:
+            (sleep_search_start_ts, sleep_search_stop_ts) = self.sleep_search_window(day_date, sleep_period_start, sleep_period_stop)
+            first = bisect.bisect_left(timestamps, sleep_search_start_ts)
+            last = bisect.bisect_left(timestamps, sleep_search_stop_ts)
+            night_activity = {col_name : values[first:last] for col_name, values in activity.iteritems()}
+            self.calculate_sleep(day_date, sleep_search_start_ts, sleep_search_stop_ts, stop_act_id, night_activity)
+
+    def calculate_sleep(self, day_date, sleep_search_start_ts, sleep_search_stop_ts, stop_act_id, activity):
+        timestamps = activity['timestamp']
+        activity_type_ids = activity['activity_type_id']
+        intensities = activity['intensity']
 
         # turn activity data into activity periods
         initial_intensity = self.base_awake_intensity
         last_intensity = initial_intensity
         last_sample_ts = sleep_search_stop_ts
         activity_periods = []
-        for index in xrange(len(activity) - 1, 0, -1):
-            (timestamp, activity_type_id, intensity) = activity[index]
+        for index in xrange(len(timestamps) - 1, 0, -1):
+            (timestamp, activity_type_id, intensity) = (timestamps[index], activity_type_ids[index], intensities[index])
             duration = int((last_sample_ts - timestamp).total_seconds())
             if activity_type_id != stop_act_id:
                 if intensity is None:
                     intensity = self.base_active_intensity
                 else:
                     intensity = self.base_active_intensity + (intensity * 2)
-            activity_periods.insert(0, (timestamp, last_intensity, duration))
+            activity_periods.append((timestamp, last_intensity, duration))
             last_intensity = intensity
             last_sample_ts = timestamp
+        activity_periods.reverse()
 
         self.bedtime_ts = None
         self.mins_asleep = 0
@@ -268,15 +294,18 @@ class Analyze():
         GarminDB.Sleep.create_or_update(self.garminsumdb,
             {'day' :  day_date, 'duration' : Conversions.min_to_dt_time(self.mins_asleep_total)})
 
-    def calculate_resting_heartrate(self, day_date, sleep_period_stop):
-        wake_ts = GarminDB.SleepEvents.get_wake_time(self.garminsumdb, day_date)
-        if wake_ts is None:
-            wake_ts = datetime.datetime.combine(day_date, sleep_period_stop)
-        rhr = GarminDB.MonitoringHeartRate.get_resting_heartrate(self.mondb, wake_ts)
-        if rhr:
-            GarminDB.RestingHeartRate.create_or_update(self.garminsumdb, {'day' : day_date, 'resting_heart_rate' : rhr})
-        else:
-            logger.debug("No RHR for %s)" % str(day_date))
+    def calculate_resting_heartrates(self, day_dates, sleep_period_stop):
+        # calculate_resting_heartrate for a range of days with a query for the wake times and one or two for the HR
+        if len(day_dates) == 0:
+            return
+        wake_times = GarminDB.SleepEvents.get_wake_times(self.garminsumdb, min(day_dates), max(day_dates))
+        for day_date in day_dates:
+            if day_date not in wake_times:
+                wake_times[day_date] = datetime.datetime.combine(day_date, sleep_period_stop)
+        rhrs = GarminDB.MonitoringHeartRate.get_resting_heartrates(self.mondb, {day_date : wake_times[day_date] for day_date in day_dates})
+        GarminDB.RestingHeartRate.create_or_update_batch(self.garminsumdb,
+            [{'day' : day_date, 'resting_heart_rate' : rhrs[day_date]} for day_date in day_dates if rhrs.get(day_date)])
+        logger.debug("RHR for %d of %d days" % (len([day_date for day_date in day_dates if rhrs.get(day_date)]), len(day_dates)))
 
     def combine_stats(self, stats, stat1_name, stat2_name):
         stat1 = stats.get(stat1_name, 0)
@@ -293,9 +322,7 @@ class Analyze():
         stats.update(GarminDB.RestingHeartRate.get_daily_stats(self.garminsumdb, day_date))
         stats.update(GarminDB.Weight.get_daily_stats(self.garmindb, day_date))
         stats.update(GarminDB.Stress.get_daily_stats(self.garmindb, day_date))
-        stats.update(GarminDB.MonitoringClimb.get_daily_stats(self.mondb, day_date, self.english_units))
-        stats.update(GarminDB.MonitoringIntensity.get_daily_stats(self.mondb, day_date))
-        stats.update(GarminDB.Monitoring.get_daily_stats(self.mondb, day_date))
+        stats.update(GarminDB.MonitoringHourly.get_daily_stats(self.mondb, day_date, self.english_units))
         stats.update(GarminDB.Sleep.get_daily_stats(self.garminsumdb, day_date))
         stats.update(GarminDB.MonitoringInfo.get_daily_stats(self.mondb, day_date))
         stats['calories_avg'] = self.combine_stats(stats, 'calories_bmr_avg', 'calories_active_avg')
@@ -307,9 +334,7 @@ class Analyze():
         stats.update(GarminDB.RestingHeartRate.get_weekly_stats(self.garminsumdb, day_date))
         stats.update(GarminDB.Weight.get_weekly_stats(self.garmindb, day_date))
         stats.update(GarminDB.Stress.get_weekly_stats(self.garmindb, day_date))
-        stats.update(GarminDB.MonitoringClimb.get_weekly_stats(self.mondb, day_date, self.english_units))
-        stats.update(GarminDB.MonitoringIntensity.get_weekly_stats(self.mondb, day_date))
-        stats.update(GarminDB.Monitoring.get_weekly_stats(self.mondb, day_date))
+        stats.update(GarminDB.MonitoringHourly.get_weekly_stats(self.mondb, day_date, self.english_units))
         stats.update(GarminDB.Sleep.get_weekly_stats(self.garminsumdb, day_date))
         stats.update(GarminDB.MonitoringInfo.get_weekly_stats(self.mondb, day_date))
         stats['calories_avg'] = self.combine_stats(stats, 'calories_bmr_avg', 'calories_active_avg')
@@ -321,26 +346,36 @@ class Analyze():
         stats.update(GarminDB.RestingHeartRate.get_monthly_stats(self.garminsumdb, start_day_date, end_day_date))
         stats.update(GarminDB.Weight.get_monthly_stats(self.garmindb, start_day_date, end_day_date))
         stats.update(GarminDB.Stress.get_monthly_stats(self.garmindb, start_day_date, end_day_date))
-        stats.update(GarminDB.MonitoringClimb.get_monthly_stats(self.mondb, start_day_date, end_day_date, self.english_units))
-        stats.update(GarminDB.MonitoringIntensity.get_monthly_stats(self.mondb, start_day_date, end_day_date))
-        stats.update(GarminDB.Monitoring.get_monthly_stats(self.mondb, start_day_date, end_day_date))
+        stats.update(GarminDB.MonitoringHourly.get_monthly_stats(self.mondb, start_day_date, end_day_date, self.english_units))
         stats.update(GarminDB.Sleep.get_monthly_stats(self.garminsumdb, start_day_date, end_day_date))
         stats.update(GarminDB.MonitoringInfo.get_monthly_stats(self.mondb, start_day_date, end_day_date))
         stats['calories_avg'] = self.combine_stats(stats, 'calories_bmr_avg', 'calories_active_avg')
         GarminDB.MonthsSummary.create_or_update_not_none(self.garminsumdb, stats)
         HealthDB.MonthsSummary.create_or_update_not_none(self.sumdb, stats)
 
+    def segment_efforts(self, name, activity_id, first_record, last_record):
+        segment_id = GarminDB.Segments.create_from_activity(self.garmin_act_db, name, activity_id, first_record, last_record)
+        GarminDB.SegmentEfforts.update(self.garmin_act_db)
+        segment = GarminDB.Segments.find_one(self.garmin_act_db, {'name' : name})
+        efforts = GarminDB.SegmentEfforts.get_efforts(self.garmin_act_db, segment_id)
+        logger.info("Segment %s: %.0fm %d efforts" % (name, segment.distance, len(efforts)))
+        for (start_time, elapsed_time, avg_hr, max_hr) in efforts:
+            elapsed_secs = (elapsed_time.hour * 3600) + (elapsed_time.minute * 60) + elapsed_time.second
+            pace_secs = int(elapsed_secs * 1000 / segment.distance)
+            logger.info("    %s: %s pace %d:%02d/km avg hr %s max hr %s" % (str(start_time), str(elapsed_time), pace_secs / 60, pace_secs % 60, str(avg_hr), str(max_hr)))
+
     def summary(self):
         sleep_period_start = GarminDB.Attributes.get_time(self.garmindb, 'sleep_time')
         sleep_period_stop = GarminDB.Attributes.get_time(self.garmindb, 'wake_time')
+        GarminDB.MonitoringHourly.rollup_missing(self.mondb)
 
         years = GarminDB.Monitoring.get_years(self.mondb)
         for year in years:
             days = GarminDB.Monitoring.get_days(self.mondb, year)
-            for day in days:
-                day_date = datetime.date(year, 1, 1) + datetime.timedelta(day - 1)
-                self.calculate_sleep(day_date, sleep_period_start, sleep_period_stop)
-                self.calculate_resting_heartrate(day_date, sleep_period_stop)
+            day_dates = [datetime.date(year, 1, 1) + datetime.timedelta(day - 1) for day in days]
+            self.calculate_sleeps(day_dates, sleep_period_start, sleep_period_stop)
+            self.calculate_resting_heartrates(day_dates, sleep_period_stop)
+            for day_date in day_dates:
                 self.calculate_day_stats(day_date)
 
             for week_starting_day in xrange(1, 365, 7):
@@ -353,8 +388,41 @@ class Analyze():
                 end_day_date = datetime.date(year, month, calendar.monthrange(year, month)[1])
                 self.calculate_month_stats(start_day_date, end_day_date)
 
+    def summary_days(self, first_day_date, last_day_date):
+        sleep_period_start = GarminDB.Attributes.get_time(self.garmindb, 'sleep_time')
+        sleep_period_stop = GarminDB.Attributes.get_time(self.garmindb, 'wake_time')
+        GarminDB.MonitoringHourly.rollup_missing(self.mondb)
+
+        day_dates = [first_day_date + datetime.timedelta(day) for day in xrange((last_day_date - first_day_date).days + 1)]
+        self.calculate_sleeps(day_dates, sleep_period_start, sleep_period_stop)
+        self.calculate_resting_heartrates(day_dates, sleep_period_stop)
+
+        week_start_dates = []
+        month_start_dates = []
+        for day_date in day_dates:
+            self.calculate_day_stats(day_date)
+            # weeks are anchored on Jan 1st the same way summary() does it
+            year_start_date = datetime.date(day_date.year, 1, 1)
+            week_start_date = year_start_date + datetime.timedelta(min((day_date - year_start_date).days / 7, 51) * 7)
+            if week_start_date not in week_start_dates:
+                week_start_dates.append(week_start_date)
+            month_start_date = datetime.date(day_date.year, day_date.month, 1)
+            if month_start_date not in month_start_dates:
+                month_start_dates.append(month_start_date)
+
+        for week_start_date in week_start_dates:
+            self.calculate_week_stats(week_start_date)
+
+        for month_start_date in month_start_dates:
+            (year, month) = (month_start_date.year, month_start_date.month)
+            self.calculate_month_stats(month_start_date, datetime.date(year, month, calendar.monthrange(year, month)[1]))
+
+
 def usage(program):
     print '%s -s <sqlite db path> -m ...' % program
+    print '    --retain <table>:<days>,... : remove raw monitoring rows older than days, heart rate is kept downsampled'
+    print '        tables: monitoring, monitoring_hr, monitoring_intensity, monitoring_climb'
+    print '    --segment <name>,<activity id>[,<first record>,<last record>] : define a segment from an activity and list its efforts'
     sys.exit()
 
 def main(argv):
@@ -364,12 +432,14 @@ def main(argv):
     dates = False
     sleep_period_start = None
     sleep_period_stop = None
+    retention_days = {}
+    segment = None
 
     logger.setLevel(logging.INFO)
     root_logger.setLevel(logging.INFO)
 
     try:
-        opts, args = getopt.getopt(argv,"adi:t:S:s:", ["analyze", "debug=", "dates", "mysql=", "sleep=", "sqlite="])
+        opts, args = getopt.getopt(argv,"adg:i:r:t:S:s:", ["analyze", "debug=", "dates", "mysql=", "retain=", "segment=", "sleep=", "sqlite="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -389,6 +459,17 @@ def main(argv):
         elif opt in ("-d", "--dates"):
             logging.debug("Dates")
             dates = True
+        elif opt in ("-r", "--retain"):
+            logging.debug("Retain: " + arg)
+            for table_days in arg.split(','):
+                (table, days) = table_days.split(':')
+                retention_days[table] = int(days)
+        elif opt in ("-g", "--segment"):
+            logging.debug("Segment: " + arg)
+            segment_args = arg.split(',')
+            segment = (segment_args[0], int(segment_args[1]), None, None)
+            if len(segment_args) == 4:
+                segment = (segment_args[0], int(segment_args[1]), int(segment_args[2]), int(segment_args[3]))
         elif opt in ("-S", "--sleep"):
             logging.debug("Sleep: " + arg)
             sleep_args = arg.split(',')
@@ -413,6 +494,10 @@ def main(argv):
     analyze = Analyze(db_params_dict, debug - 1)
     if sleep_period_start and sleep_period_stop:
         analyze.set_sleep_period(sleep_period_start, sleep_period_stop)
+    if len(retention_days) > 0:
+        GarminDB.MonitoringRetention(analyze.mondb, retention_days).apply()
+    if segment:
+        analyze.segment_efforts(*segment)
     if dates:
         analyze.get_files_stats()
         analyze.get_weight_stats()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import os, sys, getopt, logging, datetime, json, shutil
+
+from sqlalchemy import inspect, types
+
+import HealthDB
+import GarminDB
+
+
+root_logger = logging.getLogger()
+logger = logging.getLogger(__file__)
+
+
+def to_date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+def to_time(value):
+    if value is None or isinstance(value, datetime.time):
+        return value
+    if isinstance(value, datetime.timedelta):
+        return (datetime.datetime.min + value).time()
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%H:%M:%S.%f').time()
+    return datetime.datetime.strptime(value, '%H:%M:%S').time()
+
+def to_unicode(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+#
+# Streams every table and view to Parquet or Arrow IPC files partitioned by year and month of the table's time
+# column: <output dir>/<db name>/<table>/year=YYYY/month=MM/part-<export time>.<format>. Rows are read off a raw
+# cursor in batch_size batches and written as they arrive, so memory use doesn't grow with the table. Tables without
+# a time column are written whole to <output dir>/<db name>/<table>/<table>.<format> on every export.
+#
+# In incremental mode only rows newer than the last exported row of each table are written, as new part files.
+# Rows updated in place after they were exported (the summaries for recent days) need a full export to refresh.
+#
+class Export():
+
+    batch_size = 10000
+    time_col_names = ['timestamp', 'start_time', 'day', 'first_day']
+    state_file_name = 'export_state.json'
+
+    def __init__(self, db_params_dict, output_dir, export_format, incremental, debug):
+        import pyarrow
+        self.pa = pyarrow
+        if export_format == 'parquet':
+            import pyarrow.parquet
+            self.pq = pyarrow.parquet
+        self.output_dir = output_dir
+        self.export_format = export_format
+        self.incremental = incremental
+        self.export_time = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.dbs = [
+            GarminDB.GarminDB(db_params_dict, debug),
+            GarminDB.MonitoringDB(db_params_dict, debug),
+            GarminDB.ActivitiesDB(db_params_dict, debug),
+            GarminDB.GarminSummaryDB(db_params_dict, debug),
+            HealthDB.SummaryDB(db_params_dict, debug),
+        ]
+        self.state_file = output_dir + '/' + self.state_file_name
+        self.state = {}
+        if incremental and os.path.isfile(self.state_file):
+            with open(self.state_file) as file:
+                self.state = json.load(file)
+
+    def save_state(self):
+        with open(self.state_file, 'w') as file:
+            json.dump(self.state, file, indent=4, sort_keys=True)
+
+    def column_type(self, sql_type):
+        # order matters, DateTime has to be checked before Date
+        if isinstance(sql_type, HealthDB.EpochDateTime):
+            return (self.pa.timestamp('us'), HealthDB.EpochDateTime.from_epoch)
+        if isinstance(sql_type, types.DateTime):
+            return (self.pa.timestamp('us'), HealthDB.db_datetime)
+        if isinstance(sql_type, types.Date):
+            return (self.pa.date32(), to_date)
+        if isinstance(sql_type, types.Time):
+            return (self.pa.time64('us'), to_time)
+        if isinstance(sql_type, types.Boolean):
+            return (self.pa.bool_(), None)
+        if isinstance(sql_type, types.Integer):
+            return (self.pa.int64(), None)
+        if isinstance(sql_type, (types.Float, types.Numeric)):
+            return (self.pa.float64(), None)
+        # strings and view columns with no declared type
+        return (self.pa.string(), to_unicode)
+
+    def table_columns(self, db, table_name):
+        columns = inspect(db.engine).get_columns(table_name)
+        col_names = [column['name'] for column in columns]
+        # the declared types of tables with models, columns like EpochDateTime reflect as their storage type
+        table = db.Base.metadata.tables.get(table_name)
+        if table is not None:
+            sql_types = [table.columns[name].type if name in table.columns else column['type'] for name, column in zip(col_names, columns)]
+        else:
+            sql_types = [column['type'] for column in columns]
+        col_types = [self.column_type(sql_type) for sql_type in sql_types]
+        return (col_names, sql_types, col_types)
+
+    def open_writer(self, path, schema):
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        logger.info("Writing " + path)
+        if self.export_format == 'parquet':
+            return self.pq.ParquetWriter(path, schema)
+        return self.pa.RecordBatchFileWriter(path, schema)
+
+    def write_rows(self, writer, schema, col_types, rows):
+        arrays = []
+        for index, (pa_type, converter) in enumerate(col_types):
+            values = [row[index] for row in rows]
+            if converter is not None:
+                values = [converter(value) for value in values]
+            arrays.append(self.pa.array(values, type=pa_type))
+        batch = self.pa.RecordBatch.from_arrays(arrays, schema.names)
+        if self.export_format == 'parquet':
+            writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+    def partition_key(self, value):
+        # value has been through the time column's converter: a date or datetime, or a string for view columns
+        # without a declared type
+        if value is None:
+            return None
+        if not isinstance(value, (datetime.date, datetime.datetime)):
+            value = datetime.datetime.strptime(value[:7], '%Y-%m')
+        return (value.year, value.month)
+
+    def partition_file(self, table_dir, key):
+        if key is None:
+            return '%s/undated/part-%s.%s' % (table_dir, self.export_time, self.export_format)
+        return '%s/year=%04d/month=%02d/part-%s.%s' % (table_dir, key[0], key[1], self.export_time, self.export_format)
+
+    def export_table(self, db, table_name):
+        (col_names, sql_types, col_types) = self.table_columns(db, table_name)
+        schema = self.pa.schema([self.pa.field(name, pa_type) for name, (pa_type, converter) in zip(col_names, col_types)])
+        time_col = next((name for name in self.time_col_names if name in col_names), None)
+        table_dir = '%s/%s/%s' % (self.output_dir, db.db_name, table_name)
+        db_state = self.state.setdefault(db.db_name, {})
+        if not self.incremental and os.path.isdir(table_dir):
+            # a full export replaces the earlier parts
+            shutil.rmtree(table_dir)
+        query_str = 'SELECT %s FROM %s' % (', '.join(col_names), table_name)
+        params = []
+        if time_col is not None:
+            last_exported = db_state.get(table_name)
+            if self.incremental and last_exported is not None:
+                query_str += ' WHERE %s > %s' % (time_col, db.param_marker())
+                params.append(last_exported)
+            query_str += ' ORDER BY ' + time_col
+            time_col_index = col_names.index(time_col)
+            time_col_converter = col_types[time_col_index][1]
+        rows_exported = 0
+        writer = None
+        writer_key = None
+        last_value = None
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(query_str, params)
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                if time_col is None:
+                    if writer is None:
+                        writer = self.open_writer('%s/%s.%s' % (table_dir, table_name, self.export_format), schema)
+                    self.write_rows(writer, schema, col_types, rows)
+                else:
+                    # rows are in time order, so each month's rows are a contiguous run
+                    run_start = 0
+                    for index, row in enumerate(rows):
+                        key = self.partition_key(time_col_converter(row[time_col_index]))
+                        if writer is None or key != writer_key:
+                            if writer is not None and index > run_start:
+                                self.write_rows(writer, schema, col_types, rows[run_start:index])
+                            if writer is not None:
+                                writer.close()
+                            writer = self.open_writer(self.partition_file(table_dir, key), schema)
+                            writer_key = key
+                            run_start = index
+                    self.write_rows(writer, schema, col_types, rows[run_start:])
+                    last_value = time_col_converter(rows[-1][time_col_index])
+                rows_exported += len(rows)
+            cursor.close()
+        finally:
+            if writer is not None:
+                writer.close()
+            connection.close()
+        if last_value is not None:
+            db_state[table_name] = str(db.db_param(sql_types[time_col_index], last_value))
+        logger.info("Exported %d rows from %s.%s" % (rows_exported, db.db_name, table_name))
+
+    def export(self):
+        for db in self.dbs:
+            inspector = inspect(db.engine)
+            for table_name in inspector.get_table_names() + inspector.get_view_names():
+                self.export_table(db, table_name)
+            self.save_state()
+
+
+def usage(program):
+    print '%s -s <sqlite db path> | -m <user,password,host> -o <output dir> ...' % program
+    print '    --format <parquet|arrow> : file format, parquet by default'
+    print '    --incremental : only export rows newer than the last export, otherwise the export is replaced'
+    print '    --trace <level> : turn on debug tracing'
+    sys.exit()
+
+def main(argv):
+    debug = 0
+    db_params_dict = {}
+    output_dir = None
+    export_format = 'parquet'
+    incremental = False
+
+    try:
+        opts, args = getopt.getopt(argv,"f:him:o:s:t:", ["format=", "incremental", "mysql=", "output_dir=", "sqlite=", "trace="])
+    except getopt.GetoptError:
+        usage(sys.argv[0])
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(sys.argv[0])
+        elif opt in ("-t", "--trace"):
+            debug = int(arg)
+        elif opt in ("-f", "--format"):
+            logging.debug("Format: %s" % arg)
+            export_format = arg
+        elif opt in ("-i", "--incremental"):
+            logging.debug("Incremental")
+            incremental = True
+        elif opt in ("-o", "--output_dir"):
+            logging.debug("Output dir: %s" % arg)
+            output_dir = arg
+        elif opt in ("-s", "--sqlite"):
+            logging.debug("Sqlite DB path: %s" % arg)
+            db_params_dict['db_type'] = 'sqlite'
+            db_params_dict['db_path'] = arg
+        elif opt in ("-m", "--mysql"):
+            logging.debug("Mysql DB string: %s" % arg)
+            db_args = arg.split(',')
+            db_params_dict['db_type'] = 'mysql'
+            db_params_dict['db_username'] = db_args[0]
+            db_params_dict['db_password'] = db_args[1]
+            db_params_dict['db_host'] = db_args[2]
+
+    if debug > 0:
+        root_logger.setLevel(logging.DEBUG)
+    else:
+        root_logger.setLevel(logging.INFO)
+
+    if len(db_params_dict) == 0 or output_dir is None:
+        print "Missing arguments:"
+        usage(sys.argv[0])
+    if export_format not in ['parquet', 'arrow']:
+        print "Unknown format: " + export_format
+        usage(sys.argv[0])
+
+    Export(db_params_dict, output_dir, export_format, incremental, debug).export()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,11 +4,9 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, string, logging, datetime, traceback, json, dateutil.parser
+import os, sys, getopt, string, logging, datetime, traceback, json, zipfile, tempfile, shutil
 
-import Fit
 import FileProcessor
-import FitFileProcessor
 import GarminDB
 
 
@@ -18,56 +16,126 @@ logger = logging.getLogger(__file__)
 
 class GarminWeightData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
+        self.input_dir = input_dir
         self.english_units = english_units
         self.debug = debug
         logger.info("Debug: %s English units: %s" % (str(debug), str(english_units)))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, 'weight_.*\.json')
         if input_dir:
-            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, 'weight_.*\.json', latest)
+            newer_than = None
+            if latest:
+                newer_than = GarminDB.ImportCursors.get_cursor(GarminDB.GarminDB(db_params_dict), 'weight', input_dir)
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, 'weight_.*\.json', latest, newer_than=newer_than)
 
     def file_count(self):
         return len(self.file_names)
 
-    def process_files(self, db_params_dict):
-        garmindb = GarminDB.GarminDB(db_params_dict)
+    def process_file(self, garmindb, file_name):
+        import dateutil.parser
+        if GarminDB.ImportCursors.file_applied(garmindb, 'weight', file_name):
+            logger.info("Skipping already imported weight file: " + file_name)
+            return
         def json_parser(entry):
             if 'timestamp' in entry:
                 entry['timestamp'] = dateutil.parser.parse(entry['timestamp'])
             return entry
-        for file_name in self.file_names:
-            json_data = json.load(open(file_name), object_hook=json_parser)
-            for sample in json_data:
-                GarminDB.Weight.create_or_update(garmindb, sample)
+        with open(file_name) as json_file:
+            json_data = json.load(json_file, object_hook=json_parser)
+        if len(json_data) > 0:
+            GarminDB.Weight.create_or_update_batch(garmindb, json_data)
             logger.info("DB updated with weight data for %s (%d)" % (str(json_data[0]['timestamp']), len(json_data)))
+        GarminDB.ImportCursors.set_file_applied(garmindb, 'weight', file_name)
+
+    def process_files(self, db_params_dict):
+        garmindb = GarminDB.GarminDB(db_params_dict)
+        for file_name in self.file_names:
+            self.process_file(garmindb, file_name)
+        if self.input_dir:
+            GarminDB.ImportCursors.advance_cursor(garmindb, 'weight', self.input_dir, [(os.path.getmtime(file_name), file_name) for file_name in self.file_names])
 
 
 class GarminFitData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    # FIT files, or zip archives of FIT files as downloaded from Garmin Connect
+    file_regex = '.*\.(fit|zip)'
+    # archive members are unpacked to memory backed storage when there is some
+    scratch_root = '/dev/shm'
+
+    def __init__(self, db_params_dict, input_file, input_dir, latest, recursive, english_units, debug):
+        self.input_dir = input_dir
         self.english_units = english_units
         self.debug = debug
         logger.info("Debug: %s English units: %s" % (str(debug), str(english_units)))
         if input_file:
-            self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.fit')
+            self.file_names = FileProcessor.FileProcessor.match_file(input_file, self.file_regex)
         if input_dir:
-            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.fit', latest)
+            newer_than = None
+            if latest:
+                newer_than = GarminDB.ImportCursors.get_cursor(GarminDB.GarminDB(db_params_dict), 'fit', input_dir)
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, self.file_regex, latest, recursive, newer_than)
 
     def file_count(self):
         return len(self.file_names)
 
+    #
+    # Import the FIT files in a zip archive without unpacking it into the input dir, the archive stays the only copy.
+    # Fit.File (in the Fit submodule) only decodes from a path, so each member goes through a scratch file in memory
+    # backed storage that is removed once it's imported.
+    # Members that fail are logged and skipped, the ones that failed are returned.
+    #
+    def process_archive(self, fp, archive_name):
+        import Fit
+        logger.info("Processing archive: " + archive_name)
+        failed_members = []
+        if os.path.isdir(self.scratch_root):
+            scratch_dir = tempfile.mkdtemp(dir=self.scratch_root)
+        else:
+            scratch_dir = tempfile.mkdtemp()
+        try:
+            with zipfile.ZipFile(archive_name, 'r') as archive:
+                for member in archive.namelist():
+                    if member.endswith('.fit'):
+                        try:
+                            member_file_name = archive.extract(member, scratch_dir)
+                            fp.write_file(Fit.File(member_file_name, self.english_units))
+                            os.remove(member_file_name)
+                        except Exception as e:
+                            logger.error("Failed to import %s from %s: %s" % (member, archive_name, str(e)))
+                            failed_members.append(member)
+        finally:
+            shutil.rmtree(scratch_dir)
+        return failed_members
+
     def process_files(self, db_params_dict):
+        import Fit, FitFileProcessor
         fp = FitFileProcessor.FitFileProcessor(db_params_dict, self.english_units, self.debug)
+        failed_file_names = []
         for file_name in self.file_names:
-            fp.write_file(Fit.File(file_name, self.english_units))
-
+            try:
+                if zipfile.is_zipfile(file_name):
+                    if len(self.process_archive(fp, file_name)) > 0:
+                        failed_file_names.append(file_name)
+                else:
+                    fp.write_file(Fit.File(file_name, self.english_units))
+            except Exception as e:
+                logger.error("Failed to import %s: %s" % (file_name, str(e)))
+                failed_file_names.append(file_name)
+        if fp.garmin_mon_db.partitioned:
+            fp.garmin_mon_db.close_partitions()
+        if self.input_dir:
+            GarminDB.ImportCursors.advance_cursor(fp.garmin_db, 'fit', self.input_dir, [(os.path.getmtime(file_name), file_name) for file_name in self.file_names], failed_file_names)
 
 
 def usage(program):
     print '%s [-s <sqlite db path> | -m <user,password,host>] [-i <fit_inputfile> | -d <fit_input_dir>] ...' % program
     print '    --trace : turn on debug tracing'
     print '    --english : units - use feet, lbs, etc'
+    print '    --latest : only import files newer than the last import from the same directory'
+    print '    --recursive : also import fit files from subdirectories of the fit input dir'
+    print '    fit input may be FIT files or zip archives of FIT files'
+    print '    --partition_by_year : store monitoring data in a sqlite DB file per year, stays on once used'
     print '    '
     sys.exit()
 
@@ -79,11 +147,12 @@ def main(argv):
     weight_input_dir = None
     weight_input_file = None
     latest = False
+    recursive = False
     db_params_dict = {}
 
     try:
-        opts, args = getopt.getopt(argv,"f:F:elm:s:tw:W:",
-            ["trace", "english", "fit_input_dir=", "fit_input_file=", "latest", "mysql=", "sqlite=", "weight_input_dir=", "weight_input_file="])
+        opts, args = getopt.getopt(argv,"f:F:elm:rs:tw:W:y",
+            ["trace", "english", "fit_input_dir=", "fit_input_file=", "latest", "mysql=", "partition_by_year", "recursive", "sqlite=", "weight_input_dir=", "weight_input_file="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -102,6 +171,10 @@ def main(argv):
             fit_input_file = arg
         elif opt in ("-l", "--latest"):
             latest = True
+        elif opt in ("-r", "--recursive"):
+            recursive = True
+        elif opt in ("-y", "--partition_by_year"):
+            db_params_dict['partition_by_year'] = True
         elif opt in ("-w", "--weight_input_dir"):
             logging.debug("Weight input dir: %s" % arg)
             weight_input_dir = arg
@@ -128,17 +201,17 @@ def main(argv):
     if not (fit_input_file or fit_input_dir) and not (weight_input_file or weight_input_dir):
         print "Missing or incorrect arguments: Fit or weight input files or directory"
         usage(sys.argv[0])
-    if len(db_params_dict) == 0:
+    if 'db_type' not in db_params_dict:
         print "Missing or incorrect arguments: db params"
         usage(sys.argv[0])
 
     if weight_input_file or weight_input_dir:
-        gwd = GarminWeightData(weight_input_file, weight_input_dir, latest, english_units, debug)
+        gwd = GarminWeightData(db_params_dict, weight_input_file, weight_input_dir, latest, english_units, debug)
         if gwd.file_count() > 0:
             gwd.process_files(db_params_dict)
 
     if fit_input_file or fit_input_dir:
-        gfd = GarminFitData(fit_input_file, fit_input_dir, latest, english_units, debug)
+        gfd = GarminFitData(db_params_dict, fit_input_file, fit_input_dir, latest, recursive, english_units, debug)
         if gfd.file_count() > 0:
             gfd.process_files(db_params_dict)
 
@@ -4,11 +4,17 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, re, string, logging, datetime, traceback, json, tcxparser, dateutil.parser
+import os, sys, getopt, re, string, logging, datetime, traceback, multiprocessing
+
+# use the faster parser when it's installed
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 import Fit
 import FileProcessor
-import FitFileProcessor
+import TcxFile
 import GarminDB
 
 
@@ -24,115 +30,220 @@ def pace_to_time(pace):
 
 class GarminFitData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
+        self.input_dir = input_dir
         self.english_units = english_units
         self.debug = debug
         logger.info("Debug: %s English units: %s" % (str(debug), str(english_units)))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.fit')
         if input_dir:
-            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.fit', latest)
+            newer_than = None
+            if latest:
+                newer_than = GarminDB.ImportCursors.get_cursor(GarminDB.GarminDB(db_params_dict), 'fit', input_dir)
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.fit', latest, newer_than=newer_than)
 
     def file_count(self):
         return len(self.file_names)
 
     def process_files(self, db_params_dict):
+        import FitFileProcessor
         fp = FitFileProcessor.FitFileProcessor(db_params_dict, self.english_units, self.debug)
+        failed_file_names = []
         for file_name in self.file_names:
             try:
                 fp.write_file(Fit.File(file_name, self.english_units))
             except ValueError as e:
                 logger.info("Failed to parse %s: %s" % (file_name, str(e)))
+                failed_file_names.append(file_name)
             except IndexError as e:
                 logger.info("Failed to parse %s: %s" % (file_name, str(e)))
+                failed_file_names.append(file_name)
+        fp.garmin_act_db.update_track_tables()
+        if self.input_dir:
+            GarminDB.ImportCursors.advance_cursor(fp.garmin_db, 'fit', self.input_dir, [(os.path.getmtime(file_name), file_name) for file_name in self.file_names], failed_file_names)
 
 
 class GarminTcxData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    # trackpoints are written in batches of this many while the file is parsed
+    record_batch_size = 1000
+
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
+        self.input_dir = input_dir
         self.english_units = english_units
         self.debug = debug
         logger.info("Debug: %s English units: %s" % (str(debug), str(english_units)))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.tcx')
         if input_dir:
-            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.tcx', latest)
+            newer_than = None
+            if latest:
+                newer_than = GarminDB.ImportCursors.get_cursor(GarminDB.GarminDB(db_params_dict), 'tcx', input_dir)
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.tcx', latest, newer_than=newer_than)
 
     def file_count(self):
         return len(self.file_names)
 
+    def convert_distance(self, meters):
+        if meters is None:
+            return None
+        if self.english_units:
+            return Fit.Conversions.meters_to_miles(meters)
+        return meters / 1000.0
+
+    def convert_altitude(self, meters):
+        if meters is not None and self.english_units:
+            return Fit.Conversions.meters_to_feet(meters)
+        return meters
+
+    def convert_speed(self, meters_per_sec):
+        if meters_per_sec is None:
+            return None
+        return self.convert_distance(meters_per_sec * 3600)
+
+    def write_lap(self, lap_number, tcx_lap):
+        elapsed_secs = tcx_lap['elapsed_secs']
+        lap = {
+            'activity_id'       : self.activity_id,
+            'lap'               : lap_number,
+            'start_time'        : tcx_lap['start_time'],
+            'stop_time'         : tcx_lap['stop_time'],
+            'elapsed_time'      : Fit.Conversions.secs_to_dt_time(int(elapsed_secs)) if elapsed_secs is not None else None,
+            'start_lat'         : tcx_lap['start_lat'],
+            'start_long'        : tcx_lap['start_long'],
+            'stop_lat'          : tcx_lap['stop_lat'],
+            'stop_long'         : tcx_lap['stop_long'],
+            'distance'          : self.convert_distance(tcx_lap['distance']),
+            'avg_hr'            : tcx_lap['avg_hr'],
+            'max_hr'            : tcx_lap['max_hr'],
+            'calories'          : tcx_lap['calories'],
+            'avg_cadence'       : tcx_lap['avg_cadence'],
+            'avg_speed'         : self.convert_speed(tcx_lap['avg_speed']),
+            'max_speed'         : self.convert_speed(tcx_lap['max_speed']),
+        }
+        self.laps.append(lap)
+
+    def write_trackpoint(self, record_number, trackpoint):
+        record = {
+            'activity_id'       : self.activity_id,
+            'record'            : record_number,
+            'timestamp'         : trackpoint['timestamp'],
+            'position_lat'      : trackpoint['position_lat'],
+            'position_long'     : trackpoint['position_long'],
+            'distance'          : self.convert_distance(trackpoint['distance']),
+            'cadence'           : trackpoint['cadence'],
+            'hr'                : trackpoint['hr'],
+            'alititude'         : self.convert_altitude(trackpoint['altitude']),
+            'speed'             : self.convert_speed(trackpoint['speed']),
+        }
+        self.records.append(record)
+        if len(self.records) >= self.record_batch_size:
+            self.flush_records()
+
+    def flush_records(self):
+        GarminDB.ActivityRecords.create_or_update_batch(self.garmin_act_db, self.records, True)
+        self.records = []
+
+    def process_file(self, file_name):
+        logger.info("Processing file: " + file_name)
+        # the file entry, and so the activity id, is named after the file: write it before the laps and records
+        GarminDB.File.find_or_create(self.garmin_db, {'name' : file_name, 'type' : 'tcx'})
+        self.activity_id = GarminDB.gc_id_from_path(file_name)
+        self.garmin_act_db.invalidate_track(self.activity_id)
+        self.laps = []
+        self.records = []
+        try:
+            tcx = TcxFile.TcxFile(file_name, self.write_lap, self.write_trackpoint)
+            self.flush_records()
+            GarminDB.ActivityLaps.create_or_update_batch(self.garmin_act_db, self.laps, True)
+        except:
+            # don't leave part of the activity behind
+            self.garmin_act_db.delete_activity_data(self.activity_id)
+            raise
+        end_time = tcx.completed_at
+        start_time = tcx.started_at
+        manufacturer = 'Unknown'
+        product = tcx.creator
+        if product is not None:
+            match = re.search('Microsoft', product)
+            if match:
+                manufacturer = 'Microsoft'
+        serial_number = tcx.creator_version
+        if serial_number is None or serial_number ==0:
+            serial_number = GarminDB.Device.unknown_device_serial_number
+        device = {
+            'serial_number'     : serial_number,
+            'timestamp'         : start_time,
+            'manufacturer'      : manufacturer,
+            'product'           : product,
+            'hardware_version'  : None,
+        }
+        GarminDB.Device.create_or_update_not_none(self.garmin_db, device)
+        file = {
+            'name'          : file_name,
+            'type'          : 'tcx',
+            'serial_number' : serial_number,
+        }
+        GarminDB.File.create_or_update_not_none(self.garmin_db, file)
+        activity_id = GarminDB.File.get(self.garmin_db, file_name)
+        distance = self.convert_distance(tcx.distance)
+        activity = {
+            'activity_id'               : activity_id,
+            'start_time'                : start_time,
+            'stop_time'                 : end_time,
+            'laps'                      : tcx.laps,
+            # 'sport'                     : tcx.activity_type,
+            'start_lat'                 : tcx.start_latitude,
+            'start_long'                : tcx.start_longitude,
+            'stop_lat'                  : tcx.end_latitude,
+            'stop_long'                 : tcx.end_longitude,
+            'distance'                  : distance,
+            'avg_hr'                    : tcx.hr_avg,
+            'max_hr'                    : tcx.hr_max,
+            'calories'                  : tcx.calories,
+            'max_cadence'               : tcx.cadence_max,
+            'avg_cadence'               : tcx.cadence_avg,
+            'ascent'                    : self.convert_altitude(tcx.ascent),
+            'descent'                   : self.convert_altitude(tcx.descent),
+        }
+        activity_not_zero = {key : value for (key,value) in activity.iteritems() if value}
+        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity_not_zero)
+        GarminDB.ActivityMetrics.update(self.garmin_act_db, activity_id, self.english_units)
+
     def process_files(self, db_params_dict):
-        garmin_db = GarminDB.GarminDB(db_params_dict, self.debug - 1)
-        garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug)
+        self.garmin_db = GarminDB.GarminDB(db_params_dict, self.debug - 1)
+        self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug)
+        failed_file_names = []
         for file_name in self.file_names:
-            logger.info("Processing file: " + file_name)
-            tcx = tcxparser.TCXParser(file_name)
-            end_time = dateutil.parser.parse(tcx.completed_at)
-            start_time = dateutil.parser.parse(tcx.started_at)
-            manufacturer = 'Unknown'
-            product = tcx.creator
-            if product is not None:
-                match = re.search('Microsoft', product)
-                if match:
-                    manufacturer = 'Microsoft'
-            serial_number = tcx.creator_version
-            if serial_number is None or serial_number ==0:
-                serial_number = GarminDB.Device.unknown_device_serial_number
-            device = {
-                'serial_number'     : serial_number,
-                'timestamp'         : start_time,
-                'manufacturer'      : manufacturer,
-                'product'           : product,
-                'hardware_version'  : None,
-            }
-            GarminDB.Device.create_or_update_not_none(garmin_db, device)
-            file = {
-                'name'          : file_name,
-                'type'          : 'tcx',
-                'serial_number' : serial_number,
-            }
-            GarminDB.File.find_or_create(garmin_db, file)
-            activity_id = GarminDB.File.get(garmin_db, file_name)
-            if self.english_units and tcx.distance_units == 'meters':
-                distance = Fit.Conversions.meters_to_miles(tcx.distance)
-                ascent = Fit.Conversions.meters_to_feet(tcx.ascent)
-                descent = Fit.Conversions.meters_to_feet(tcx.descent)
-            else:
-                distance = tcx.distance / 1000.0
-                ascent = tcx.ascent / 1000.0
-                descent = tcx.descent / 1000.0
-            activity = {
-                'activity_id'               : activity_id,
-                'start_time'                : start_time,
-                'stop_time'                 : end_time,
-                'laps'                      : len(tcx.activity.Lap),
-                # 'sport'                     : tcx.activity_type,
-                'start_lat'                 : tcx.start_latitude,
-                'start_long'                : tcx.start_longitude,
-                'stop_lat'                  : tcx.end_latitude,
-                'stop_long'                 : tcx.end_longitude,
-                'distance'                  : distance,
-                'avg_hr'                    : tcx.hr_avg,
-                'max_hr'                    : tcx.hr_max,
-                'calories'                  : tcx.calories,
-                'max_cadence'               : tcx.cadence_max,
-                'avg_cadence'               : tcx.cadence_avg,
-                #'ascent'                    : ascent,
-                #'descent'                   : descent
-            }
-            activity_not_zero = {key : value for (key,value) in activity.iteritems() if value}
-            GarminDB.Activities.create_or_update_not_none(garmin_act_db, activity_not_zero)
+            try:
+                self.process_file(file_name)
+            except Exception as e:
+                logger.error("Failed to import %s: %s" % (file_name, str(e)))
+                failed_file_names.append(file_name)
+        self.garmin_act_db.update_track_tables()
+        if self.input_dir:
+            GarminDB.ImportCursors.advance_cursor(self.garmin_db, 'tcx', self.input_dir, [(os.path.getmtime(file_name), file_name) for file_name in self.file_names], failed_file_names)
 
 class GarminJsonData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    # activities written per transaction
+    batch_size = 100
+    # files handed to a parse worker at a time
+    chunk_size = 16
+
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
+        self.input_dir = input_dir
         self.english_units = english_units
         self.debug = debug
         logger.info("Debug: %s" % str(debug))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.json')
         if input_dir:
-            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.json', latest)
+            newer_than = None
+            if latest:
+                newer_than = GarminDB.ImportCursors.get_cursor(GarminDB.GarminDB(db_params_dict), 'json', input_dir)
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.json', latest, newer_than=newer_than)
 
     def file_count(self):
         return len(self.file_names)
@@ -146,14 +257,14 @@ class GarminJsonData():
         except KeyError as e:
             logger.debug("JSON %s[%s] not found in %s: %s" % (fieldname, format_str, repr(json), str(e)))
 
-    def process_running(self, activity_id, activity_summary):
+    def process_running(self, activity, activity_summary):
         avg_vertical_oscillation = Fit.Conversions.centimeters_to_meters(self.get_garmin_json_data(activity_summary, 'WeightedMeanVerticalOscillation', 'value', float))
         avg_step_length = self.get_garmin_json_data(activity_summary, 'WeightedMeanStrideLength', 'value', float)
         if self.english_units:
             avg_vertical_oscillation = Fit.Conversions.meters_to_feet(avg_vertical_oscillation)
             avg_step_length = Fit.Conversions.meters_to_feet(avg_step_length)
         run = {
-                'activity_id'               : activity_id,
+                'activity_id'               : activity['activity_id'],
                 'steps'                     : self.get_garmin_json_data(activity_summary, 'SumStep', 'value', float),
                 'avg_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanPace', 'display')),
                 'avg_moving_pace'           : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanMovingPace', 'display')),
@@ -168,51 +279,47 @@ class GarminJsonData():
                 'power'                     : self.get_garmin_json_data(activity_summary, 'DirectFunctionalThresholdPower', 'value', float),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'DirectVO2Max', 'value', float),
         }
-        GarminDB.RunActivities.create_or_update_not_none(self.garmin_act_db, run)
+        return (GarminDB.RunActivities, run)
 
-    def process_treadmill_running(self, activity_id, activity_summary):
-        return self.process_running(activity_id, activity_summary)
+    def process_treadmill_running(self, activity, activity_summary):
+        return self.process_running(activity, activity_summary)
 
-    def process_walking(self, activity_id, activity_summary):
+    def process_walking(self, activity, activity_summary):
         walk = {
-                'activity_id'               : activity_id,
+                'activity_id'               : activity['activity_id'],
                 'steps'                     : self.get_garmin_json_data(activity_summary, 'SumStep', 'value', float),
                 'avg_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanPace', 'display')),
                 'max_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'MaxPace', 'display')),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'DirectVO2Max', 'value', float),
         }
-        GarminDB.WalkActivities.create_or_update_not_none(self.garmin_act_db, walk)
+        return (GarminDB.WalkActivities, walk)
 
-    def process_hiking(self, activity_id, activity_summary):
-        return self.process_walking(activity_id, activity_summary)
+    def process_hiking(self, activity, activity_summary):
+        return self.process_walking(activity, activity_summary)
 
-    def process_paddling(self, activity_id, activity_summary):
-        activity = {
-                'activity_id'               : activity_id,
+    def process_paddling(self, activity, activity_summary):
+        activity.update({
                 'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'WeightedMeanStrokeCadence', 'value', float),
                 'max_cadence'               : self.get_garmin_json_data(activity_summary, 'MaxStrokeCadence', 'value', float),
-        }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        })
         avg_stroke_distance = self.get_garmin_json_data(activity_summary, 'WeightedMeanStrokeDistance', 'value', float)
         if self.english_units:
             avg_stroke_distance = Fit.Conversions.meters_to_feet(avg_stroke_distance)
         paddle = {
-                'activity_id'               : activity_id,
+                'activity_id'               : activity['activity_id'],
                 'strokes'                   : self.get_garmin_json_data(activity_summary, 'SumStrokes', 'value', float),
                 'avg_stroke_distance'       : avg_stroke_distance,
                 'power'                     : self.get_garmin_json_data(activity_summary, 'DirectFunctionalThresholdPower', 'value', float),
         }
-        GarminDB.PaddleActivities.create_or_update_not_none(self.garmin_act_db, paddle)
+        return (GarminDB.PaddleActivities, paddle)
 
-    def process_cycling(self, activity_id, activity_summary):
-        activity = {
-                'activity_id'               : activity_id,
+    def process_cycling(self, activity, activity_summary):
+        activity.update({
                 'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'WeightedMeanBikeCadence', 'value', float),
                 'max_cadence'               : self.get_garmin_json_data(activity_summary, 'MaxBikeCadence', 'value', float),
-        }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        })
         ride = {
-                'activity_id'               : activity_id,
+                'activity_id'               : activity['activity_id'],
                 'strokes'                   : self.get_garmin_json_data(activity_summary, 'SumStrokes', 'value', float),
                 'avg_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanPace', 'display')),
                 'avg_moving_pace'           : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanMovingPace', 'display')),
@@ -220,77 +327,130 @@ class GarminJsonData():
                 'power'                     : self.get_garmin_json_data(activity_summary, 'DirectFunctionalThresholdPower', 'value', float),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'DirectVO2Max', 'value', float),
         }
-        GarminDB.CycleActivities.create_or_update_not_none(self.garmin_act_db, ride)
+        return (GarminDB.CycleActivities, ride)
 
-    def process_mountain_biking(self, activity_id, activity_summary):
-        return self.process_cycling(activity_id, activity_summary)
+    def process_mountain_biking(self, activity, activity_summary):
+        return self.process_cycling(activity, activity_summary)
 
-    def process_elliptical(self, activity_id, activity_summary):
+    def process_elliptical(self, activity, activity_summary):
         if activity_summary is not None:
-            activity = {
-                    'activity_id'               : activity_id,
+            activity.update({
                     'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'WeightedMeanRunCadence', 'value', float),
                     'max_cadence'               : self.get_garmin_json_data(activity_summary, 'MaxRunCadence', 'value', float),
-            }
-            GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+            })
             workout = {
-                    'activity_id'               : activity_id,
+                    'activity_id'               : activity['activity_id'],
                     'elliptical_distance'       : self.get_garmin_json_data(activity_summary, 'SumDistance', 'value', float),
                     'steps'                     : self.get_garmin_json_data(activity_summary, 'SumStep', 'value', float),
                     'avg_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'WeightedMeanPace', 'display')),
                     'max_pace'                  : pace_to_time(self.get_garmin_json_data(activity_summary, 'MaxPace', 'display')),
                     'power'                     : self.get_garmin_json_data(activity_summary, 'DirectFunctionalThresholdPower', 'value', float),
             }
-            GarminDB.EllipticalActivities.create_or_update_not_none(self.garmin_act_db, workout)
+            return (GarminDB.EllipticalActivities, workout)
+
+    #
+    # Parse an activity file into the Activities row and the (sport table, row) pair for it, if any.
+    # Doesn't touch the DB so it can run in a worker process.
+    #
+    def parse_file(self, file_name):
+        with open(file_name) as json_file:
+            json_data = json.load(json_file)
+        activity_id = json_data['activityId']
+        sub_sport = json_data['activityType']['key']
+
+        activity = {
+            'activity_id'               : activity_id,
+            'name'                      : json_data['activityName'],
+            'description'               : json_data['activityDescription'],
+            'type'                      : self.get_garmin_json_data(json_data, 'eventType', 'display'),
+            'sport'                     : self.get_garmin_json_data(json_data['activityType'], 'parent', 'key'),
+            'sub_sport'                 : sub_sport,
+        }
+        activity_summary = json_data.get('activitySummary', None)
+        if activity_summary is not None:
+            activity.update({
+                'start_time'                : datetime.datetime.strptime(self.get_garmin_json_data(activity_summary, 'BeginTimestamp', 'value'), "%Y-%m-%dT%H:%M:%S.%fZ"),
+                'stop_time'                 : datetime.datetime.strptime(self.get_garmin_json_data(activity_summary, 'EndTimestamp', 'value'), "%Y-%m-%dT%H:%M:%S.%fZ"),
+                'elapsed_time'              : Fit.Conversions.secs_to_dt_time(int(self.get_garmin_json_data(activity_summary, 'SumElapsedDuration', 'value', float))),
+                'moving_time'               : Fit.Conversions.secs_to_dt_time(int(self.get_garmin_json_data(activity_summary, 'SumMovingDuration', 'value', float))),
+                'start_lat'                 : self.get_garmin_json_data(activity_summary, 'BeginLatitude', 'value', float),
+                'start_long'                : self.get_garmin_json_data(activity_summary, 'BeginLongitude', 'value', float),
+                'stop_lat'                  : self.get_garmin_json_data(activity_summary, 'EndLatitude', 'value', float),
+                'stop_long'                 : self.get_garmin_json_data(activity_summary, 'EndLongitude', 'value', float),
+                'distance'                  : self.get_garmin_json_data(activity_summary, 'SumDistance', 'value', float),
+                #'laps'                      : self.get_garmin_json_data(json_data, 'totalLaps'),
+                'avg_hr'                    : self.get_garmin_json_data(activity_summary, 'WeightedMeanHeartRate', 'value', float),
+                'max_hr'                    : self.get_garmin_json_data(activity_summary, 'MaxHeartRate', 'value', float),
+                'calories'                  : self.get_garmin_json_data(activity_summary, 'SumEnergy', 'value', float),
+                'avg_speed'                 : self.get_garmin_json_data(activity_summary, 'WeightedMeanSpeed', 'value', float),
+                'avg_moving_speed'          : self.get_garmin_json_data(activity_summary, 'WeightedMeanMovingSpeed', 'value', float),
+                'max_speed'                 : self.get_garmin_json_data(activity_summary, 'MaxSpeed', 'value', float),
+                'ascent'                    : self.get_garmin_json_data(activity_summary, 'GainElevation', 'value', float),
+                'descent'                   : self.get_garmin_json_data(activity_summary, 'LossElevation', 'value', float),
+                'max_temperature'           : self.get_garmin_json_data(activity_summary, 'MaxAirTemperature', 'value', float),
+                'min_temperature'           : self.get_garmin_json_data(activity_summary, 'MinAirTemperature', 'value', float),
+                'avg_temperature'           : self.get_garmin_json_data(activity_summary, 'WeightedMeanAirTemperature', 'value', float),
+                'training_effect'           : self.get_garmin_json_data(activity_summary, 'SumTrainingEffect', 'value', float),
+                'anaerobic_training_effect' : self.get_garmin_json_data(activity_summary, 'SumAnaerobicTrainingEffect', 'value', float),
+            })
+        sport_activity = None
+        try:
+            function = getattr(self, 'process_' + sub_sport)
+            sport_activity = function(activity, activity_summary)
+        except AttributeError:
+            logger.info("No sport handler for type %s from %s" % (sub_sport, activity_id))
+        return (activity, sport_activity)
+
+    def write_activities(self, parsed_activities):
+        # the whole batch goes in one transaction with one upsert per table per activity
+        session = self.garmin_act_db.session()
+        for (activity, sport_activity) in parsed_activities:
+            GarminDB.Activities._create_or_update(self.garmin_act_db, session, activity, True)
+            if sport_activity is not None:
+                (sport_table, sport_values) = sport_activity
+                sport_table._create_or_update(self.garmin_act_db, session, sport_values, True)
+        GarminDB.DB.commit(session)
+
+    def process_file(self, file_name):
+        self.write_activities([self.parse_file(file_name)])
 
     def process_files(self, db_params_dict):
         self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug - 1)
-        for file_name in self.file_names:
-            json_data = json.load(open(file_name))
-            activity_id = json_data['activityId']
-            sub_sport = json_data['activityType']['key']
-
-            activity = {
-                'activity_id'               : activity_id,
-                'name'                      : json_data['activityName'],
-                'description'               : json_data['activityDescription'],
-                'type'                      : self.get_garmin_json_data(json_data, 'eventType', 'display'),
-                'sport'                     : self.get_garmin_json_data(json_data['activityType'], 'parent', 'key'),
-                'sub_sport'                 : sub_sport,
-            }
-            activity_summary = json_data.get('activitySummary', None)
-            if activity_summary is not None:
-                activity.update({
-                    'start_time'                : datetime.datetime.strptime(self.get_garmin_json_data(activity_summary, 'BeginTimestamp', 'value'), "%Y-%m-%dT%H:%M:%S.%fZ"),
-                    'stop_time'                 : datetime.datetime.strptime(self.get_garmin_json_data(activity_summary, 'EndTimestamp', 'value'), "%Y-%m-%dT%H:%M:%S.%fZ"),
-                    'elapsed_time'              : Fit.Conversions.secs_to_dt_time(int(self.get_garmin_json_data(activity_summary, 'SumElapsedDuration', 'value', float))),
-                    'moving_time'               : Fit.Conversions.secs_to_dt_time(int(self.get_garmin_json_data(activity_summary, 'SumMovingDuration', 'value', float))),
-                    'start_lat'                 : self.get_garmin_json_data(activity_summary, 'BeginLatitude', 'value', float),
-                    'start_long'                : self.get_garmin_json_data(activity_summary, 'BeginLongitude', 'value', float),
-                    'stop_lat'                  : self.get_garmin_json_data(activity_summary, 'EndLatitude', 'value', float),
-                    'stop_long'                 : self.get_garmin_json_data(activity_summary, 'EndLongitude', 'value', float),
-                    'distance'                  : self.get_garmin_json_data(activity_summary, 'SumDistance', 'value', float),
-                    #'laps'                      : self.get_garmin_json_data(json_data, 'totalLaps'),
-                    'avg_hr'                    : self.get_garmin_json_data(activity_summary, 'WeightedMeanHeartRate', 'value', float),
-                    'max_hr'                    : self.get_garmin_json_data(activity_summary, 'MaxHeartRate', 'value', float),
-                    'calories'                  : self.get_garmin_json_data(activity_summary, 'SumEnergy', 'value', float),
-                    'avg_speed'                 : self.get_garmin_json_data(activity_summary, 'WeightedMeanSpeed', 'value', float),
-                    'avg_moving_speed'          : self.get_garmin_json_data(activity_summary, 'WeightedMeanMovingSpeed', 'value', float),
-                    'max_speed'                 : self.get_garmin_json_data(activity_summary, 'MaxSpeed', 'value', float),
-                    'ascent'                    : self.get_garmin_json_data(activity_summary, 'GainElevation', 'value', float),
-                    'descent'                   : self.get_garmin_json_data(activity_summary, 'LossElevation', 'value', float),
-                    'max_temperature'           : self.get_garmin_json_data(activity_summary, 'MaxAirTemperature', 'value', float),
-                    'min_temperature'           : self.get_garmin_json_data(activity_summary, 'MinAirTemperature', 'value', float),
-                    'avg_temperature'           : self.get_garmin_json_data(activity_summary, 'WeightedMeanAirTemperature', 'value', float),
-                    'training_effect'           : self.get_garmin_json_data(activity_summary, 'SumTrainingEffect', 'value', float),
-                    'anaerobic_training_effect' : self.get_garmin_json_data(activity_summary, 'SumAnaerobicTrainingEffect', 'value', float),
-                })
-            GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
-            try:
-                function = getattr(self, 'process_' + sub_sport)
-                function(activity_id, activity_summary)
-            except AttributeError:
-                logger.info("No sport handler for type %s from %s" % (sub_sport, activity_id))
+        pool = multiprocessing.Pool(initializer=init_json_parser, initargs=(self.english_units, self.debug))
+        batch = []
+        failed_file_names = []
+        for index, parsed_activity in enumerate(pool.imap(parse_json_file, self.file_names, self.chunk_size)):
+            if parsed_activity is None:
+                failed_file_names.append(self.file_names[index])
+                continue
+            batch.append(parsed_activity)
+            if len(batch) >= self.batch_size:
+                self.write_activities(batch)
+                batch = []
+        if len(batch) > 0:
+            self.write_activities(batch)
+        pool.close()
+        pool.join()
+        self.garmin_act_db.update_track_tables()
+        if self.input_dir:
+            GarminDB.ImportCursors.advance_cursor(GarminDB.GarminDB(db_params_dict, self.debug - 1), 'json', self.input_dir,
+                [(os.path.getmtime(file_name), file_name) for file_name in self.file_names], failed_file_names)
+
+
+# per worker process parser used by GarminJsonData.process_files
+json_parser = None
+
+def init_json_parser(english_units, debug):
+    global json_parser
+    json_parser = GarminJsonData(None, None, None, False, english_units, debug)
+
+def parse_json_file(file_name):
+    # None for files that fail, so the rest of the import carries on
+    try:
+        return json_parser.parse_file(file_name)
+    except Exception as e:
+        logger.error("Failed to parse %s: %s" % (file_name, str(e)))
+        return None
 
 
 def usage(program):
@@ -348,15 +508,15 @@ def main(argv):
         print "Missing arguments:"
         usage(sys.argv[0])
 
-    gjd = GarminJsonData(input_file, input_dir, latest, english_units, debug)
+    gjd = GarminJsonData(db_params_dict, input_file, input_dir, latest, english_units, debug)
     if gjd.file_count() > 0:
         gjd.process_files(db_params_dict)
 
-    gtd = GarminTcxData(input_file, input_dir, latest, english_units, debug)
+    gtd = GarminTcxData(db_params_dict, input_file, input_dir, latest, english_units, debug)
     if gtd.file_count() > 0:
         gtd.process_files(db_params_dict)
 
-    gfd = GarminFitData(input_file, input_dir, latest, english_units, debug)
+    gfd = GarminFitData(db_params_dict, input_file, input_dir, latest, english_units, debug)
     if gfd.file_count() > 0:
         gfd.process_files(db_params_dict)
 
@@ -4,14 +4,7 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, re, logging, datetime, time, tempfile, zipfile, json, dateutil.parser
-
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException
+import os, sys, getopt, re, logging, datetime, time, tempfile, zipfile, json, shutil, hashlib, contextlib, dateutil.parser
 
 import GarminDB
 
@@ -19,6 +12,78 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 
+def file_checksum(filename):
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as checksum_file:
+        for block in iter(lambda: checksum_file.read(65536), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+#
+# Fetches the daily monitoring archives over HTTP, several days at a time, using the cookies from a logged in
+# browser session. The download url can be pointed at a local server for testing.
+#
+class MonitoringDownloader():
+
+    download_url = "https://connect.garmin.com/modern/proxy/download-service/files/wellness/"
+    headers = {'NK' : 'NT'}
+    max_attempts = 3
+    # timeout is seconds
+    request_timeout = 30
+
+    def __init__(self, cookies, outdir, download_url=None):
+        self.outdir = outdir
+        if download_url is not None:
+            self.download_url = download_url
+        self.cookie_header = '; '.join(['%s=%s' % (cookie['name'], cookie['value']) for cookie in cookies])
+
+    def download_day(self, day_date):
+        import urllib2
+        date_str = day_date.strftime("%Y-%m-%d")
+        filename = self.outdir + '/' + date_str + '.zip'
+        # download to a temp name so only complete archives ever appear under the final name
+        part_filename = filename + '.part'
+        headers = dict(self.headers, Cookie=self.cookie_header)
+        for attempt in xrange(1, self.max_attempts + 1):
+            try:
+                request = urllib2.Request(self.download_url + date_str, headers=headers)
+                with contextlib.closing(urllib2.urlopen(request, timeout=self.request_timeout)) as response:
+                    with open(part_filename, 'wb') as part_file:
+                        shutil.copyfileobj(response, part_file)
+                if not zipfile.is_zipfile(part_filename):
+                    # a login page comes back instead when the session cookies are stale, a retry won't help
+                    logger.error("download_day: %s is not a zip archive" % date_str)
+                    return None
+                os.rename(part_filename, filename)
+                return file_checksum(filename)
+            except urllib2.HTTPError as e:
+                logger.error("download_day: %s attempt %d failed: %s" % (date_str, attempt, str(e)))
+                # the error holds the response's connection open until it's closed
+                if e.fp is not None:
+                    e.fp.close()
+                # client errors won't succeed on a retry
+                if e.code < 500:
+                    return None
+            except (urllib2.URLError, IOError) as e:
+                logger.error("download_day: %s attempt %d failed: %s" % (date_str, attempt, str(e)))
+            finally:
+                if os.path.exists(part_filename):
+                    os.remove(part_filename)
+            time.sleep(attempt)
+        return None
+
+    # returns (day, archive checksum) for each day, the checksum is None if the download failed
+    def download(self, day_dates, workers):
+        from multiprocessing.pool import ThreadPool
+        logger.info("download: %d days with %d workers" % (len(day_dates), workers))
+        pool = ThreadPool(workers)
+        checksums = pool.map(self.download_day, day_dates)
+        pool.close()
+        pool.join()
+        return zip(day_dates, checksums)
+
+
 class Scrape():
 
     garmin_connect_base_url = "https://connect.garmin.com"
@@ -32,8 +97,11 @@ class Scrape():
     # timeout is seconds
     initial_page_load_timeout = 30
     page_reload_timeout = 15
+    download_timeout = 30
 
     def __init__(self):
+        # Selenium is slow to import and only needed when actually scraping
+        from selenium import webdriver
         self.temp_dir = tempfile.mkdtemp()
         logger.info("Creating profile: temp_dir= " + self.temp_dir)
         fp = webdriver.FirefoxProfile()
@@ -95,10 +163,16 @@ class Scrape():
         return element.find_elements_by_tag_name(tag)
 
     def wait_for_id(self, driver, time_s, id):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
         logger.info("Waiting for: " + id)
         return WebDriverWait(driver, time_s).until(EC.presence_of_element_located((By.ID, id)))
 
     def wait_for_xpath(self, driver, time_s, xpath):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
         logger.info("Waiting for: " + xpath)
         return WebDriverWait(driver, time_s).until(EC.presence_of_element_located((By.XPATH, xpath)))
 
@@ -129,35 +203,73 @@ class Scrape():
         dropdown.click()
         logger.debug("Finding button")
         button = dropdown.find_element_by_class_name("btn-export-original")
+        existing_files = set(os.listdir(self.temp_dir))
         logger.debug("clicking button")
         button.click()
-        time.sleep(5)
+        return self.wait_for_download(existing_files, self.download_timeout)
+
+    def wait_for_download(self, existing_files, time_s):
+        # Firefox downloads to a .part file alongside the final file and removes it when the download completes
+        end_time = time.time() + time_s
+        while time.time() < end_time:
+            files = os.listdir(self.temp_dir)
+            new_files = set(files) - existing_files
+            if len(new_files) > 0 and not any(filename.endswith('.part') for filename in files):
+                return self.temp_dir + "/" + new_files.pop()
+            time.sleep(0.25)
+        logger.error("wait_for_download: no download after %d seconds" % time_s)
 
     def browse_daily_page(self, profile_name, date):
         logger.info("browse_daily_page: %s %s" % (profile_name, repr(date)))
         daily_url = self.garmin_connect_daily_user_base_url + ("/%s/%s/timeline" % (profile_name, date.strftime("%Y-%m-%d")))
         self.load_page(daily_url)
         page_container = self.wait_for_pagecontainer(self.browser, self.initial_page_load_timeout)
-        self.save_monitoring(page_container)
+        return self.save_monitoring(page_container)
 
-    def get_monitoring(self, date, days):
-        logger.info("get_monitoring: %s : %d" % (str(date), days))
+    # returns (day, archive checksum) for each day, the checksum is None if the download failed
+    def get_monitoring(self, day_dates):
+        from selenium.common.exceptions import TimeoutException
+        logger.info("get_monitoring: %d days" % len(day_dates))
         self.load_page(self.garmin_connect_daily_url)
         page_container = self.wait_for_pagecontainer(self.browser, self.initial_page_load_timeout)
         profile_name = self.get_profile_name(self.browser)
-        for day in xrange(0, days):
-            day_date = date + datetime.timedelta(day)
+        results = []
+        for day_date in day_dates:
+            checksum = None
             try:
-                self.browse_daily_page(profile_name, day_date)
+                filename = self.browse_daily_page(profile_name, day_date)
+                if filename is not None:
+                    checksum = file_checksum(filename)
             except TimeoutException:
-                logger.error("get_monitoring: timed out on day %d of %d" % (day, days))
+                logger.error("get_monitoring: timed out on %s" % str(day_date))
+            results.append((day_date, checksum))
+        return results
+
+    def download_monitoring(self, day_dates, workers):
+        logger.info("download_monitoring: %d days" % len(day_dates))
+        # load a connect page so the browser holds the session cookies for the connect domain
+        self.load_page(self.garmin_connect_daily_url)
+        self.wait_for_pagecontainer(self.browser, self.initial_page_load_timeout)
+        downloader = MonitoringDownloader(self.browser.get_cookies(), self.temp_dir)
+        results = downloader.download(day_dates, workers)
+        for (day_date, checksum) in results:
+            if checksum is None:
+                logger.error("download_monitoring: failed to download %s" % str(day_date))
+        return results
 
     def unzip_monitoring(self, outdir):
         logger.info("unzip_monitoring: " + outdir)
         for filename in os.listdir(self.temp_dir):
-            monitoring_files_zip = zipfile.ZipFile(self.temp_dir + "/" + filename, 'r')
-            monitoring_files_zip.extractall(outdir)
-            monitoring_files_zip.close()
+            if zipfile.is_zipfile(self.temp_dir + "/" + filename):
+                with zipfile.ZipFile(self.temp_dir + "/" + filename, 'r') as monitoring_files_zip:
+                    monitoring_files_zip.extractall(outdir)
+
+    def save_monitoring_archives(self, outdir):
+        # keep the archives as downloaded, import_garmin.py reads the FIT files straight out of them
+        logger.info("save_monitoring_archives: " + outdir)
+        for filename in os.listdir(self.temp_dir):
+            if zipfile.is_zipfile(self.temp_dir + "/" + filename):
+                shutil.move(self.temp_dir + "/" + filename, outdir + "/" + filename)
 
     def get_weight_year(self, page_container):
         chart_div = page_container.find_element_by_xpath("//div[@data-highcharts-chart]")
@@ -181,8 +293,9 @@ class Scrape():
         del points[-1]
         return points
 
-    def get_weight(self):
-        logger.info("get_weight")
+    # returns the points newer than stop_ts, or all of them if stop_ts is None
+    def get_weight(self, stop_ts=None):
+        logger.info("get_weight: " + str(stop_ts))
         points = []
         self.load_page(self.garmin_connect_weight_base_url)
         page_container = self.wait_for_pagecontainer(self.browser, self.initial_page_load_timeout)
@@ -190,8 +303,12 @@ class Scrape():
         while True:
             time.sleep(1)
             page_container = self.wait_for_pagecontainer(self.browser, self.page_reload_timeout)
-            new_points = self.get_weight_year(page_container)
+            year_points = self.get_weight_year(page_container)
+            new_points = [point for point in year_points if stop_ts is None or point['timestamp'] > stop_ts]
             points += new_points
+            # each page is a year further back, once a page has points we already have there is nothing newer left
+            if len(new_points) < len(year_points):
+                break
             try:
                 self.click_by_xpath(page_container, "//button[@class='icon-arrow-left']")
             except:
@@ -207,8 +324,11 @@ def usage(program):
     print '%s -d [<date> -n <days> | -l <path to dbs>] -u <username> -p <password> [-m <outdir> | -w ]' % program
     print '  -d <date ex: 01/21/2018> -n <days> fetch n days of monitoring data starting at date'
     print '  -l check the garmin DB and find out what the most recent date is and fetch monitoring data from that date on'
+    print '     along with any earlier days that failed to download or have gaps'
     print '  -m <outdir> fetches the daily monitoring FIT files for each day specified, unzips them, and puts them in outdit'
-    print '  -w <outdit> fetches the daily weight data for each day specified and puts them in the DB'
+    print '  -z keep the monitoring zip files in outdir instead of unzipping them, import_garmin.py imports directly from them'
+    print '  -j <n> download n days of monitoring data at a time, 0 uses the browser for each day (default 4)'
+    print '  -w <outdit> fetches the weight data newer than the latest weight in the DB, saves it in outdir, and puts it in the DB'
     sys.exit()
 
 def main(argv):
@@ -220,11 +340,13 @@ def main(argv):
     password = None
     monitoring = None
     weight = None
+    jobs = 4
+    keep_archives = False
     debug = False
 
     try:
-        opts, args = getopt.getopt(argv,"d:n:lm:p:s:tu:w:",
-            ["debug", "date=", "days=", "username=", "password=", "latest", "monitoring=", "mysql=", "sqlite=", "weight="])
+        opts, args = getopt.getopt(argv,"d:j:n:lm:p:s:tu:w:z",
+            ["debug", "date=", "days=", "jobs=", "username=", "password=", "latest", "monitoring=", "mysql=", "sqlite=", "weight=", "zip"])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -239,6 +361,9 @@ def main(argv):
         elif opt in ("-n", "--days"):
             logger.debug("Days: " + arg)
             days = int(arg)
+        elif opt in ("-j", "--jobs"):
+            logger.debug("Jobs: " + arg)
+            jobs = int(arg)
         elif opt in ("-l", "--latest"):
             logger.debug("Latest" )
             latest = True
@@ -254,6 +379,9 @@ def main(argv):
         elif opt in ("-w", "--weight"):
             logger.debug("Weight")
             weight = arg
+        elif opt in ("-z", "--zip"):
+            logger.debug("Keep archives")
+            keep_archives = True
         elif opt in ("-s", "--sqlite"):
             logging.debug("Sqlite DB path: %s" % arg)
             db_params_dict['db_type'] = 'sqlite'
@@ -281,6 +409,11 @@ def main(argv):
         print "Missing arguments: must specify <db params> with --sqlite or --mysql"
         usage(sys.argv[0])
 
+    if monitoring and len(db_params_dict) > 0:
+        garmindb = GarminDB.GarminDB(db_params_dict)
+    else:
+        garmindb = None
+
     if latest and monitoring:
         mondb = GarminDB.MonitoringDB(db_params_dict)
         last_ts = GarminDB.Monitoring.latest_time(mondb)
@@ -293,31 +426,46 @@ def main(argv):
             logger.info("Automatically downloading monitoring data from: " + str(last_ts))
             date = last_ts.date() + datetime.timedelta(1)
             days = (datetime.datetime.now().date() - date).days
+        # skip days already downloaded and pick up earlier days that failed or have gaps
+        day_dates = GarminDB.ScrapeState.days_to_fetch(garmindb, date, date + datetime.timedelta(days))
+    elif monitoring:
+        day_dates = [date + datetime.timedelta(day) for day in xrange(0, days)]
 
-    if monitoring and days > 0:
-        logger.info("Date range to update: %s (%d)" % (str(date), days))
+    if monitoring and len(day_dates) > 0:
+        logger.info("Days to update: %s to %s (%d)" % (str(day_dates[0]), str(day_dates[-1]), len(day_dates)))
         scrape = Scrape()
         scrape.login(username, password)
-        scrape.get_monitoring(date, days)
-        scrape.unzip_monitoring(monitoring)
-        logger.info("Saved monitoring files for %s (%d) to %s for processing" % (str(date), days, monitoring))
+        if jobs > 0:
+            results = scrape.download_monitoring(day_dates, jobs)
+        else:
+            results = scrape.get_monitoring(day_dates)
+        if garmindb is not None:
+            for (day_date, checksum) in results:
+                GarminDB.ScrapeState.record_download(garmindb, day_date, checksum)
+        if keep_archives:
+            scrape.save_monitoring_archives(monitoring)
+        else:
+            scrape.unzip_monitoring(monitoring)
+        logger.info("Saved monitoring files for %d days to %s for processing" % (len(day_dates), monitoring))
 
     if weight:
+        garmindb = GarminDB.GarminDB(db_params_dict)
+        latest_ts = GarminDB.Weight.latest_time(garmindb)
         scrape = Scrape()
         scrape.login(username, password)
-        points = scrape.get_weight()
-
-        # dump weight data to file as json
-        json_filename = weight + '/weight_' + str(int(time.time())) + '.json'
-        save_file = open(json_filename, 'w')
-        save_file.write(json.dumps(points, default=convert_to_json))
-        save_file.close()
-
-        garmindb = GarminDB.GarminDB(db_params_dict)
-        for point in points:
-            logger.debug("Inserting: " + repr(point))
-            GarminDB.Weight.create_or_update(garmindb, point)
-        logger.info("DB updated with weight data for %s (%d)" % (str(date), len(points)))
+        points = scrape.get_weight(latest_ts)
+
+        if len(points) > 0:
+            # dump weight data to file as json
+            json_filename = weight + '/weight_' + str(int(time.time())) + '.json'
+            save_file = open(json_filename, 'w')
+            save_file.write(json.dumps(points, default=convert_to_json))
+            save_file.close()
+
+            GarminDB.Weight.create_or_update_batch(garmindb, points)
+            # already in the DB, import_garmin.py doesn't need to read it again
+            GarminDB.ImportCursors.set_file_applied(garmindb, 'weight', json_filename)
+        logger.info("DB updated with weight data newer than %s (%d)" % (str(latest_ts), len(points)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, tempfile, shutil, os, datetime, hashlib, threading, zipfile, StringIO, BaseHTTPServer, SocketServer
+
+# scrape_garmin imports the DB modules, which need the Fit submodule and SQLAlchemy
+try:
+    import scrape_garmin
+    missing_dependency = None
+except ImportError as e:
+    missing_dependency = str(e)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+#
+# Serves /wellness/<date> as a zip archive for that date, 404s for dates in missing_dates and a login page for dates
+# in login_dates.
+#
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    missing_dates = []
+    login_dates = []
+    cookies = []
+
+    @classmethod
+    def archive(cls, date_str):
+        archive_data = StringIO.StringIO()
+        with zipfile.ZipFile(archive_data, 'w') as archive:
+            archive.writestr(zipfile.ZipInfo(date_str + '.fit', (2018, 1, 1, 0, 0, 0)), 'fit data ' + date_str)
+        return archive_data.getvalue()
+
+    def do_GET(self):
+        date_str = self.path.split('/')[-1]
+        StubHandler.cookies.append(self.headers.getheader('Cookie'))
+        if date_str in self.missing_dates:
+            self.send_error(404)
+            return
+        if date_str in self.login_dates:
+            body = '<html><body>Sign in</body></html>'
+        else:
+            body = self.archive(date_str)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipIf(missing_dependency is not None, "scrape_garmin unavailable: %s" % missing_dependency)
+class TestMonitoringDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.download_url = 'http://127.0.0.1:%d/wellness/' % self.server.server_address[1]
+        StubHandler.cookies = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.outdir)
+
+    def test_download(self):
+        days = [datetime.date(2018, 6, 1) + datetime.timedelta(day) for day in xrange(10)]
+        StubHandler.missing_dates = [days[3].strftime("%Y-%m-%d")]
+        StubHandler.login_dates = [days[6].strftime("%Y-%m-%d")]
+        downloader = scrape_garmin.MonitoringDownloader([{'name' : 'session', 'value' : '1234'}], self.outdir, self.download_url)
+        results = downloader.download(days, 4)
+        self.assertEqual([day for (day, checksum) in results], days)
+        for (day, checksum) in results:
+            date_str = day.strftime("%Y-%m-%d")
+            if date_str in StubHandler.missing_dates or date_str in StubHandler.login_dates:
+                self.assertIsNone(checksum)
+                self.assertFalse(os.path.exists(self.outdir + '/' + date_str + '.zip'))
+            else:
+                self.assertEqual(checksum, hashlib.sha1(StubHandler.archive(date_str)).hexdigest())
+        # only complete archives are left behind
+        self.assertEqual(len(os.listdir(self.outdir)), len(days) - 2)
+        self.assertEqual(set(StubHandler.cookies), set(['session=1234']))
+
+
+if __name__ == '__main__':
+    unittest.main()
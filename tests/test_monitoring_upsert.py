@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, tempfile, shutil, os
+
+# The importer needs the Fit submodule (make submodules_update) and SQLAlchemy.
+try:
+    import Fit
+    import FitFileProcessor
+    import GarminDB
+    missing_dependency = None
+except ImportError as e:
+    missing_dependency = str(e)
+
+
+#
+# monitoring_multi_activity.fit is a monitoring_b file from a device tracking walking and running. It has five
+# monitoring samples over two minutes, with both activity types at each minute and the first walking sample
+# repeated, and three heart rate samples, two of them at the same time.
+#
+@unittest.skipIf(missing_dependency is not None, "monitoring import unavailable: %s" % missing_dependency)
+class TestMonitoringUpsert(unittest.TestCase):
+
+    fit_file_name = os.path.join(os.path.dirname(__file__), 'files', 'monitoring_multi_activity.fit')
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_params_dict = {'db_type' : 'sqlite', 'db_path' : self.db_dir}
+        self.fp = FitFileProcessor.FitFileProcessor(self.db_params_dict, False, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def check_rows(self):
+        mon_db = GarminDB.MonitoringDB(self.db_params_dict)
+        self.assertEqual(GarminDB.Monitoring.row_count(mon_db), 4)
+        self.assertEqual(GarminDB.MonitoringHeartRate.row_count(mon_db), 2)
+        session = mon_db.session()
+        steps = [row.steps for row in session.query(GarminDB.Monitoring).order_by(GarminDB.Monitoring.timestamp, GarminDB.Monitoring.steps).all()]
+        self.assertEqual(steps, [40, 100, 60, 150])
+        heart_rates = [row.heart_rate for row in session.query(GarminDB.MonitoringHeartRate).order_by(GarminDB.MonitoringHeartRate.timestamp).all()]
+        self.assertEqual(heart_rates, [72, 75])
+        session.close()
+
+    def import_twice(self):
+        # importing the same file again updates the rows instead of adding new ones
+        for attempt in xrange(2):
+            self.fp.write_file(Fit.File(self.fit_file_name, False))
+            self.check_rows()
+
+    def test_native_upsert(self):
+        self.import_twice()
+
+    def test_orm_upsert(self):
+        self.fp.garmin_mon_db.native_upsert = lambda: False
+        self.import_twice()
+
+
+if __name__ == '__main__':
+    unittest.main()
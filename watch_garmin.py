@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import os, sys, getopt, logging, time
+
+import Fit
+import FileProcessor
+import FitFileProcessor
+import GarminDB
+import import_garmin
+import import_garmin_activities
+import analyze_garmin
+
+
+root_logger = logging.getLogger()
+logger = logging.getLogger(__file__)
+
+
+class GarminWatcher():
+
+    # seconds a file has to go unmodified before we import it, so we don't read files that are still being written
+    settle_time = 5
+
+    def __init__(self, db_params_dict, monitoring_dirs, activities_dir, weight_dir, import_existing, english_units, debug):
+        self.english_units = english_units
+        self.debug = debug
+        logger.info("Debug: %s English units: %s" % (str(debug), str(english_units)))
+
+        # open the DBs once and keep the engines warm for the life of the process
+        self.fit_processor = FitFileProcessor.FitFileProcessor(db_params_dict, english_units, debug)
+        self.garmin_db = self.fit_processor.garmin_db
+        self.garmin_mon_db = self.fit_processor.garmin_mon_db
+        self.garmin_act_db = self.fit_processor.garmin_act_db
+
+        self.fit_data = import_garmin.GarminFitData(db_params_dict, None, None, False, False, english_units, debug)
+        self.weight_data = import_garmin.GarminWeightData(db_params_dict, None, None, False, english_units, debug)
+        self.tcx_data = import_garmin_activities.GarminTcxData(db_params_dict, None, None, False, english_units, debug)
+        self.tcx_data.garmin_db = self.garmin_db
+        self.tcx_data.garmin_act_db = self.garmin_act_db
+        self.json_data = import_garmin_activities.GarminJsonData(db_params_dict, None, None, False, english_units, debug)
+        self.json_data.garmin_act_db = self.garmin_act_db
+
+        self.analyze = analyze_garmin.Analyze(db_params_dict, debug - 1)
+
+        # file types match the ones the batch importers keep their import cursors under
+        self.watches = []
+        for monitoring_dir in monitoring_dirs:
+            self.watches.append((monitoring_dir, '.*\.fit', 'fit', self.process_fit_file))
+            self.watches.append((monitoring_dir, '.*\.zip', 'fit', self.process_fit_archive))
+        if activities_dir:
+            self.watches.append((activities_dir, '.*\.fit', 'fit', self.process_fit_file))
+            self.watches.append((activities_dir, '.*\.tcx', 'tcx', self.tcx_data.process_file))
+            self.watches.append((activities_dir, 'activity_.*\.json', 'json', self.json_data.process_file))
+        if weight_dir:
+            self.watches.append((weight_dir, 'weight_.*\.json', 'weight', self.process_weight_file))
+        self.file_mtimes = {}
+
+        # start from the import cursors so files that arrived while we weren't running still get imported
+        self.cursors = {}
+        for (input_dir, file_regex, file_type, handler) in self.watches:
+            if import_existing:
+                self.cursors[(file_type, input_dir)] = None
+            else:
+                self.cursors[(file_type, input_dir)] = GarminDB.ImportCursors.get_cursor(self.garmin_db, file_type, input_dir)
+
+    def process_fit_file(self, file_name):
+        self.fit_processor.write_file(Fit.File(file_name, self.english_units))
+
+    def process_fit_archive(self, file_name):
+        failed_members = self.fit_data.process_archive(self.fit_processor, file_name)
+        if len(failed_members) > 0:
+            # so the import cursor isn't moved past the archive
+            raise IOError("%d of the archive's files failed" % len(failed_members))
+
+    def process_weight_file(self, file_name):
+        self.weight_data.process_file(self.garmin_db, file_name)
+
+    def scan(self):
+        new_files = []
+        settled_time = time.time() - self.settle_time
+        for (input_dir, file_regex, file_type, handler) in self.watches:
+            if not os.path.isdir(input_dir):
+                continue
+            newer_than = self.cursors[(file_type, input_dir)]
+            for (mtime, file_name) in FileProcessor.FileProcessor.dir_to_file_mtimes(input_dir, file_regex, newer_than=newer_than):
+                if mtime < settled_time and self.file_mtimes.get(file_name) != mtime:
+                    self.file_mtimes[file_name] = mtime
+                    new_files.append((mtime, file_name, file_type, input_dir, handler))
+        return sorted(new_files)
+
+    def advance_cursors(self, new_files, failed_file_names):
+        for cursor_key in set([(file_type, input_dir) for (mtime, file_name, file_type, input_dir, handler) in new_files]):
+            (file_type, input_dir) = cursor_key
+            file_mtimes = [(mtime, file_name) for (mtime, file_name, _file_type, _input_dir, handler) in new_files if (_file_type, _input_dir) == cursor_key]
+            GarminDB.ImportCursors.advance_cursor(self.garmin_db, file_type, input_dir, file_mtimes, failed_file_names)
+            self.cursors[cursor_key] = GarminDB.ImportCursors.get_cursor(self.garmin_db, file_type, input_dir)
+
+    def update_summary(self, prev_latest_ts):
+        latest_ts = GarminDB.Monitoring.latest_time(self.garmin_mon_db)
+        if latest_ts is None:
+            return
+        if prev_latest_ts is None:
+            logger.info("Building summary for all monitoring data")
+            self.analyze.summary()
+        else:
+            logger.info("Updating summary for %s to %s" % (str(prev_latest_ts.date()), str(latest_ts.date())))
+            self.analyze.summary_days(prev_latest_ts.date(), latest_ts.date())
+
+    def process(self, new_files):
+        prev_latest_ts = GarminDB.Monitoring.latest_time(self.garmin_mon_db)
+        failed_file_names = []
+        for (mtime, file_name, file_type, input_dir, handler) in new_files:
+            logger.info("Importing: " + file_name)
+            try:
+                handler(file_name)
+            except Exception as e:
+                logger.error("Failed to import %s: %s" % (file_name, str(e)))
+                failed_file_names.append(file_name)
+        self.garmin_act_db.update_track_tables()
+        self.update_summary(prev_latest_ts)
+        self.advance_cursors(new_files, failed_file_names)
+
+    def run(self, poll_interval):
+        logger.info("Watching %d directories every %d seconds" % (len(self.watches), poll_interval))
+        while True:
+            new_files = self.scan()
+            if len(new_files) > 0:
+                self.process(new_files)
+            time.sleep(poll_interval)
+
+
+def usage(program):
+    print '%s [-s <sqlite db path> | -m <user,password,host>] [-f <monitoring_dir> ...] [-a <activities_dir>] [-w <weight_dir>] ...' % program
+    print '    --trace <level> : turn on debug tracing'
+    print '    --english : units - use feet, lbs, etc'
+    print '    --interval <seconds> : how often to check the directories for new files'
+    print '    --all : import all of the files already in the directories at startup, ignoring the import cursors'
+    print '    '
+    sys.exit()
+
+def main(argv):
+    debug = 0
+    english_units = False
+    monitoring_dirs = []
+    activities_dir = None
+    weight_dir = None
+    poll_interval = 60
+    import_existing = False
+    db_params_dict = {}
+
+    try:
+        opts, args = getopt.getopt(argv,"a:Aef:i:m:s:t:w:",
+            ["activities_input_dir=", "all", "english", "fit_input_dir=", "interval=", "mysql=", "sqlite=", "trace=", "weight_input_dir="])
+    except getopt.GetoptError:
+        usage(sys.argv[0])
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(sys.argv[0])
+        elif opt in ("-t", "--trace"):
+            debug = int(arg)
+        elif opt in ("-e", "--english"):
+            english_units = True
+        elif opt in ("-f", "--fit_input_dir"):
+            logging.debug("Fit input dir: %s" % arg)
+            monitoring_dirs.append(arg)
+        elif opt in ("-a", "--activities_input_dir"):
+            logging.debug("Activities input dir: %s" % arg)
+            activities_dir = arg
+        elif opt in ("-w", "--weight_input_dir"):
+            logging.debug("Weight input dir: %s" % arg)
+            weight_dir = arg
+        elif opt in ("-i", "--interval"):
+            poll_interval = int(arg)
+        elif opt in ("-A", "--all"):
+            import_existing = True
+        elif opt in ("-s", "--sqlite"):
+            logging.debug("Sqlite DB path: %s" % arg)
+            db_params_dict['db_type'] = 'sqlite'
+            db_params_dict['db_path'] = arg
+        elif opt in ("-m", "--mysql"):
+            logging.debug("Mysql DB string: %s" % arg)
+            db_args = arg.split(',')
+            db_params_dict['db_type'] = 'mysql'
+            db_params_dict['db_username'] = db_args[0]
+            db_params_dict['db_password'] = db_args[1]
+            db_params_dict['db_host'] = db_args[2]
+
+    if debug > 0:
+        root_logger.setLevel(logging.DEBUG)
+    else:
+        root_logger.setLevel(logging.INFO)
+
+    if len(monitoring_dirs) == 0 and not activities_dir and not weight_dir:
+        print "Missing arguments: at least one directory to watch"
+        usage(sys.argv[0])
+    if len(db_params_dict) == 0:
+        print "Missing arguments: db params"
+        usage(sys.argv[0])
+
+    watcher = GarminWatcher(db_params_dict, monitoring_dirs, activities_dir, weight_dir, import_existing, english_units, debug)
+    watcher.run(poll_interval)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])